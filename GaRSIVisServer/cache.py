@@ -0,0 +1,108 @@
+from hashlib import md5
+from json import dump, dumps
+from os import getpid, listdir, makedirs, remove, replace, stat, utime
+from os.path import dirname, isdir, join
+from typing import Dict, List
+
+from preprocess import CACHE_FOLDER
+
+CACHE_SIZE = 512 * 1024 * 1024  # maximum size of all cached files in bytes
+
+
+def get_cache_file(session_name: str, chunk_size: int, ignored: List[Dict], version: str) -> str:
+    """
+    Get the path of the cached chunks of a session.
+    :param session_name: Name of the session
+    :param chunk_size: Size of each chunk in seconds
+    :param ignored: List of ignored times of the session
+    :param version: Version of the feature calculation, cached chunks of other versions are not used
+    :return: Path of the cache file
+    """
+    key = md5(dumps([ignored, version], sort_keys=True).encode('utf8')).hexdigest()
+    return join(CACHE_FOLDER, session_name, '{}-{}.json'.format(chunk_size, key))
+
+
+def read_cache(cache_file: str) -> bool:
+    """
+    Check whether a cache file exists and mark it as recently used.
+    :param cache_file: Path of the cache file
+    :return: Whether the cache file exists
+    """
+    try:
+        utime(cache_file)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def write_cache(cache_file: str, chunks: List[Dict], cache_size: int = CACHE_SIZE) -> None:
+    """
+    Write chunks to a cache file, and evict the least recently used cache files if the cache is too large.
+    The file is written under a temporary name first, so readers never see a partial file.
+    :param cache_file: Path of the cache file
+    :param chunks: List of chunks with fixation and saccade features
+    :param cache_size: Maximum size of all cache files in bytes
+    """
+    try:
+        makedirs(dirname(cache_file))
+    except FileExistsError:
+        pass
+    temporary_file = '{}.{}.tmp'.format(cache_file, getpid())
+    with open(temporary_file, 'w') as target:
+        dump(chunks, target, indent=2)
+    replace(temporary_file, cache_file)
+    evict(cache_size)
+
+
+def evict(cache_size: int = CACHE_SIZE) -> int:
+    """
+    Remove the least recently used cache files until all cache files fit into the cache size.
+    :param cache_size: Maximum size of all cache files in bytes
+    :return: Number of removed cache files
+    """
+    files = []
+    for session_name in listdir(CACHE_FOLDER) if isdir(CACHE_FOLDER) else []:
+        folder = join(CACHE_FOLDER, session_name)
+        for file_name in listdir(folder) if isdir(folder) else []:
+            if file_name.endswith('.json'):
+                try:
+                    file_stat = stat(join(folder, file_name))
+                except FileNotFoundError:
+                    continue
+                files.append((file_stat.st_mtime, file_stat.st_size, join(folder, file_name)))
+    total_size = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total_size <= cache_size:
+            break
+        try:
+            remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total_size -= size
+    return removed
+
+
+def get_cache_stats(hits: int, misses: int) -> Dict:
+    """
+    Summarize the cache usage.
+    :param hits: Number of cache hits
+    :param misses: Number of cache misses
+    :return: Dict with hits, misses, hit rate, and number and size of the cache files
+    """
+    count = 0
+    size = 0
+    for session_name in listdir(CACHE_FOLDER) if isdir(CACHE_FOLDER) else []:
+        folder = join(CACHE_FOLDER, session_name)
+        for file_name in listdir(folder) if isdir(folder) else []:
+            if file_name.endswith('.json'):
+                count += 1
+                size += stat(join(folder, file_name)).st_size
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else 0,
+        'files': count,
+        'size': size
+    }
@@ -0,0 +1,47 @@
+import unittest
+from os import utime
+from os.path import isfile
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from cache import evict, get_cache_file, get_cache_stats, read_cache, write_cache
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.patch = patch('cache.CACHE_FOLDER', self.directory.name)
+        self.patch.start()
+
+    def tearDown(self) -> None:
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_key(self) -> None:
+        ignored = [{'start': 1, 'end': 2}]
+        self.assertEqual(get_cache_file('session', 5, ignored, '1'), get_cache_file('session', 5, list(ignored), '1'))
+        self.assertNotEqual(get_cache_file('session', 5, ignored, '1'), get_cache_file('session', 10, ignored, '1'))
+        self.assertNotEqual(get_cache_file('session', 5, ignored, '1'), get_cache_file('session', 5, [], '1'))
+        self.assertNotEqual(get_cache_file('session', 5, ignored, '1'), get_cache_file('session', 5, ignored, '2'))
+
+    def test_read_write(self) -> None:
+        cache_file = get_cache_file('session', 5, [], '1')
+        self.assertFalse(read_cache(cache_file))
+        write_cache(cache_file, [{'start': 0, 'end': 5}])
+        self.assertTrue(read_cache(cache_file))
+        self.assertEqual({'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'files': 1}, {
+            name: value for name, value in get_cache_stats(1, 1).items() if name != 'size'})
+
+    def test_evict_least_recently_used(self) -> None:
+        cache_files = [get_cache_file('session', chunk_size, [], '1') for chunk_size in range(3)]
+        for i, cache_file in enumerate(cache_files):
+            write_cache(cache_file, [{'start': 0, 'end': 5}])
+            utime(cache_file, (i, i))
+        read_cache(cache_files[0])
+        size = get_cache_stats(0, 0)['size']
+        self.assertEqual(1, evict(size - 1))
+        self.assertEqual([True, False, True], [isfile(cache_file) for cache_file in cache_files])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,24 @@
-from json import load, dump
+from collections import deque
+from heapq import heappop, heappush
+from json import dump, load
 from math import ceil, floor
+from multiprocessing import cpu_count
 from multiprocessing.pool import Pool
-from os import listdir, makedirs
-from os.path import join, isfile
-from statistics import mean, median, variance
-from typing import Dict, List
+from os import getpid, makedirs, remove, replace
+from os.path import join
+from shutil import copyfile
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from cache import CACHE_SIZE, get_cache_file, get_cache_stats, read_cache, write_cache
+from features import CHUNK_FEATURES, EVENTS, ORDER_STATISTICS, STATISTICS, plan_features
+from preprocess import CHUNK_FOLDER, CHUNK_PARAMETER_FOLDER, get_relative_seconds_array, list_combined, read_combined, \
+    read_combined_times, read_second_index
+
+FEATURE_VERSION = 1  # increase when the chunk features change
+RUNNING_OVERLAP = 32  # average number of windows per value above which overlapping windows slide
 
 
 def get_relative_seconds(event: Dict, start: int) -> int:
@@ -25,67 +39,392 @@ def bin_events_to_chunks(events: List[Dict], start: int, chunks: List[Dict], eve
     :param chunks: List of relevant chunks with start and end as relative second values
     :param event_name: Name of event property
     """
-    i = 0
-    for chunk in chunks:
-        chunk[event_name] = []
-        time_s = get_relative_seconds(events[i], start)
-        while time_s < chunk['start'] and i < len(events):
-            i += 1
-            if i == len(events):
-                break
-            time_s = get_relative_seconds(events[i], start)
-        while time_s < chunk['end'] and i < len(events):
-            chunk[event_name].append(events[i])
-            i += 1
-            if i == len(events):
-                break
-            time_s = get_relative_seconds(events[i], start)
-
-
-def add_features_to_chunk(chunks: List) -> None:
-    """
-    Replace fixations and saccades in a chunk with the calculated features in place.
-    :param chunks: List of chunks with fixations and saccades
-    """
-    for chunk in chunks:
-        durations = [fixation['end'] - fixation['start'] for fixation in chunk['fixations']]
-        chunk['fixations'] = {
-            'duration': {
-                'avg': mean(durations) if len(durations) else 0,
-                'med': median(durations) if len(durations) else 0,
-                'min': min(durations) if len(durations) else 0,
-                'max': max(durations) if len(durations) else 0,
-                'var': variance(durations) if len(durations) > 1 else 0
-            },
-            'count': len(chunk['fixations'])
-        }
-        durations = [saccade['end'] - saccade['start'] for saccade in chunk['saccades']]
-        lengths = [saccade['length'] for saccade in chunk['saccades']]
-        angles = [saccade['angle'] for saccade in chunk['saccades']]
-        chunk['saccades'] = {
-            'duration': {
-                'avg': mean(durations) if len(durations) else 0,
-                'med': median(durations) if len(durations) else 0,
-                'min': min(durations) if len(durations) else 0,
-                'max': max(durations) if len(durations) else 0,
-                'var': variance(durations) if len(durations) > 1 else 0
-            },
-            'length': {
-                'avg': mean(lengths) if len(lengths) else 0,
-                'med': median(lengths) if len(lengths) else 0,
-                'min': min(lengths) if len(lengths) else 0,
-                'max': max(lengths) if len(lengths) else 0,
-                'var': variance(lengths) if len(lengths) > 1 else 0
-            },
-            'angle': {
-                'avg': mean(angles) if len(angles) else 0,
-                'med': median(angles) if len(angles) else 0,
-                'min': min(angles) if len(angles) else 0,
-                'max': max(angles) if len(angles) else 0,
-                'var': variance(angles) if len(angles) > 1 else 0
-            },
-            'count': len(chunk['saccades'])
-        }
+    lower, upper = get_chunk_ranges(get_relative_seconds_array(get_event_columns(events, ['start', 'end']), start),
+                                    np.array([chunk['start'] for chunk in chunks], dtype=np.int64),
+                                    np.array([chunk['end'] for chunk in chunks], dtype=np.int64))
+    for chunk, first, last in zip(chunks, lower.tolist(), upper.tolist()):
+        chunk[event_name] = events[first:last]
+
+
+def get_event_columns(events: Union[List[Dict], Dict], names: List[str]) -> Dict:
+    """
+    Get the given properties of events as columns.
+    :param events: List of events, or events that are already columns
+    :param names: Names of the properties
+    :return: Dict with an array per property
+    """
+    if isinstance(events, dict):
+        return {name: np.asarray(events[name]) for name in names}
+    return {name: np.array([event[name] for event in events]) for name in names}
+
+
+def get_chunk_ranges(seconds: np.ndarray, chunk_starts: np.ndarray,
+                     chunk_ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the range of events in each chunk by binary search on the middle of the events.
+    The events have to be sorted by their middle, as consecutive fixations or saccades are.
+    :param seconds: Array of the middle of the events as relative seconds, see get_relative_seconds_array
+    :param chunk_starts: Array of chunk starts as relative seconds
+    :param chunk_ends: Array of chunk ends as relative seconds
+    :return: Arrays of the first event index and the index after the last event of each chunk
+    """
+    return np.searchsorted(seconds, chunk_starts), np.searchsorted(seconds, chunk_ends)
+
+
+def get_segment_statistics(values: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                           statistics: List[str] = STATISTICS) -> Dict[str, np.ndarray]:
+    """
+    Calculate the statistics of segments of values.
+    Statistics of empty segments are 0, the variance of segments with a single value is 0.
+    :param values: Array of values
+    :param lower: Array of the first index of each segment
+    :param upper: Array of the index after the last value of each segment
+    :param statistics: Names of the statistics to calculate, out of avg, med, min, max, and var
+    :return: Dict with an array with one value per segment for each statistic
+    """
+    counts = upper - lower
+    result = get_order_statistics(values, lower, upper) if set(statistics) & set(ORDER_STATISTICS) else {}
+    result['avg'] = np.zeros(len(counts))
+    result['var'] = np.zeros(len(counts))
+    filled = counts > 0
+    if not filled.any() or not {'avg', 'var'} & set(statistics):
+        return {name: result[name] for name in statistics}
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    segments = np.repeat(np.arange(len(counts)), counts)
+    segment_values = values[np.repeat(lower - offsets[:-1], counts) + np.arange(offsets[-1])]
+    first = offsets[:-1][filled]
+    n = counts[filled]
+
+    result['avg'][filled] = np.add.reduceat(segment_values, first) / n
+    if 'var' in statistics:
+        deviations = segment_values - result['avg'][segments]
+        squares = np.add.reduceat(deviations * deviations, first)
+        result['var'][filled] = np.where(n > 1, squares / np.maximum(n - 1, 1), 0)
+    return {name: result[name] for name in statistics}
+
+
+def get_order_statistics(values: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Calculate the median, minimum, and maximum of segments of values.
+    Statistics of empty segments are 0.
+    :param values: Array of values
+    :param lower: Array of the first index of each segment
+    :param upper: Array of the index after the last value of each segment
+    :return: Dict with med, min, and max arrays with one value per segment
+    """
+    counts = upper - lower
+    statistics = {
+        'med': np.zeros(len(counts)),
+        'min': np.zeros(len(counts), dtype=values.dtype),
+        'max': np.zeros(len(counts), dtype=values.dtype)
+    }
+    filled = counts > 0
+    if not filled.any():
+        return statistics
+    # Values of all segments one after another, sorted within each segment
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    segments = np.repeat(np.arange(len(counts)), counts)
+    segment_values = values[np.repeat(lower - offsets[:-1], counts) + np.arange(offsets[-1])]
+    sorted_values = segment_values[np.lexsort((segment_values, segments))]
+    first = offsets[:-1][filled]
+    last = offsets[1:][filled] - 1
+
+    statistics['med'][filled] = (sorted_values[(first + last) // 2] + sorted_values[(first + last + 1) // 2]) / 2
+    statistics['min'][filled] = sorted_values[first]
+    statistics['max'][filled] = sorted_values[last]
+    return statistics
+
+
+def get_window_statistics(index: Dict, measure: str, event: str, window_starts: np.ndarray,
+                          window_ends: np.ndarray, statistics: List[str] = STATISTICS,
+                          sliding=False) -> Dict[str, np.ndarray]:
+    """
+    Calculate the statistics of a measure in time windows from the per-second index, see get_segment_statistics.
+    Count, average, and variance only take the prefix sums at the window bounds.
+    :param index: Per-second index as returned by preprocess.get_second_index
+    :param measure: Name of the measure, e.g. saccade_length
+    :param event: Event type of the measure, fixation or saccade
+    :param window_starts: Array of window starts as relative seconds
+    :param window_ends: Array of window ends as relative seconds
+    :param statistics: Names of the statistics to calculate, out of avg, med, min, max, and var
+    :param sliding: Whether the windows overlap, see get_overlapping_order_statistics
+    :return: Dict with an array with one value per window for each statistic
+    """
+    prefix = index[event + '_count_prefix']
+    lower = prefix[window_starts]
+    upper = prefix[window_ends]
+    sums = index[measure + '_sum_prefix'][window_ends] - index[measure + '_sum_prefix'][window_starts]
+    squares = index[measure + '_sumsq_prefix'][window_ends] - index[measure + '_sumsq_prefix'][window_starts]
+    order_statistics = [name for name in statistics if name in ORDER_STATISTICS]
+    if not order_statistics:
+        result = {}
+    elif sliding:
+        result = get_overlapping_order_statistics(index[measure + '_sorted'], lower, upper, order_statistics)
+    else:
+        result = get_order_statistics(index[measure + '_sorted'], lower, upper)
+    result.update(get_moment_statistics(float(index[measure + '_shift']), sums, squares, upper - lower))
+    return {name: result[name] for name in statistics}
+
+
+def get_moment_statistics(shift: float, sums: np.ndarray, squares: np.ndarray, n: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Calculate the average and variance of windows from the sums of their shifted values.
+    Statistics of empty windows are 0, the variance of windows with a single value is 0.
+    :param shift: Value subtracted from all values before summing them, for numerical stability
+    :param sums: Array of the sums of the shifted values of each window
+    :param squares: Array of the sums of the squared shifted values of each window
+    :param n: Array of the number of values of each window
+    :return: Dict with avg and var arrays with one value per window
+    """
+    return {
+        'avg': np.where(n > 0, shift + sums / np.maximum(n, 1), 0),
+        'var': np.where(n > 1, np.maximum(squares - sums * sums / np.maximum(n, 1), 0) / np.maximum(n - 1, 1), 0)
+    }
+
+
+def get_sliding_statistics(values: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                           statistics: List[str] = STATISTICS) -> Dict[str, np.ndarray]:
+    """
+    Calculate the statistics of overlapping windows of values, see get_segment_statistics.
+    Average and variance take the prefix sums at the window bounds, see get_overlapping_order_statistics
+    for the order statistics.
+    :param values: Array of values
+    :param lower: Array of the first index of each window
+    :param upper: Array of the index after the last value of each window
+    :param statistics: Names of the statistics to calculate, out of avg, med, min, max, and var
+    :return: Dict with an array with one value per window for each statistic
+    """
+    order_statistics = [name for name in statistics if name in ORDER_STATISTICS]
+    result = get_overlapping_order_statistics(values, lower, upper, order_statistics) if order_statistics else {}
+    shift = float(values.mean()) if len(values) else 0.0
+    shifted = values - shift
+    sum_prefix = np.concatenate([[0], np.cumsum(shifted)])
+    sumsq_prefix = np.concatenate([[0], np.cumsum(shifted * shifted)])
+    result.update(get_moment_statistics(shift, sum_prefix[upper] - sum_prefix[lower],
+                                        sumsq_prefix[upper] - sumsq_prefix[lower], upper - lower))
+    return {name: result[name] for name in statistics}
+
+
+def get_overlapping_order_statistics(values: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                                     statistics: List[str] = ORDER_STATISTICS) -> Dict[str, np.ndarray]:
+    """
+    Calculate the median, minimum, and maximum of overlapping windows of values.
+    Sorting each window costs time in the number of windows times their size, so if the windows overlap a lot,
+    a window slides over the values instead, see get_running_order_statistics.
+    :param values: Array of values
+    :param lower: Array of the first index of each window
+    :param upper: Array of the index after the last value of each window
+    :param statistics: Names of the statistics to calculate, out of med, min, and max
+    :return: Dict with an array with one value per window for each statistic
+    """
+    if int((upper - lower).sum()) > RUNNING_OVERLAP * len(values):
+        return get_running_order_statistics(values, lower, upper, statistics)
+    result = get_order_statistics(values, lower, upper)
+    return {name: result[name] for name in statistics}
+
+
+def get_running_order_statistics(values: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                                 statistics: List[str] = ORDER_STATISTICS) -> Dict[str, np.ndarray]:
+    """
+    Calculate the median, minimum, and maximum of windows of values by sliding a window over the values,
+    see get_order_statistics.
+    Values entering and leaving the window update two heaps for the median and monotonic queues for the minimum
+    and maximum, so windows that move forward cost time near-linear in the number of values instead of
+    the number of windows times their size. The window starts over whenever it moves backward.
+    :param values: Array of values
+    :param lower: Array of the first index of each window
+    :param upper: Array of the index after the last value of each window
+    :param statistics: Names of the statistics to calculate, out of med, min, and max
+    :return: Dict with an array with one value per window for each statistic
+    """
+    result = {
+        'med': np.zeros(len(lower)),
+        'min': np.zeros(len(lower), dtype=values.dtype),
+        'max': np.zeros(len(lower), dtype=values.dtype)
+    }
+    items = values.tolist()
+    # Lower half as max-heap and upper half as min-heap, removed values are only dropped once they reach the top
+    low = []
+    high = []
+    in_low = {}
+    removed = set()
+    sizes = {'low': 0, 'high': 0}
+    # Indices of candidates for the minimum and maximum, their values increasing and decreasing respectively
+    minimum = deque()
+    maximum = deque()
+
+    def prune(heap):
+        while heap and heap[0][1] in removed:
+            removed.discard(heappop(heap)[1])
+
+    def balance():
+        if sizes['low'] > sizes['high'] + 1:
+            prune(low)
+            value, i = heappop(low)
+            heappush(high, (-value, i))
+            in_low[i] = False
+            sizes['low'] -= 1
+            sizes['high'] += 1
+        elif sizes['high'] > sizes['low']:
+            prune(high)
+            value, i = heappop(high)
+            heappush(low, (-value, i))
+            in_low[i] = True
+            sizes['high'] -= 1
+            sizes['low'] += 1
+
+    def add(i):
+        value = items[i]
+        if 'med' in statistics:
+            prune(low)
+            in_low[i] = not low or value <= -low[0][0]
+            if in_low[i]:
+                heappush(low, (-value, i))
+                sizes['low'] += 1
+            else:
+                heappush(high, (value, i))
+                sizes['high'] += 1
+            balance()
+        while minimum and items[minimum[-1]] >= value:
+            minimum.pop()
+        minimum.append(i)
+        while maximum and items[maximum[-1]] <= value:
+            maximum.pop()
+        maximum.append(i)
+
+    def remove(i):
+        if 'med' in statistics:
+            removed.add(i)
+            sizes['low' if in_low.pop(i) else 'high'] -= 1
+            balance()
+        while minimum and minimum[0] <= i:
+            minimum.popleft()
+        while maximum and maximum[0] <= i:
+            maximum.popleft()
+
+    first = 0
+    last = 0
+    for k, (window_first, window_last) in enumerate(zip(lower.tolist(), upper.tolist())):
+        if window_first < first or window_last < last or window_first > last:
+            for structure in [low, high, in_low, removed, minimum, maximum]:
+                structure.clear()
+            sizes['low'] = sizes['high'] = 0
+            first = last = window_first
+        while last < window_last:
+            add(last)
+            last += 1
+        while first < window_first:
+            remove(first)
+            first += 1
+        if first == last:
+            continue
+        if 'med' in statistics:
+            prune(low)
+            prune(high)
+            result['med'][k] = -low[0][0] if sizes['low'] > sizes['high'] else (high[0][0] - low[0][0]) / 2
+        result['min'][k] = items[minimum[0]]
+        result['max'][k] = items[maximum[0]]
+    return {name: result[name] for name in statistics}
+
+
+def get_planned_features(plan: Dict, get_count: Callable[[str], np.ndarray],
+                         get_statistics: Callable[[Dict, List[str]], Dict[str, np.ndarray]]) -> Dict:
+    """
+    Calculate the planned features of all chunks in the structure of a chunk.
+    :param plan: Plan as returned by features.plan_features
+    :param get_count: Function to count the events of an event type in each chunk
+    :param get_statistics: Function to calculate statistics of a measure in each chunk
+    :return: Dict of features in the structure of a chunk, with an array per statistic
+    """
+    features = {}
+    for event in EVENTS:
+        event_features = {}
+        for measure, statistics in plan['measures']:
+            if measure['event'] == event:
+                event_features[measure['key']] = get_statistics(measure, statistics)
+        if event in plan['counts']:
+            event_features['count'] = get_count(event)
+        if event_features:
+            features[event + 's'] = event_features
+    return features
+
+
+def get_chunk_features(fixations: Dict, saccades: Dict, fixation_ranges: Tuple[np.ndarray, np.ndarray],
+                       saccade_ranges: Tuple[np.ndarray, np.ndarray], features: List[str] = CHUNK_FEATURES,
+                       sliding=False) -> Dict:
+    """
+    Calculate the fixation and saccade features of all chunks.
+    :param fixations: Fixation columns, see features.plan_features for the columns needed
+    :param saccades: Saccade columns, see features.plan_features for the columns needed
+    :param fixation_ranges: Ranges of fixations in each chunk as returned by get_chunk_ranges
+    :param saccade_ranges: Ranges of saccades in each chunk as returned by get_chunk_ranges
+    :param features: Names of the features to calculate
+    :param sliding: Whether the chunks overlap, see get_sliding_statistics
+    :return: Dict of features in the structure of a chunk, with an array per statistic
+    """
+    columns = {'fixation': fixations, 'saccade': saccades}
+    ranges = {'fixation': fixation_ranges, 'saccade': saccade_ranges}
+    get_statistics = get_sliding_statistics if sliding else get_segment_statistics
+    return get_planned_features(
+        plan_features(features),
+        lambda event: ranges[event][1] - ranges[event][0],
+        lambda measure, statistics: get_statistics(measure['value'](columns[measure['event']]),
+                                                   *ranges[measure['event']], statistics=statistics)
+    )
+
+
+def get_index_features(index: Dict, chunk_starts: np.ndarray, chunk_ends: np.ndarray,
+                       features: List[str] = CHUNK_FEATURES, sliding=False) -> Dict:
+    """
+    Calculate the fixation and saccade features of all chunks from the per-second index, see get_chunk_features.
+    :param index: Per-second index as returned by preprocess.get_second_index
+    :param chunk_starts: Array of chunk starts as relative seconds
+    :param chunk_ends: Array of chunk ends as relative seconds
+    :param features: Names of the features to calculate
+    :param sliding: Whether the chunks overlap, see get_overlapping_order_statistics
+    :return: Dict of features in the structure of a chunk, with an array per statistic
+    """
+    return get_planned_features(
+        plan_features(features),
+        lambda event: index[event + '_count_prefix'][chunk_ends] - index[event + '_count_prefix'][chunk_starts],
+        lambda measure, statistics: get_window_statistics(index, measure['name'], measure['event'], chunk_starts,
+                                                          chunk_ends, statistics, sliding)
+    )
+
+
+def add_features_to_chunk(chunks: List, features: Dict) -> None:
+    """
+    Add the calculated features to each chunk in place.
+    :param chunks: List of chunks
+    :param features: Features of all chunks as returned by get_chunk_features
+    """
+    def to_lists(feature):
+        if isinstance(feature, dict):
+            return {name: to_lists(value) for name, value in feature.items()}
+        return feature.tolist()
+
+    def get_chunk_feature(feature, i):
+        if isinstance(feature, dict):
+            return {name: get_chunk_feature(value, i) for name, value in feature.items()}
+        return feature[i]
+
+    features = to_lists(features)
+    for i, chunk in enumerate(chunks):
+        chunk.update(get_chunk_feature(features, i))
+
+
+def get_chunk_starts(start: int, end: int, chunk_size: int, stride: Optional[int] = None) -> np.ndarray:
+    """
+    Get the starts of the chunks of a time segment, aligned to its end.
+    :param start: Start of the time segment
+    :param end: End of the time segment
+    :param chunk_size: Size of each chunk
+    :param stride: Distance between the starts of consecutive chunks, the chunk size if None
+    :return: Array of chunk starts, the last chunk ends at the end of the segment
+    """
+    stride = stride or chunk_size
+    count = max(0, (end - start - chunk_size) // stride + 1)
+    return np.arange(end - chunk_size - (count - 1) * stride, end - chunk_size + 1, stride, dtype=np.int64)
 
 
 def chunk2(start: int, end: int, chunk_size: int, interruption: bool) -> List[Dict]:
@@ -97,29 +436,31 @@ def chunk2(start: int, end: int, chunk_size: int, interruption: bool) -> List[Di
     :param interruption: Flag whether the last segment ends with an interruption
     :return: List of chunks with start, end, and interruption flag
     """
-    if end - start < chunk_size:
-        return []
-    return chunk2(start, end - chunk_size, chunk_size, False) + [{
-        'start': end - chunk_size,
-        'end': end,
-        'interruption': interruption
-    }]
+    starts = get_chunk_starts(start, end, chunk_size).tolist()
+    return [{
+        'start': chunk_start,
+        'end': chunk_start + chunk_size,
+        'interruption': interruption and chunk_start + chunk_size == end
+    } for chunk_start in starts]
 
 
-def chunk_session(length: int, chunk_size: int, ignored: List[Dict], interruptions: List[Dict]) -> List:
+def chunk_session_arrays(length: int, chunk_size: int, ignored: List[Dict], interruptions: List[Dict],
+                         stride: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Chunk a reading into chunks of relevant time.
+    Chunk a reading into chunks of relevant time, like chunk_session.
     All times are seconds relative to the start.
     :param length: Length of reading in seconds
     :param chunk_size: Chunk size in seconds
     :param ignored: List of ignored segments with start and end as seconds
     :param interruptions: List of interruption events with timestamp as seconds
-    :return: List of chunks with start, end, and interruption flag
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None,
+        smaller strides give overlapping chunks
+    :return: Arrays of chunk starts, chunk ends, and interruption flags
     """
     current = 0
     i = 0
     j = 0
-    chunks = []
+    segments = []
     while current < length:
         if i < len(ignored) and j < len(interruptions):
             next_event = min(ignored[i]['start'], interruptions[j]['timestamp'])
@@ -131,70 +472,585 @@ def chunk_session(length: int, chunk_size: int, ignored: List[Dict], interruptio
             next_event = interruptions[j]['timestamp']
             is_interruption = True
         else:
-            chunks.extend(chunk2(current, length, chunk_size, False))
+            segments.append((get_chunk_starts(current, length, chunk_size, stride), False))
             break
         if current < next_event:
-            chunks.extend(chunk2(current, next_event, chunk_size, is_interruption))
+            segments.append((get_chunk_starts(current, next_event, chunk_size, stride), is_interruption))
         if is_interruption:
             current = next_event
             j += 1
         else:
             current = ignored[i]['end']
             i += 1
+    starts = np.concatenate([np.empty(0, dtype=np.int64)] + [segment_starts for segment_starts, _ in segments])
+    # Only the last chunk of a segment that ends with an interruption is flagged
+    counts = [len(segment_starts) for segment_starts, _ in segments]
+    last_indices = np.cumsum(counts, dtype=np.int64) - 1
+    flagged = np.array([count > 0 and interruption for count, (_, interruption) in zip(counts, segments)], dtype=bool)
+    flags = np.zeros(len(starts), dtype=bool)
+    flags[last_indices[flagged]] = True
+    return starts, starts + chunk_size, flags
+
+
+def chunk_session(length: int, chunk_size: int, ignored: List[Dict], interruptions: List[Dict],
+                  stride: Optional[int] = None) -> List:
+    """
+    Chunk a reading into chunks of relevant time.
+    All times are seconds relative to the start.
+    :param length: Length of reading in seconds
+    :param chunk_size: Chunk size in seconds
+    :param ignored: List of ignored segments with start and end as seconds
+    :param interruptions: List of interruption events with timestamp as seconds
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: List of chunks with start, end, and interruption flag
+    """
+    starts, ends, flags = chunk_session_arrays(length, chunk_size, ignored, interruptions, stride)
+    return [{
+        'start': start,
+        'end': end,
+        'interruption': interruption
+    } for start, end, interruption in zip(starts.tolist(), ends.tolist(), flags.tolist())]
+
+
+def prepare_session(session: Dict, features: List[str] = CHUNK_FEATURES) -> Dict:
+    """
+    Prepare a combined session for chunking with any chunk size.
+    Fixations and saccades can be lists of events or columns, e.g. from preprocess.get_saccade_columns.
+    :param session: Combined session with fixations, saccades, ignored times, and interruptions
+    :param features: Names of the features to calculate
+    :return: Dict with fixation and saccade columns, the middle of each event as relative seconds,
+        the length of the session in seconds, ignored times, interruptions, and the features to calculate
+    """
+    columns = plan_features(features)['columns']
+    fixations = get_event_columns(session['fixations'], columns['fixation'])
+    saccades = get_event_columns(session['saccades'], columns['saccade'])
+    start, end = int(fixations['start'][0]), int(fixations['end'][-1])
+    return {
+        'fixations': fixations,
+        'saccades': saccades,
+        'fixation_seconds': get_relative_seconds_array(fixations, start),
+        'saccade_seconds': get_relative_seconds_array(saccades, start),
+        'length': int(ceil((end - start) / 1000)),
+        'ignored': session['ignored'],
+        'interruptions': session['interruptions'],
+        'features': features
+    }
+
+
+def prepare_index(session_name: str, features: List[str] = CHUNK_FEATURES) -> Dict:
+    """
+    Prepare a session for chunking with any chunk size from its per-second index instead of its events.
+    :param session_name: Name of the session
+    :param features: Names of the features to calculate
+    :return: Dict with the per-second index, the length of the session in seconds, ignored times, interruptions,
+        and the features to calculate
+    """
+    prepared = read_combined_times(session_name)
+    prepared['index'] = read_second_index(session_name)
+    prepared['length'] = len(prepared['index']['fixation_count_prefix']) - 1
+    prepared['features'] = features
+    return prepared
+
+
+def featurize_prepared(prepared: Dict, chunk_size: int, stride: Optional[int] = None) -> List[Dict]:
+    """
+    Chunk and calculate the features for a prepared session.
+    :param prepared: Session as returned by prepare_session or prepare_index
+    :param chunk_size: Size of each chunk in seconds
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: List of chunks with fixation and saccade features
+    """
+    chunk_starts, chunk_ends, interruptions = chunk_session_arrays(prepared['length'], chunk_size,
+                                                                   prepared['ignored'], prepared['interruptions'],
+                                                                   stride)
+    chunks = [{
+        'start': chunk_start,
+        'end': chunk_end,
+        'interruption': interruption
+    } for chunk_start, chunk_end, interruption in zip(chunk_starts.tolist(), chunk_ends.tolist(),
+                                                      interruptions.tolist())]
+    add_features_to_chunk(chunks, get_prepared_features(prepared, chunk_starts, chunk_ends,
+                                                        stride is not None and stride < chunk_size))
     return chunks
 
 
-def featurize(session_name: str, chunk_size: int, save=False) -> List[Dict]:
+def get_prepared_features(prepared: Dict, chunk_starts: np.ndarray, chunk_ends: np.ndarray, sliding=False) -> Dict:
+    """
+    Calculate the fixation and saccade features of chunks of a prepared session.
+    :param prepared: Session as returned by prepare_session or prepare_index
+    :param chunk_starts: Array of chunk starts as relative seconds
+    :param chunk_ends: Array of chunk ends as relative seconds
+    :param sliding: Whether the chunks overlap, so their statistics are calculated while sliding over the events
+    :return: Dict of features in the structure of a chunk, with an array per statistic
+    """
+    if 'index' in prepared:
+        return get_index_features(prepared['index'], chunk_starts, chunk_ends, prepared['features'], sliding)
+    return get_chunk_features(
+        prepared['fixations'],
+        prepared['saccades'],
+        get_chunk_ranges(prepared['fixation_seconds'], chunk_starts, chunk_ends),
+        get_chunk_ranges(prepared['saccade_seconds'], chunk_starts, chunk_ends),
+        prepared['features'],
+        sliding
+    )
+
+
+def featurize_changes(prepared: Dict, chunk_size: int, chunks: List[Dict]) -> Tuple[List[Dict], Dict]:
+    """
+    Chunk a prepared session again after its ignored times changed, reusing the features of unchanged chunks.
+    The features of a chunk only depend on its start and end, and chunks only move in the reading segments
+    between ignored times and interruptions that changed, so only the chunks of these segments are calculated.
+    The chunks before the change have to have the features of the prepared session.
+    :param prepared: Session with the new ignored times as returned by prepare_session or prepare_index
+    :param chunk_size: Size of each chunk in seconds
+    :param chunks: List of chunks with fixation and saccade features before the change
+    :return: List of chunks with fixation and saccade features, and a dict with the number of kept,
+        calculated, relabeled, and removed chunks, and the number of changed chunks in total
+    """
+    chunk_starts, chunk_ends, interruptions = chunk_session_arrays(prepared['length'], chunk_size,
+                                                                   prepared['ignored'], prepared['interruptions'])
+    previous_chunks = {(chunk['start'], chunk['end']): chunk for chunk in chunks}
+    changes = {
+        'kept': 0,
+        'calculated': 0,
+        'relabeled': 0,
+        'removed': 0
+    }
+    new_chunks = []
+    calculated = []
+    for i, (chunk_start, chunk_end, interruption) in enumerate(zip(chunk_starts.tolist(), chunk_ends.tolist(),
+                                                                  interruptions.tolist())):
+        previous_chunk = previous_chunks.pop((chunk_start, chunk_end), None)
+        if previous_chunk is None:
+            calculated.append(i)
+            new_chunks.append({
+                'start': chunk_start,
+                'end': chunk_end,
+                'interruption': interruption
+            })
+        else:
+            changes['kept' if previous_chunk['interruption'] == interruption else 'relabeled'] += 1
+            new_chunks.append(dict(previous_chunk, interruption=interruption))
+    if calculated:
+        calculated = np.array(calculated)
+        add_features_to_chunk([new_chunks[i] for i in calculated.tolist()],
+                              get_prepared_features(prepared, chunk_starts[calculated], chunk_ends[calculated]))
+    changes['calculated'] = len(calculated)
+    changes['removed'] = len(previous_chunks)
+    changes['changed'] = changes['calculated'] + changes['relabeled'] + changes['removed']
+    return new_chunks, changes
+
+
+def featurize_session(session: Dict, chunk_size: int, features: List[str] = CHUNK_FEATURES,
+                      stride: Optional[int] = None) -> List[Dict]:
+    """
+    Chunk and calculate the features for a given combined session.
+    Fixations and saccades can be lists of events or columns, e.g. from preprocess.get_saccade_columns.
+    :param session: Combined session with fixations, saccades, ignored times, and interruptions
+    :param chunk_size: Size of each chunk in seconds
+    :param features: Names of the features to calculate
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: List of chunks with fixation and saccade features
+    """
+    return featurize_prepared(prepare_session(session, features), chunk_size, stride)
+
+
+def get_chunk_file(session_name: str) -> str:
+    """
+    Get the path of the chunks of a session that are currently used.
+    :param session_name: Name of the session
+    :return: Path of the chunk file
+    """
+    return join(CHUNK_FOLDER, session_name + '.json')
+
+
+def get_chunk_parameters(chunk_size: int, use_index=False, features: List[str] = CHUNK_FEATURES,
+                         stride: Optional[int] = None) -> Dict:
+    """
+    Get the parameters that the chunks of a session were calculated with.
+    :param chunk_size: Size of each chunk in seconds
+    :param use_index: Whether the features are calculated from the per-second index instead of the events
+    :param features: Names of the features
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: Dict of the parameters
+    """
+    return {
+        'chunk_size': chunk_size,
+        'stride': stride or chunk_size,
+        'use_index': use_index,
+        'features': features,
+        'version': FEATURE_VERSION
+    }
+
+
+def get_chunk_parameters_file(session_name: str) -> str:
+    """
+    Get the path of the parameters of the chunks currently used of a session.
+    :param session_name: Name of the session
+    :return: Path of the parameters file
+    """
+    return join(CHUNK_PARAMETER_FOLDER, session_name + '.json')
+
+
+def read_chunk_parameters(session_name: str) -> Optional[Dict]:
+    """
+    Read the parameters of the chunks currently used of a session.
+    :param session_name: Name of the session
+    :return: Dict of the parameters, or None if they are unknown
+    """
+    try:
+        with open(get_chunk_parameters_file(session_name), encoding='utf8') as parameters_file:
+            return load(parameters_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def remove_chunk_parameters(session_name: str) -> None:
+    """
+    Remove the parameters of the chunks currently used of a session before its chunk file is replaced,
+    so the chunks are never paired with the parameters of other chunks.
+    :param session_name: Name of the session
+    """
+    try:
+        remove(get_chunk_parameters_file(session_name))
+    except FileNotFoundError:
+        pass
+
+
+def save_chunk_parameters(session_name: str, parameters: Dict) -> None:
+    """
+    Save the parameters of the chunks currently used of a session after its chunk file was replaced.
+    :param session_name: Name of the session
+    :param parameters: Parameters of the chunks as returned by get_chunk_parameters
+    """
+    try:
+        makedirs(CHUNK_PARAMETER_FOLDER)
+    except FileExistsError:
+        pass
+    parameters_file = get_chunk_parameters_file(session_name)
+    temporary_file = '{}.{}.tmp'.format(parameters_file, getpid())
+    with open(temporary_file, 'w') as target:
+        dump(parameters, target)
+    replace(temporary_file, parameters_file)
+
+
+def save_chunks(session_name: str, chunks: List[Dict], parameters: Dict) -> None:
+    """
+    Save the chunks of a session as the chunks currently used, with the parameters they were calculated with.
+    The file is written under a temporary name first, so readers never see a partial file.
+    :param session_name: Name of the session
+    :param chunks: List of chunks with fixation and saccade features
+    :param parameters: Parameters of the chunks as returned by get_chunk_parameters
+    """
+    try:
+        makedirs(CHUNK_FOLDER)
+    except FileExistsError:
+        pass
+    remove_chunk_parameters(session_name)
+    chunk_file = get_chunk_file(session_name)
+    temporary_file = '{}.{}.tmp'.format(chunk_file, getpid())
+    with open(temporary_file, 'w') as target:
+        dump(chunks, target, indent=2)
+    replace(temporary_file, chunk_file)
+    save_chunk_parameters(session_name, parameters)
+
+
+def get_feature_cache_file(session_name: str, chunk_size: int, ignored: List[Dict], use_index=False,
+                           features: List[str] = CHUNK_FEATURES, stride: Optional[int] = None) -> str:
+    """
+    Get the path of the cached chunks of a session.
+    :param session_name: Name of the session
+    :param chunk_size: Size of each chunk in seconds
+    :param ignored: List of ignored times of the session
+    :param use_index: Whether the features are calculated from the per-second index instead of the events
+    :param features: Names of the calculated features
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: Path of the cache file
+    """
+    version = '{}-{}-{}'.format(FEATURE_VERSION, 'index' if use_index else 'events', ','.join(sorted(set(features))))
+    if stride and stride != chunk_size:
+        version += '-{}'.format(stride)
+    return get_cache_file(session_name, chunk_size, ignored, version)
+
+
+def prepare(session_name: str, use_index=False, features: List[str] = CHUNK_FEATURES) -> Dict:
+    """
+    Read and prepare a session for chunking.
+    Only the columns of the combined results that are needed for the features are read.
+    :param session_name: Name of the session
+    :param use_index: Whether to use the per-second index instead of the events
+    :param features: Names of the features to calculate
+    :return: Prepared session
+    """
+    if use_index:
+        return prepare_index(session_name, features)
+    columns = plan_features(features)['columns']
+    return prepare_session(read_combined(session_name, columns['fixation'], columns['saccade']), features)
+
+
+def featurize(session_name: str, chunk_size: int, save=False, use_index=False,
+              features: List[str] = CHUNK_FEATURES, stride: Optional[int] = None) -> List[Dict]:
     """
     Chunk and calculate the features for a given session.
-    :param session_name: File name of the session
+    :param session_name: Name of the session
     :param chunk_size: Size of each chunk in seconds
+    :param save: Whether to save the chunks as the chunks currently used
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param features: Names of the features to calculate
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
     :return: List of chunks with fixation and saccade features
     """
-    source_folder = join('data', 'combined')
-    with open(join(source_folder, session_name), encoding='utf8') as parsed_file:
-        session = load(parsed_file)
-    start, end = session['fixations'][0]['start'], session['fixations'][-1]['end']
-    length = int(ceil((end - start) / 1000))
-    chunks = chunk_session(length, chunk_size, session['ignored'], session['interruptions'])
-    bin_events_to_chunks(session['fixations'], start, chunks, 'fixations')
-    bin_events_to_chunks(session['saccades'], start, chunks, 'saccades')
-    add_features_to_chunk(chunks)
+    chunks = featurize_prepared(prepare(session_name, use_index, features), chunk_size, stride)
     if save:
+        save_chunks(session_name, chunks, get_chunk_parameters(chunk_size, use_index, features, stride))
+    return chunks
+
+
+def update_chunks(session_name: str, chunk_size: int, use_index=False, cache_size: int = CACHE_SIZE,
+                  features: List[str] = CHUNK_FEATURES, stride: Optional[int] = None) -> bool:
+    """
+    Save the chunks of a session with a chunk size as the chunks currently used.
+    The chunks are taken from the feature cache if possible, otherwise they are calculated and cached.
+    :param session_name: Name of the session
+    :param chunk_size: Size of each chunk in seconds
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param cache_size: Maximum size of the feature cache in bytes
+    :param features: Names of the features to calculate
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: Whether the chunks were found in the cache
+    """
+    cache_file = get_feature_cache_file(session_name, chunk_size, read_combined_times(session_name)['ignored'],
+                                        use_index, features, stride)
+    if read_cache(cache_file):
         try:
-            makedirs(join('data', 'chunks'))
+            makedirs(CHUNK_FOLDER)
         except FileExistsError:
             pass
-        with open(join('data', 'chunks', session_name), 'w') as target:
-            dump(chunks, target, indent=2)
-    return chunks
+        remove_chunk_parameters(session_name)
+        chunk_file = get_chunk_file(session_name)
+        temporary_file = '{}.{}.tmp'.format(chunk_file, getpid())
+        try:
+            copyfile(cache_file, temporary_file)
+            replace(temporary_file, chunk_file)
+            save_chunk_parameters(session_name, get_chunk_parameters(chunk_size, use_index, features, stride))
+            return True
+        except FileNotFoundError:
+            pass  # evicted in the meantime
+    write_cache(cache_file, featurize(session_name, chunk_size, True, use_index, features, stride), cache_size)
+    return False
+
+
+def refeaturize(session_name: str, chunk_size: int, previous_ignored: List[Dict], use_index=False,
+                cache_size: int = CACHE_SIZE, features: List[str] = CHUNK_FEATURES) -> Dict:
+    """
+    Update the chunks currently used of a session after its ignored times changed, see featurize_changes.
+    The chunks currently used are only reused if they were calculated with the same parameters,
+    and they have to have the previous ignored times, otherwise all chunks are calculated again.
+    :param session_name: Name of the session
+    :param chunk_size: Size of each chunk in seconds
+    :param previous_ignored: List of ignored times of the session before the change
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param cache_size: Maximum size of the feature cache in bytes
+    :param features: Names of the features to calculate
+    :return: Dict with the number of kept, calculated, relabeled, removed, and changed chunks
+    """
+    parameters = get_chunk_parameters(chunk_size, use_index, features)
+    chunks = []
+    if read_chunk_parameters(session_name) == parameters:
+        try:
+            with open(get_chunk_file(session_name), encoding='utf8') as chunk_file:
+                chunks = load(chunk_file)
+        except FileNotFoundError:
+            pass
+    prepared = prepare(session_name, use_index, features)
+    if previous_ignored == prepared['ignored'] and chunks:
+        return {
+            'kept': len(chunks),
+            'calculated': 0,
+            'relabeled': 0,
+            'removed': 0,
+            'changed': 0
+        }
+    chunks, changes = featurize_changes(prepared, chunk_size, chunks)
+    save_chunks(session_name, chunks, parameters)
+    write_cache(get_feature_cache_file(session_name, chunk_size, prepared['ignored'], use_index, features), chunks,
+                cache_size)
+    return changes
+
 
+def featurize_sweep(session_name: str, chunk_sizes: List[int], cache=False, use_index=False,
+                    cache_size: int = CACHE_SIZE, features: List[str] = CHUNK_FEATURES,
+                    stride: Optional[int] = None) -> Dict[int, List[Dict]]:
+    """
+    Chunk and calculate the features for a given session with multiple chunk sizes.
+    The session is read and prepared only once.
+    :param session_name: Name of the session
+    :param chunk_sizes: List of chunk sizes in seconds
+    :param cache: Whether to add the chunks of each chunk size to the feature cache
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param cache_size: Maximum size of the feature cache in bytes
+    :param features: Names of the features to calculate
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: Dict of chunk size to list of chunks with fixation and saccade features
+    """
+    prepared = prepare(session_name, use_index, features)
+    results = {}
+    for chunk_size in chunk_sizes:
+        results[chunk_size] = featurize_prepared(prepared, chunk_size, stride)
+        if cache:
+            write_cache(get_feature_cache_file(session_name, chunk_size, prepared['ignored'], use_index, features,
+                                               stride), results[chunk_size], cache_size)
+    return results
+
+
+def update_chunks_task(task: Tuple[str, int, bool, int, List[str], Optional[int]]) -> Dict:
+    """
+    Update the chunks of a single session and report the outcome instead of raising, see update_chunks.
+    Used by the worker processes, so only this small status record is sent back.
+    :param task: Tuple of the arguments of update_chunks
+    :return: Status with session name, whether the chunks were cached, duration in seconds, and error message or None
+    """
+    session_name = task[0]
+    start = time()
+    cached = False
+    error = None
+    try:
+        cached = update_chunks(*task)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'session': session_name,
+        'cached': cached,
+        'duration': time() - start,
+        'error': error
+    }
 
-def featurize_all(chunk_size: int) -> None:
+
+def featurize_sweep_task(task: Tuple[str, List[int], bool, int, List[str], Optional[int]]) -> Dict:
+    """
+    Add the chunks of a single session with multiple chunk sizes to the feature cache and report the outcome
+    instead of raising, see featurize_sweep.
+    Used by the worker processes, so only this small status record is sent back.
+    :param task: Tuple of session name, chunk sizes, whether to use the per-second index, cache size, features,
+        and stride
+    :return: Status with session name, duration in seconds, and error message or None
     """
-    Featurize all sessions and save the results as files.
+    session_name, chunk_sizes, use_index, cache_size, features, stride = task
+    start = time()
+    error = None
+    try:
+        featurize_sweep(session_name, chunk_sizes, True, use_index, cache_size, features, stride)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'session': session_name,
+        'duration': time() - start,
+        'error': error
+    }
+
+
+def featurize_all(chunk_size: int, use_index=False, cache_size: int = CACHE_SIZE, workers: int = cpu_count(),
+                  stride: Optional[int] = None) -> List[Dict]:
+    """
+    Featurize all sessions and save the results as files, using the feature cache if possible.
+    Sessions are distributed to worker processes, each writing its own chunks, and reported as they finish.
     :param chunk_size: Size of each chunk in seconds
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param cache_size: Maximum size of the feature cache in bytes
+    :param workers: Number of worker processes
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: List of status records of the sessions that failed
     """
-    source_folder = join('data', 'combined')
-    source_files = [f for f in listdir(source_folder) if isfile(join(source_folder, f))]
-    pool = Pool(4)
-    results = pool.starmap(featurize, [(filename, chunk_size) for filename in source_files])
+    session_names = list_combined()
+    failed = []
+    hits = 0
+    pool = Pool(workers)
+    for i, status in enumerate(pool.imap_unordered(update_chunks_task, [
+        (session_name, chunk_size, use_index, cache_size, CHUNK_FEATURES, stride) for session_name in session_names
+    ]), 1):
+        progress = '{}/{} {} - '.format(i, len(session_names), status['session'])
+        if status['error']:
+            failed.append(status)
+            print(progress + 'failed - ' + status['error'])
+        else:
+            hits += status['cached']
+            print(progress + ('cached' if status['cached'] else 'done') + ' ({:.2f}s)'.format(status['duration']))
     pool.close()
     pool.join()
 
-    try:
-        makedirs(join('data', 'chunks'))
-    except FileExistsError:
-        pass
-    for i, filename in enumerate(source_files):
-        print(filename)
-        with open(join('data', 'chunks', filename), 'w') as target:
-            dump(results[i], target, indent=2)
+    stats = get_cache_stats(hits, len(session_names) - len(failed) - hits)
+    print('cache: {} hits, {} misses, {} files ({:.1f} MB)'.format(stats['hits'], stats['misses'], stats['files'],
+                                                                  stats['size'] / 1024 / 1024))
+    return failed
 
 
-def main() -> None:
-    featurize_all(5)
+def featurize_sweep_all(chunk_sizes: List[int], use_index=False, cache_size: int = CACHE_SIZE,
+                        workers: int = cpu_count(), stride: Optional[int] = None) -> List[Dict]:
+    """
+    Featurize all sessions with multiple chunk sizes and add the results to the feature cache.
+    :param chunk_sizes: List of chunk sizes in seconds
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param cache_size: Maximum size of the feature cache in bytes
+    :param workers: Number of worker processes
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: List of status records of the sessions that failed
+    """
+    session_names = list_combined()
+    failed = []
+    pool = Pool(workers)
+    for i, status in enumerate(pool.imap_unordered(featurize_sweep_task, [
+        (session_name, chunk_sizes, use_index, cache_size, CHUNK_FEATURES, stride) for session_name in session_names
+    ]), 1):
+        progress = '{}/{} {} - '.format(i, len(session_names), status['session'])
+        if status['error']:
+            failed.append(status)
+            print(progress + 'failed - ' + status['error'])
+        else:
+            print(progress + ', '.join(str(chunk_size) for chunk_size in chunk_sizes) +
+                  ' ({:.2f}s)'.format(status['duration']))
+    pool.close()
+    pool.join()
+    return failed
+
+
+def main(chunk_size: int = 5, sweep: Optional[List[int]] = None, use_index=False,
+         cache_size: int = CACHE_SIZE, workers: int = cpu_count(), stride: Optional[int] = None) -> List[Dict]:
+    """
+    Featurize all sessions with a chunk size, and optionally add more chunk sizes to the feature cache.
+    :param chunk_size: Size of each chunk in seconds of the chunks used
+    :param sweep: List of chunk sizes in seconds to add to the feature cache
+    :param use_index: Whether to calculate the features from the per-second index instead of the events
+    :param cache_size: Maximum size of the feature cache in bytes
+    :param workers: Number of worker processes
+    :param stride: Distance between the starts of consecutive chunks in seconds, the chunk size if None
+    :return: List of status records of the sessions that failed
+    """
+    failed = featurize_all(chunk_size, use_index, cache_size, workers, stride)
+    # The chunks of the chunk size used are already in the cache
+    sweep = [sweep_size for sweep_size in sweep or [] if sweep_size != chunk_size]
+    if sweep:
+        failed.extend(featurize_sweep_all(sweep, use_index, cache_size, workers, stride))
+    for status in failed:
+        print('failed - ' + status['session'] + ' - ' + status['error'])
+    return failed
 
 
 if __name__ == '__main__':
-    main()
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Chunk and featurize the combined sessions.')
+    parser.add_argument('--chunk-size', type=int, default=5, help='chunk size in seconds of the chunks used')
+    parser.add_argument('--sweep', type=int, nargs='+', metavar='CHUNK_SIZE',
+                        help='also add the chunks for these chunk sizes to the feature cache')
+    parser.add_argument('--index', action='store_true',
+                        help='calculate the features from the per-second index instead of the events')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE // 1024 // 1024,
+                        help='maximum size of the feature cache in MB')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of worker processes')
+    parser.add_argument('--stride', type=int,
+                        help='distance between the starts of consecutive chunks in seconds (default: chunk size), '
+                             'smaller strides give overlapping chunks')
+    arguments = parser.parse_args()
+    if main(arguments.chunk_size, arguments.sweep, arguments.index, arguments.cache_size * 1024 * 1024,
+            arguments.workers, arguments.stride):
+        exit(1)
@@ -1,6 +1,44 @@
 import unittest
+from json import load
+from os import chdir, getcwd
+from statistics import mean, median, variance
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+from unittest.mock import patch
 
-from chunk import bin_events_to_chunks, chunk_session, chunk2, get_relative_seconds
+import numpy as np
+
+from cache import CACHE_SIZE
+from features import CHUNK_FEATURES, MODEL_FEATURES, UI_FEATURES, get_feature_vector
+from preprocess import get_second_index
+from chunk import bin_events_to_chunks, chunk_session, chunk_session_arrays, chunk2, featurize_session, \
+    featurize_changes, featurize_prepared, get_chunk_ranges, get_chunk_starts, get_relative_seconds, \
+    get_relative_seconds_array, get_order_statistics, get_prepared_features, get_running_order_statistics, \
+    get_chunk_file, get_chunk_parameters, get_segment_statistics, get_sliding_statistics, main, prepare_session, \
+    read_chunk_parameters, refeaturize, save_chunks
+
+
+def get_session(end: int, ignored: List[Dict], interruptions: List[Dict]) -> Dict:
+    # Synthetic session with a fixation every 400 ms until end and a saccade between consecutive fixations
+    fixations = [{
+        'start': start,
+        'end': start + 200 + start % 300
+    } for start in range(0, end, 400)]
+    return {
+        'fixations': fixations,
+        'saccades': [{
+            'start': fixation['end'],
+            'end': next_fixation['start'],
+            'length': float(i % 11),
+            'angle': float(i % 5)
+        } for i, (fixation, next_fixation) in enumerate(zip(fixations, fixations[1:]))],
+        'ignored': ignored,
+        'interruptions': interruptions
+    }
+
+
+def get_columns(events: List[Dict]) -> Dict[str, np.ndarray]:
+    return {name: np.array([event[name] for event in events]) for name in events[0]}
 
 
 class RelativeSecondsTestCase(unittest.TestCase):
@@ -140,6 +178,206 @@ class Chunk2TestCase(unittest.TestCase):
             'interruption': True
         }], chunk2(0, 11, 5, True))
 
+    def test_long(self) -> None:
+        chunks = chunk2(0, 4 * 3600, 1, True)
+        self.assertEqual(4 * 3600, len(chunks))
+        self.assertEqual({'start': 0, 'end': 1, 'interruption': False}, chunks[0])
+        self.assertEqual({'start': 4 * 3600 - 1, 'end': 4 * 3600, 'interruption': True}, chunks[-1])
+
+
+class ChunkStartsTestCase(unittest.TestCase):
+    def test_aligned_to_end(self) -> None:
+        self.assertEqual([3, 8, 13], get_chunk_starts(1, 18, 5).tolist())
+
+    def test_stride(self) -> None:
+        self.assertEqual([0, 2, 4, 6], get_chunk_starts(0, 10, 4, 2).tolist())
+        self.assertEqual([2, 4, 6], get_chunk_starts(1, 10, 4, 2).tolist())
+        self.assertEqual(get_chunk_starts(3, 20, 5).tolist(), get_chunk_starts(3, 20, 5, 5).tolist())
+        self.assertEqual([], get_chunk_starts(0, 3, 4, 1).tolist())
+
+    def test_empty(self) -> None:
+        self.assertEqual([], get_chunk_starts(5, 4, 5).tolist())
+
+
+class ChunkRangesTestCase(unittest.TestCase):
+    def test_same_as_relative_seconds(self) -> None:
+        events = [{
+            'start': start,
+            'end': start + 200
+        } for start in range(0, 20000, 700)]
+        chunks = chunk_session(20, 5, [{'start': 6, 'end': 9}], [])
+        seconds = get_relative_seconds_array({
+            'start': np.array([event['start'] for event in events]),
+            'end': np.array([event['end'] for event in events])
+        }, 500)
+        self.assertEqual([get_relative_seconds(event, 500) for event in events], seconds.tolist())
+        lower, upper = get_chunk_ranges(seconds, np.array([chunk['start'] for chunk in chunks]),
+                                        np.array([chunk['end'] for chunk in chunks]))
+        for chunk, first, last in zip(chunks, lower, upper):
+            self.assertEqual([event for event in events
+                              if chunk['start'] <= get_relative_seconds(event, 500) < chunk['end']],
+                             events[first:last])
+
+    def test_no_events(self) -> None:
+        chunks = chunk_session(10, 5, [], [])
+        bin_events_to_chunks([], 0, chunks, 'events')
+        self.assertEqual([[], []], [chunk['events'] for chunk in chunks])
+
+
+class SegmentStatisticsTestCase(unittest.TestCase):
+    def test_same_as_statistics(self) -> None:
+        random = np.random.RandomState(0)
+        values = random.normal(100, 50, 1000)
+        lower = np.array([0, 5, 5, 6, 8, 100, 300, 301])
+        upper = np.array([5, 5, 6, 8, 100, 300, 301, 1000])
+        result = get_segment_statistics(values, lower, upper)
+        for i, (first, last) in enumerate(zip(lower, upper)):
+            segment = values[first:last].tolist()
+            expected = {
+                'avg': mean(segment) if len(segment) else 0,
+                'med': median(segment) if len(segment) else 0,
+                'min': min(segment) if len(segment) else 0,
+                'max': max(segment) if len(segment) else 0,
+                'var': variance(segment) if len(segment) > 1 else 0
+            }
+            for name, value in expected.items():
+                self.assertAlmostEqual(value, result[name][i], places=9)
+
+    def test_running(self) -> None:
+        random = np.random.RandomState(1)
+        for values in [random.normal(100, 50, 500), random.randint(0, 20, 500)]:
+            lower = np.concatenate([np.sort(random.randint(0, 500, 100)), [10, 10, 480]])
+            upper = np.concatenate([np.maximum.accumulate(np.minimum(lower[:100] + random.randint(0, 40, 100), 500)),
+                                    [30, 10, 500]])
+            expected = get_order_statistics(values, lower, upper)
+            result = get_running_order_statistics(values, lower, upper)
+            for name in ['med', 'min', 'max']:
+                self.assertEqual(expected[name].tolist(), result[name].tolist())
+            expected = get_segment_statistics(values, lower, upper)
+            result = get_sliding_statistics(values, lower, upper)
+            for name in expected:
+                np.testing.assert_allclose(expected[name], result[name], atol=1e-9)
+
+    def test_integers(self) -> None:
+        result = get_segment_statistics(np.array([3, 1, 2, 10]), np.array([0, 3]), np.array([3, 4]))
+        self.assertEqual([2.0, 10.0], result['avg'].tolist())
+        self.assertEqual([2.0, 10.0], result['med'].tolist())
+        self.assertEqual([1, 10], result['min'].tolist())
+        self.assertEqual([3, 10], result['max'].tolist())
+        self.assertEqual([1.0, 0.0], result['var'].tolist())
+
+
+class FeaturizeTestCase(unittest.TestCase):
+    def test_columns(self) -> None:
+        fixations = [{
+            'start': start,
+            'end': start + 200 + start % 300
+        } for start in range(0, 12000, 500)]
+        saccades = [{
+            'start': fixation['end'],
+            'end': next_fixation['start'],
+            'length': float(i),
+            'angle': float(i % 7)
+        } for i, (fixation, next_fixation) in enumerate(zip(fixations, fixations[1:]))]
+        session = {
+            'fixations': fixations,
+            'saccades': saccades,
+            'ignored': [],
+            'interruptions': [{'timestamp': 7}]
+        }
+        columns_session = dict(session, fixations=get_columns(fixations), saccades=get_columns(saccades))
+        chunks = featurize_session(session, 5)
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(chunks, featurize_session(columns_session, 5))
+
+    def test_prepared(self) -> None:
+        session = get_session(40000, [{'start': 10, 'end': 13}], [{'timestamp': 22}])
+        prepared = prepare_session(session)
+        for chunk_size in [1, 3, 5, 10]:
+            self.assertEqual(featurize_session(session, chunk_size), featurize_prepared(prepared, chunk_size))
+
+    def test_index(self) -> None:
+        session = get_session(120000, [{'start': 20, 'end': 31}], [{'timestamp': 50}, {'timestamp': 90}])
+        prepared = {
+            'index': get_second_index(get_columns(session['fixations']), get_columns(session['saccades'])),
+            'length': prepare_session(session)['length'],
+            'ignored': session['ignored'],
+            'interruptions': session['interruptions'],
+            'features': CHUNK_FEATURES
+        }
+        for chunk_size in [1, 2, 5, 10]:
+            chunks = featurize_session(session, chunk_size)
+            index_chunks = featurize_prepared(prepared, chunk_size)
+            self.assertEqual(len(chunks), len(index_chunks))
+            for chunk, index_chunk in zip(chunks, index_chunks):
+                self.assertEqual(chunk['interruption'], index_chunk['interruption'])
+                for event in ['fixations', 'saccades']:
+                    self.assertEqual(list(chunk[event]), list(index_chunk[event]))
+                    self.assertEqual(chunk[event].get('count'), index_chunk[event].get('count'))
+                    for measure in chunk[event]:
+                        if measure != 'count':
+                            for name, value in chunk[event][measure].items():
+                                self.assertAlmostEqual(value, index_chunk[event][measure][name], places=6)
+
+    def test_features(self) -> None:
+        session = get_session(30000, [{'start': 10, 'end': 13}], [{'timestamp': 22}])
+        chunks = featurize_session(session, 5)
+        model_chunks = featurize_session(session, 5, MODEL_FEATURES)
+        self.assertEqual([get_feature_vector(chunk, MODEL_FEATURES) for chunk in chunks],
+                         [get_feature_vector(chunk, MODEL_FEATURES) for chunk in model_chunks])
+        self.assertEqual(['duration', 'count'], list(model_chunks[0]['fixations']))
+        self.assertEqual(['avg', 'med', 'var'], list(model_chunks[0]['fixations']['duration']))
+        self.assertNotIn('count', model_chunks[0]['saccades'])
+        ui_chunks = featurize_session(session, 5, UI_FEATURES)
+        self.assertEqual(['avg', 'min', 'max'], list(ui_chunks[0]['saccades']['angle']))
+
+    def test_stride(self) -> None:
+        session = get_session(40000, [{'start': 10, 'end': 13}], [{'timestamp': 25}])
+        self.assertEqual(featurize_session(session, 5), featurize_session(session, 5, stride=5))
+        prepared = prepare_session(session)
+        with patch('chunk.RUNNING_OVERLAP', 0):
+            chunks = featurize_prepared(prepared, 6, 2)
+        # Windows are aligned to the end of each reading segment, only the last before the interruption is flagged
+        self.assertEqual([0, 2, 4, 13, 15, 17, 19, 26, 28, 30, 32, 34], [chunk['start'] for chunk in chunks])
+        self.assertEqual([25], [chunk['end'] for chunk in chunks if chunk['interruption']])
+        features = get_prepared_features(prepared, np.array([chunk['start'] for chunk in chunks]),
+                                         np.array([chunk['end'] for chunk in chunks]))
+        for i, chunk in enumerate(chunks):
+            self.assertEqual(features['fixations']['count'][i], chunk['fixations']['count'])
+            for event in ['fixations', 'saccades']:
+                for measure in chunk[event]:
+                    if measure != 'count':
+                        for name, value in chunk[event][measure].items():
+                            self.assertAlmostEqual(features[event][measure][name][i], value, places=9)
+
+    def test_changes(self) -> None:
+        session = get_session(60000, [{'start': 10, 'end': 13}], [{'timestamp': 22}, {'timestamp': 45}])
+        chunks = featurize_session(session, 5)
+        changed_session = dict(session, ignored=[{'start': 10, 'end': 13}, {'start': 31, 'end': 33}])
+        changed_chunks, changes = featurize_changes(prepare_session(changed_session), 5, chunks)
+        self.assertEqual(featurize_session(changed_session, 5), changed_chunks)
+        # Only the chunk from 22 to 31 is new, the chunks from 33 to 45 are still aligned to the interruption
+        self.assertEqual({'kept': 8, 'calculated': 1, 'relabeled': 0, 'removed': 2, 'changed': 3}, changes)
+
+        unchanged_chunks, changes = featurize_changes(prepare_session(session), 5, chunks)
+        self.assertEqual(chunks, unchanged_chunks)
+        self.assertEqual(0, changes['changed'])
+
+
+class ChunkArraysTestCase(unittest.TestCase):
+    def test_interruptions(self) -> None:
+        starts, ends, flags = chunk_session_arrays(20, 2, [{
+            'start': 10,
+            'end': 12
+        }], [{
+            'timestamp': 5
+        }, {
+            'timestamp': 6
+        }])
+        self.assertEqual([1, 3, 6, 8, 12, 14, 16, 18], starts.tolist())
+        self.assertEqual((starts + 2).tolist(), ends.tolist())
+        self.assertEqual([False, True, False, False, False, False, False, False], flags.tolist())
+
 
 class ChunkTestCase(unittest.TestCase):
     def test_exact_fit(self) -> None:
@@ -216,5 +454,63 @@ class ChunkTestCase(unittest.TestCase):
         }]))
 
 
+class RefeaturizeTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = getcwd()
+        self.directory = TemporaryDirectory()
+        chdir(self.directory.name)
+        self.session = get_session(60000, [{'start': 10, 'end': 13}], [{'timestamp': 22}, {'timestamp': 45}])
+        self.changed_session = dict(self.session, ignored=[{'start': 10, 'end': 13}, {'start': 31, 'end': 33}])
+
+    def tearDown(self) -> None:
+        chdir(self.cwd)
+        self.directory.cleanup()
+
+    def refeaturize(self) -> dict:
+        with patch('chunk.prepare', side_effect=lambda _, use_index, features: prepare_session(
+                self.changed_session, features)):
+            return refeaturize('session', 5, self.session['ignored'])
+
+    def read_chunks(self) -> list:
+        with open(get_chunk_file('session'), encoding='utf8') as chunk_file:
+            return load(chunk_file)
+
+    def test_same_parameters(self) -> None:
+        save_chunks('session', featurize_session(self.session, 5), get_chunk_parameters(5))
+        changes = self.refeaturize()
+        self.assertEqual(8, changes['kept'])
+        self.assertEqual(featurize_session(self.changed_session, 5), self.read_chunks())
+
+    def test_extended(self) -> None:
+        # An edit that extends an existing segment changes the chunks it now covers
+        save_chunks('session', featurize_session(self.session, 5), get_chunk_parameters(5))
+        self.changed_session = dict(self.session, ignored=[{'start': 10, 'end': 22}])
+        changes = self.refeaturize()
+        self.assertGreater(changes['changed'], 0)
+        self.assertEqual(featurize_session(self.changed_session, 5), self.read_chunks())
+
+    def test_other_parameters(self) -> None:
+        # Chunks with other features are not mixed with the new ones
+        parameters = get_chunk_parameters(5, features=MODEL_FEATURES)
+        save_chunks('session', featurize_session(self.session, 5, MODEL_FEATURES), parameters)
+        changes = self.refeaturize()
+        self.assertEqual(0, changes['kept'])
+        self.assertEqual(featurize_session(self.changed_session, 5), self.read_chunks())
+        self.assertEqual(get_chunk_parameters(5), read_chunk_parameters('session'))
+
+
+class MainTestCase(unittest.TestCase):
+    def test_sweep(self) -> None:
+        with patch('chunk.featurize_all', return_value=[]) as featurize_all, \
+                patch('chunk.featurize_sweep_all', return_value=[]) as featurize_sweep_all:
+            main(5, [3, 5, 10], workers=1)
+            featurize_all.assert_called_once_with(5, False, CACHE_SIZE, 1, None)
+            # The chunk size used is not featurized again by the sweep
+            featurize_sweep_all.assert_called_once_with([3, 10], False, CACHE_SIZE, 1, None)
+            featurize_sweep_all.reset_mock()
+            main(5, [5], workers=1)
+            featurize_sweep_all.assert_not_called()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+from typing import Dict, List, Union
+
+EVENTS = ['fixation', 'saccade']
+STATISTICS = ['avg', 'med', 'min', 'max', 'var']
+ORDER_STATISTICS = ['med', 'min', 'max']  # statistics that need the values of a chunk sorted
+
+# Measures of the events, with the event columns they are calculated from
+MEASURES = [{
+    'name': 'fixation_duration',
+    'event': 'fixation',
+    'key': 'duration',
+    'columns': ['start', 'end'],
+    'value': lambda columns: columns['end'] - columns['start']
+}, {
+    'name': 'saccade_duration',
+    'event': 'saccade',
+    'key': 'duration',
+    'columns': ['start', 'end'],
+    'value': lambda columns: columns['end'] - columns['start']
+}, {
+    'name': 'saccade_length',
+    'event': 'saccade',
+    'key': 'length',
+    'columns': ['length'],
+    'value': lambda columns: columns['length']
+}, {
+    'name': 'saccade_angle',
+    'event': 'saccade',
+    'key': 'angle',
+    'columns': ['angle'],
+    'value': lambda columns: columns['angle']
+}]
+
+# Features of a chunk, either the number of events or a statistic of a measure
+FEATURES = [{
+    'name': event + '_count',
+    'event': event,
+    'measure': None,
+    'aggregation': 'count'
+} for event in EVENTS] + [{
+    'name': measure['name'] + '_' + statistic,
+    'event': measure['event'],
+    'measure': measure['name'],
+    'aggregation': statistic
+} for measure in MEASURES for statistic in STATISTICS]
+
+# Features used by predict.py, in the order of the columns of the feature matrix
+MODEL_FEATURES = [
+    'fixation_count',
+    'fixation_duration_avg',
+    'fixation_duration_med',
+    'fixation_duration_var',
+    'saccade_duration_avg',
+    'saccade_duration_med',
+    'saccade_duration_var',
+    'saccade_length_avg',
+    'saccade_length_med',
+    'saccade_length_var',
+    'saccade_angle_avg',
+    'saccade_angle_med',
+    'saccade_angle_var'
+]
+
+# Features shown by the prediction view of the client
+UI_FEATURES = ['fixation_count'] + [measure['name'] + '_' + statistic
+                                    for measure in MEASURES for statistic in ['avg', 'min', 'max']]
+
+# Features saved with the chunks
+CHUNK_FEATURES = [feature['name'] for feature in FEATURES if feature['name'] in MODEL_FEATURES + UI_FEATURES]
+
+
+def get_feature(name: str) -> Dict:
+    """
+    Get a feature of the registry.
+    :param name: Name of the feature
+    :return: Feature with name, event type, measure name or None, and aggregation
+    """
+    for feature in FEATURES:
+        if feature['name'] == name:
+            return feature
+    raise ValueError('Unknown feature: ' + name)
+
+
+def get_measure(name: str) -> Dict:
+    """
+    Get a measure of the registry.
+    :param name: Name of the measure
+    :return: Measure with name, event type, key in a chunk, columns, and value function
+    """
+    for measure in MEASURES:
+        if measure['name'] == name:
+            return measure
+    raise ValueError('Unknown measure: ' + name)
+
+
+def plan_features(names: List[str]) -> Dict:
+    """
+    Plan which counts, statistics, and columns have to be calculated or read for some features.
+    :param names: Names of the features
+    :return: Dict with the event types to count, a list of pairs of measure and statistics to calculate,
+        both in the order of the registry, and a dict of event type to the columns to read
+    """
+    features = [get_feature(name) for name in names]
+    counts = [event for event in EVENTS if any(feature['event'] == event and feature['measure'] is None
+                                               for feature in features)]
+    measures = []
+    for measure in MEASURES:
+        statistics = [statistic for statistic in STATISTICS
+                      if any(feature['measure'] == measure['name'] and feature['aggregation'] == statistic
+                             for feature in features)]
+        if statistics:
+            measures.append((measure, statistics))
+    columns = {}
+    for event in EVENTS:
+        # Start and end are needed to bin the events into chunks
+        columns[event] = ['start', 'end']
+        for measure, _ in measures:
+            if measure['event'] == event:
+                columns[event].extend(column for column in measure['columns'] if column not in columns[event])
+    return {
+        'counts': counts,
+        'measures': measures,
+        'columns': columns
+    }
+
+
+def get_feature_value(chunk: Dict, name: str) -> Union[int, float]:
+    """
+    Get the value of a feature of a chunk.
+    :param chunk: Chunk with fixation and saccade features
+    :param name: Name of the feature
+    :return: Value of the feature
+    """
+    feature = get_feature(name)
+    if feature['measure'] is None:
+        return chunk[feature['event'] + 's']['count']
+    return chunk[feature['event'] + 's'][get_measure(feature['measure'])['key']][feature['aggregation']]
+
+
+def get_feature_vector(chunk: Dict, names: List[str]) -> List[Union[int, float]]:
+    """
+    Get the values of some features of a chunk.
+    :param chunk: Chunk with fixation and saccade features
+    :param names: Names of the features
+    :return: List of the values of the features in the given order
+    """
+    return [get_feature_value(chunk, name) for name in names]
@@ -0,0 +1,48 @@
+import unittest
+
+from features import CHUNK_FEATURES, FEATURES, MODEL_FEATURES, UI_FEATURES, get_feature_vector, plan_features
+
+
+class PlanTestCase(unittest.TestCase):
+    def test_count(self) -> None:
+        plan = plan_features(['fixation_count'])
+        self.assertEqual(['fixation'], plan['counts'])
+        self.assertEqual([], plan['measures'])
+        self.assertEqual({'fixation': ['start', 'end'], 'saccade': ['start', 'end']}, plan['columns'])
+
+    def test_statistics(self) -> None:
+        plan = plan_features(['saccade_length_var', 'fixation_duration_min', 'saccade_length_avg'])
+        self.assertEqual([], plan['counts'])
+        self.assertEqual([('fixation_duration', ['min']), ('saccade_length', ['avg', 'var'])],
+                         [(measure['name'], statistics) for measure, statistics in plan['measures']])
+        self.assertEqual(['start', 'end', 'length'], plan['columns']['saccade'])
+
+    def test_unknown(self) -> None:
+        with self.assertRaises(ValueError):
+            plan_features(['fixation_duration_mode'])
+
+    def test_chunk_features(self) -> None:
+        names = [feature['name'] for feature in FEATURES]
+        self.assertTrue(set(MODEL_FEATURES) <= set(CHUNK_FEATURES))
+        self.assertTrue(set(UI_FEATURES) <= set(CHUNK_FEATURES))
+        self.assertEqual(sorted(CHUNK_FEATURES, key=names.index), CHUNK_FEATURES)
+
+
+class FeatureVectorTestCase(unittest.TestCase):
+    def test_order(self) -> None:
+        chunk = {
+            'fixations': {
+                'duration': {'avg': 1.0, 'med': 2.0},
+                'count': 3
+            },
+            'saccades': {
+                'angle': {'var': 4.0}
+            }
+        }
+        self.assertEqual([4.0, 3, 2.0, 1.0],
+                         get_feature_vector(chunk, ['saccade_angle_var', 'fixation_count', 'fixation_duration_med',
+                                                    'fixation_duration_avg']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+from hashlib import md5
+from json import dump, dumps, load
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+from os import getpid, makedirs, remove, replace
+from os.path import join
+from shutil import rmtree
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from chunk import featurize_sweep, get_chunk_parameters
+from features import MODEL_FEATURES
+from predict import MODEL_PARAMETERS, WEIGHTINGS, fit_standardized, get_fold_weights, get_matrix, get_result, \
+    get_session_rows, get_summary, limit_blas_threads, read_matrix, save_matrix
+from preprocess import list_combined, read_combined_times, read_manifest
+
+GRID_FOLDER = join('data', 'grid')
+POINT_FOLDER = join(GRID_FOLDER, 'points')
+GRID_TABLE = join('data', 'grid.json')
+
+worker_matrices = {}
+
+
+def get_points(chunk_sizes: List[int], cs: List[float], weightings: List[str]) -> List[Dict]:
+    return [{
+        'chunk_size': chunk_size,
+        'C': c,
+        'weighting': weighting
+    } for chunk_size in chunk_sizes for c in cs for weighting in weightings]
+
+
+def get_matrix_folder(chunk_size: int) -> str:
+    return join(GRID_FOLDER, 'matrix', str(chunk_size))
+
+
+def get_input_fingerprint(chunk_size: int, use_index=False) -> str:
+    # The inputs of a matrix: the hash of the raw file of each session from the manifest, its ignored times and
+    # interruptions, which annotations change, and the parameters of the preprocessing and the chunks
+    manifest = read_manifest()
+    hashes = {entry['session']: entry['hash'] for entry in manifest['sessions'].values()}
+    sessions = [[session_name, hashes.get(session_name), read_combined_times(session_name)]
+                for session_name in list_combined()]
+    return md5(dumps([manifest['parameters'], get_chunk_parameters(chunk_size, use_index, MODEL_FEATURES), sessions],
+                     sort_keys=True).encode()).hexdigest()
+
+
+def get_matrix_inputs_file(chunk_size: int) -> str:
+    return join(get_matrix_folder(chunk_size), 'inputs.json')
+
+
+def read_matrix_inputs(chunk_size: int) -> Optional[str]:
+    # Input fingerprint of the matrix of an earlier run
+    try:
+        with open(get_matrix_inputs_file(chunk_size), encoding='utf8') as source:
+            return load(source)['fingerprint']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_matrix_inputs(chunk_size: int, fingerprint: str) -> None:
+    # Written after the matrix, so it only marks a matrix of all sessions
+    with open(get_matrix_inputs_file(chunk_size), 'w') as target:
+        dump({
+            'fingerprint': fingerprint
+        }, target)
+
+
+def get_point_file(point: Dict) -> str:
+    return join(POINT_FOLDER, '{}_{}_{}.json'.format(point['chunk_size'], point['C'], point['weighting']))
+
+
+def get_data_fingerprint(data: Dict) -> str:
+    # The sessions of a matrix and the hashes of their rows, together with the features and parameters of the model
+    return md5(dumps([MODEL_FEATURES, MODEL_PARAMETERS, data['names'], data['fingerprints']],
+                     sort_keys=True).encode()).hexdigest()
+
+
+def read_point(point: Dict, fingerprint: str) -> Optional[Dict]:
+    # Summary of a point finished by an earlier run on the same matrix
+    try:
+        with open(get_point_file(point), encoding='utf8') as source:
+            finished = load(source)
+        return finished['summary'] if finished['fingerprint'] == fingerprint else None
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_point(point: Dict, fingerprint: str, summary: Dict) -> None:
+    # Written atomically, so a crash never leaves a point that looks finished
+    try:
+        makedirs(POINT_FOLDER)
+    except FileExistsError:
+        pass
+    point_file = get_point_file(point)
+    temporary_file = '{}.{}.tmp'.format(point_file, getpid())
+    with open(temporary_file, 'w') as target:
+        dump({
+            'fingerprint': fingerprint,
+            'summary': summary
+        }, target, indent=2)
+    replace(temporary_file, point_file)
+
+
+def featurize_task(task: Tuple[str, List[int], bool]) -> Dict:
+    # A session is read and prepared once for all chunk sizes, only the rows of the feature matrix are sent back
+    session_name, chunk_sizes, use_index = task
+    start = time()
+    rows = {}
+    error = None
+    try:
+        chunks = featurize_sweep(session_name, chunk_sizes, use_index=use_index, features=MODEL_FEATURES)
+        rows = {chunk_size: get_session_rows(chunks[chunk_size]) for chunk_size in chunk_sizes}
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'session': session_name,
+        'rows': rows,
+        'duration': time() - start,
+        'error': error
+    }
+
+
+def save_matrices(chunk_sizes: List[int], use_index=False, workers: int = cpu_count()) -> List[Dict]:
+    # One feature matrix per chunk size, shared by all points with that chunk size
+    session_names = list_combined()
+    rows = {}
+    failed = []
+    pool = Pool(workers)
+    for i, status in enumerate(pool.imap_unordered(featurize_task, [
+        (session_name, chunk_sizes, use_index) for session_name in session_names
+    ]), 1):
+        progress = '{}/{} {} - '.format(i, len(session_names), status['session'])
+        if status['error']:
+            failed.append(status)
+            print(progress + 'failed - ' + status['error'])
+        else:
+            rows[status['session']] = status['rows']
+            print(progress + 'featurized ({:.2f}s)'.format(status['duration']))
+    pool.close()
+    pool.join()
+    featurized = sorted(rows)
+    for chunk_size in chunk_sizes:
+        save_matrix(get_matrix(featurized, [rows[session_name][chunk_size] for session_name in featurized]),
+                    get_matrix_folder(chunk_size))
+    return failed
+
+
+def evaluate_point(data: Dict, point: Dict) -> Dict:
+    # Leave-one-session-out round with the parameters of the point, summarized like data/predictions.json
+    results = []
+    for i, count in enumerate(np.bincount(data['session'], minlength=len(data['names']))):
+        if count == 0:
+            continue  # the session is shorter than the chunk size
+        test = data['session'] == i
+        classifier = LogisticRegression(C=point['C'], **MODEL_PARAMETERS)
+        fit_standardized(classifier, data, get_fold_weights(data, test, point['weighting']))
+        results.append(get_result(data['y'][test], classifier.predict(data['x'][test])))
+    summary = get_summary(results, point['chunk_size'])
+    summary['C'] = point['C']
+    summary['weighting'] = point['weighting']
+    return summary
+
+
+def init_worker(blas_threads: int) -> None:
+    limit_blas_threads(blas_threads)
+    worker_matrices.clear()  # a forked worker must not use a matrix the parent read before it was featurized again
+
+
+def evaluate_task(point: Dict) -> Dict:
+    # Runs in a worker, the matrix of a chunk size is mapped once per worker
+    start = time()
+    error = None
+    try:
+        if point['chunk_size'] not in worker_matrices:
+            worker_matrices[point['chunk_size']] = read_matrix(get_matrix_folder(point['chunk_size']))
+        data = worker_matrices[point['chunk_size']]
+        write_point(point, get_data_fingerprint(data), evaluate_point(data, point))
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'point': point,
+        'duration': time() - start,
+        'error': error
+    }
+
+
+def write_table(points: List[Dict], fingerprints: Dict[int, str]) -> List[Dict]:
+    # Summaries of all finished points in the order of the grid
+    table = [summary for summary in (read_point(point, fingerprints[point['chunk_size']]) for point in points)
+             if summary]
+    with open(GRID_TABLE, 'w') as target:
+        dump(table, target, indent=2)
+    return table
+
+
+def grid_search(chunk_sizes: List[int], cs: List[float], weightings: List[str], use_index=False,
+                workers: int = cpu_count(), blas_threads: Optional[int] = None, restart=False) -> List[Dict]:
+    # Points finished by an earlier run are skipped, unless the sweep is restarted. Only the matrices whose inputs
+    # changed are featurized again, and points are evaluated again if their matrix changed
+    if restart:
+        rmtree(GRID_FOLDER, ignore_errors=True)
+    points = get_points(chunk_sizes, cs, weightings)
+    inputs = {chunk_size: get_input_fingerprint(chunk_size, use_index) for chunk_size in set(chunk_sizes)}
+    stale = sorted(chunk_size for chunk_size in inputs if read_matrix_inputs(chunk_size) != inputs[chunk_size])
+    print('{} of {} matrices up to date'.format(len(inputs) - len(stale), len(inputs)))
+    failed = []
+    if stale:
+        for chunk_size in stale:
+            try:
+                remove(get_matrix_inputs_file(chunk_size))  # the matrix is replaced, even if this run stops
+            except FileNotFoundError:
+                pass
+        failed = save_matrices(stale, use_index, workers)
+        if not failed:
+            for chunk_size in stale:
+                write_matrix_inputs(chunk_size, inputs[chunk_size])
+    fingerprints = {chunk_size: get_data_fingerprint(read_matrix(get_matrix_folder(chunk_size)))
+                    for chunk_size in chunk_sizes}
+    pending = [point for point in points if read_point(point, fingerprints[point['chunk_size']]) is None]
+    print('{} of {} points done'.format(len(points) - len(pending), len(points)))
+    if pending:
+        pool = Pool(workers, initializer=init_worker, initargs=[blas_threads or max(1, cpu_count() // workers)])
+        for i, status in enumerate(pool.imap_unordered(evaluate_task, pending), 1):
+            progress = '{}/{} chunk size {chunk_size}, C {C}, {weighting} - '.format(i, len(pending),
+                                                                                      **status['point'])
+            if status['error']:
+                failed.append(status)
+                print(progress + 'failed - ' + status['error'])
+            else:
+                print(progress + 'done ({:.2f}s)'.format(status['duration']))
+        pool.close()
+        pool.join()
+
+    print('chunk size  C         weighting  accuracy  precision  recall')
+    for summary in write_table(points, fingerprints):
+        print('{:>10}  {:<8}  {:<9}  {:>8.3f}  {:>9.3f}  {:>6.3f}'.format(
+            summary['chunk_size'], summary['C'], summary['weighting'], summary['accuracy'], summary['precision'],
+            summary['recall']))
+    return failed
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Evaluate the predictions for a grid of chunk sizes and model parameters.')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[5], help='chunk sizes in seconds')
+    parser.add_argument('--c', type=float, nargs='+', default=[1.0], help='inverse regularization strengths')
+    parser.add_argument('--weightings', nargs='+', choices=WEIGHTINGS, default=['session'],
+                        help='sample weightings of the classes')
+    parser.add_argument('--index', action='store_true',
+                        help='calculate the features from the per-second index instead of the events')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of worker processes')
+    parser.add_argument('--blas-threads', type=int,
+                        help='number of BLAS threads per worker (default: number of cores divided by workers)')
+    parser.add_argument('--restart', action='store_true', help='discard the points of an earlier run')
+    arguments = parser.parse_args()
+    if grid_search(arguments.chunk_sizes, arguments.c, arguments.weightings, arguments.index, arguments.workers,
+                   arguments.blas_threads, arguments.restart):
+        exit(1)
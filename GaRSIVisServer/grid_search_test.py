@@ -0,0 +1,119 @@
+import unittest
+from json import load
+from os import chdir, getcwd, makedirs
+from tempfile import TemporaryDirectory
+from typing import ContextManager, List
+from unittest.mock import patch
+
+import numpy as np
+
+from grid_search import GRID_TABLE, evaluate_point, evaluate_task, get_data_fingerprint, get_input_fingerprint, \
+    get_matrix_folder, get_points, grid_search, read_point
+from predict import get_matrix, read_matrix, save_matrix
+from preprocess import get_combined_folder, get_parameters, save_combined_times, save_manifest
+
+
+def get_rows(random: np.random.RandomState, size: int) -> tuple:
+    y = [1 if i % 4 == 0 else 0 for i in range(size)]
+    x = [random.normal(2 * label, 1, 13).tolist() for label in y]
+    w = [size - sum(y) if label else sum(y) for label in y]
+    return x, y, w
+
+
+class GridSearchTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = getcwd()
+        self.directory = TemporaryDirectory()
+        chdir(self.directory.name)
+        random = np.random.RandomState(0)
+        self.rows = [get_rows(random, size) for size in [20, 30, 40]]
+        save_matrix(get_matrix(['a', 'b', 'c'], self.rows), get_matrix_folder(5))
+
+    def tearDown(self) -> None:
+        chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_points(self) -> None:
+        points = get_points([5, 10], [0.1, 1.0], ['session', 'none'])
+        self.assertEqual(8, len(points))
+        self.assertEqual({'chunk_size': 5, 'C': 0.1, 'weighting': 'none'}, points[1])
+
+    def test_evaluate(self) -> None:
+        point = {'chunk_size': 5, 'C': 1.0, 'weighting': 'balanced'}
+        status = evaluate_task(point)
+        self.assertIsNone(status['error'])
+        data = read_matrix(get_matrix_folder(5))
+        summary = read_point(point, get_data_fingerprint(data))
+        self.assertEqual(evaluate_point(data, point), summary)
+        self.assertEqual({'chunk_size', 'accuracy', 'precision', 'recall', 'C', 'weighting'}, set(summary))
+        self.assertGreater(summary['accuracy'], 0.8)
+
+    def test_unknown_weighting(self) -> None:
+        self.assertIn('ValueError', evaluate_task({'chunk_size': 5, 'C': 1.0, 'weighting': 'inverse'})['error'])
+
+    def save_matrices(self, names: List[str]) -> ContextManager:
+        # Featurizing again produces the rows of the given sessions
+        def save_matrices(chunk_sizes, use_index, workers):
+            save_matrix(get_matrix(names, [self.rows[ord(name) - ord('a')] for name in names]), get_matrix_folder(5))
+            return []
+
+        return patch('grid_search.save_matrices', side_effect=save_matrices)
+
+    def test_input_fingerprint(self) -> None:
+        for session_name in ['a', 'b']:
+            makedirs(get_combined_folder(session_name))
+            save_combined_times(session_name, [], [])
+        save_manifest({
+            'parameters': get_parameters(),
+            'sessions': {
+                'user/a.txt': {'session': 'a', 'hash': '1'},
+                'user/b.txt': {'session': 'b', 'hash': '2'}
+            }
+        })
+        fingerprint = get_input_fingerprint(5)
+        self.assertEqual(fingerprint, get_input_fingerprint(5))
+        self.assertNotEqual(fingerprint, get_input_fingerprint(10))
+        self.assertNotEqual(fingerprint, get_input_fingerprint(5, use_index=True))
+        # An annotation changes the ignored times of a session
+        save_combined_times('b', [{'start': 1, 'end': 2, 'comment': ''}], [])
+        self.assertNotEqual(fingerprint, get_input_fingerprint(5))
+
+    def test_resume(self) -> None:
+        points = get_points([5], [0.1, 1.0], ['session'])
+        for point in points:
+            evaluate_task(point)
+        fingerprint = get_data_fingerprint(read_matrix(get_matrix_folder(5)))
+        # The sessions did not change, so every point is done and nothing is evaluated again
+        with patch('grid_search.get_input_fingerprint', return_value='inputs'), patch('grid_search.Pool') as pool:
+            with self.save_matrices(['a', 'b', 'c']) as save_matrices:
+                self.assertEqual([], grid_search([5], [0.1, 1.0], ['session'], workers=1))
+                save_matrices.assert_called_once()
+            # The inputs of the matrix did not change either, so it is not featurized again
+            with self.save_matrices(['a', 'b', 'c']) as save_matrices:
+                self.assertEqual([], grid_search([5], [0.1, 1.0], ['session'], workers=1))
+                save_matrices.assert_not_called()
+            pool.assert_not_called()
+        with open(GRID_TABLE, encoding='utf8') as source:
+            self.assertEqual([read_point(point, fingerprint) for point in points], load(source))
+
+    def test_resume_after_change(self) -> None:
+        points = get_points([5], [0.1, 1.0], ['session'])
+        for point in points:
+            evaluate_task(point)
+        previous = get_data_fingerprint(read_matrix(get_matrix_folder(5)))
+        # A session was removed since, so the points are evaluated again on the remaining sessions
+        with patch('grid_search.get_input_fingerprint', return_value='inputs'), self.save_matrices(['a', 'c']):
+            self.assertEqual([], grid_search([5], [0.1, 1.0], ['session'], workers=1))
+        data = read_matrix(get_matrix_folder(5))
+        self.assertEqual(['a', 'c'], data['names'])
+        fingerprint = get_data_fingerprint(data)
+        self.assertNotEqual(previous, fingerprint)
+        with open(GRID_TABLE, encoding='utf8') as source:
+            self.assertEqual([evaluate_point(data, point) for point in points], load(source))
+        for point in points:
+            self.assertIsNone(read_point(point, previous))
+            self.assertEqual(evaluate_point(data, point), read_point(point, fingerprint))
+
+
+if __name__ == '__main__':
+    unittest.main()
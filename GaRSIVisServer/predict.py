@@ -1,64 +1,251 @@
-from json import dump, load
-from os import listdir, makedirs
+from hashlib import md5
+from json import dump, dumps, load
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+from os import environ, getpid, listdir, makedirs, replace
 from os.path import join, isfile, splitext
 from statistics import mean
-from typing import List, Tuple, Dict, Union
+from time import time
+from typing import List, Optional, Tuple, Dict, Union
 
+import numpy as np
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, precision_score, recall_score
-from sklearn.utils import shuffle
+from threadpoolctl import threadpool_limits
 
+from features import MODEL_FEATURES, get_feature_vector
 
-def load_others(excluded_session_name: str) -> Tuple[List, List, List]:
-    x = []
-    y = []
-    w = []
-    chunk_folder = join('data', 'chunks')
-    for file_name in listdir(chunk_folder):
-        if isfile(join(chunk_folder, file_name)):
-            session_name = splitext(file_name)[0]
-            if session_name != excluded_session_name:
-                session_x, session_y, session_w = load_session(session_name)
-                x.extend(session_x)
-                y.extend(session_y)
-                w.extend(session_w)
-    return shuffle(x, y, w)
+MATRIX_FOLDER = join('data', 'matrix')
+MATRIX_COLUMNS = ['x', 'z', 'y', 'w', 'session']  # z is x standardized with the scaler of the round
+MODEL_FOLDER = join('data', 'models')
+# lbfgs continues from the coefficients of the previous fit with warm_start, liblinear always starts over.
+# On standardized features lbfgs reaches the tolerance well before max_iter, so a warm fit ends where a cold one does
+MODEL_PARAMETERS = {'solver': 'lbfgs', 'max_iter': 1000, 'tol': 1e-6}
+STATISTICS_FILE = join('data', 'statistics.json')
+BACKENDS = ['batch', 'incremental']
+# Sample weights: balanced per session, balanced over the training sessions of a fold, or equal
+WEIGHTINGS = ['session', 'balanced', 'none']
+RIDGE = 1e-9  # regularization of the incremental backend, relative to the mean of the diagonal
+BLAS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+worker_data = {}
 
 
 def load_session(session_name: str) -> Tuple[List, List, List]:
+    with open(join('data', 'chunks', session_name + '.json'), encoding='utf8') as session_file:
+        return get_session_rows(load(session_file))
+
+
+def get_session_rows(session: List[Dict]) -> Tuple[List, List, List]:
     x = []
     y = []
-    with open(join('data', 'chunks', session_name + '.json'), encoding='utf8') as session_file:
-        session = load(session_file)
     for chunk in session:
         y.append(1 if chunk['interruption'] else 0)
-        x.append([
-            chunk['fixations']['count'],
-            chunk['fixations']['duration']['avg'],
-            chunk['fixations']['duration']['med'],
-            chunk['fixations']['duration']['var'],
-            chunk['saccades']['duration']['avg'],
-            chunk['saccades']['duration']['med'],
-            chunk['saccades']['duration']['var'],
-            chunk['saccades']['length']['avg'],
-            chunk['saccades']['length']['med'],
-            chunk['saccades']['length']['var'],
-            chunk['saccades']['angle']['avg'],
-            chunk['saccades']['angle']['med'],
-            chunk['saccades']['angle']['var'],
-        ])
+        x.append(get_feature_vector(chunk, MODEL_FEATURES))
     weight_0 = sum(y)
     weight_1 = len(y) - weight_0
     w = [weight_1 if i else weight_0 for i in y]
     return x, y, w
 
 
-def predict(session_name: str) -> Dict[str, Union[float, List]]:
-    x_train, y_train, w_train = load_others(session_name)
-    x_test, y_test, _ = load_session(session_name)
-    classifier = LogisticRegression()
-    classifier.fit(x_train, y_train, sample_weight=w_train)
-    c = classifier.predict(x_test)
+def load_sessions() -> Dict:
+    # Feature matrix of all chunks, with the index of the session of each chunk to select the folds
+    chunk_folder = join('data', 'chunks')
+    session_names = [splitext(file_name)[0] for file_name in sorted(listdir(chunk_folder))
+                     if isfile(join(chunk_folder, file_name)) and splitext(file_name)[1] == '.json']
+    return get_matrix(session_names, [load_session(session_name) for session_name in session_names])
+
+
+def get_matrix(session_names: List[str], rows: List[Tuple[List, List, List]]) -> Dict:
+    x = []
+    y = []
+    w = []
+    sessions = []
+    for i, (session_x, session_y, session_w) in enumerate(rows):
+        x.extend(session_x)
+        y.extend(session_y)
+        w.extend(session_w)
+        sessions.extend([i] * len(session_y))
+    data = {
+        'names': session_names,
+        'x': np.array(x, dtype=float).reshape(len(y), len(MODEL_FEATURES)),
+        'y': np.array(y, dtype=int),
+        'w': np.array(w, dtype=float),
+        'session': np.array(sessions, dtype=int)
+    }
+    data['fingerprints'] = get_session_fingerprints(data)
+    data.update(get_scaler(data['x']))
+    data['z'] = data['x'] - data['mean']
+    data['z'] /= data['scale']
+    return data
+
+
+def get_session_fingerprints(data: Dict) -> List[str]:
+    # Hash of the rows of each session, the rows of a session are contiguous
+    bounds = np.searchsorted(data['session'], np.arange(len(data['names']) + 1))
+    fingerprints = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        fingerprint = md5()
+        for column in ['x', 'y', 'w']:
+            fingerprint.update(np.ascontiguousarray(data[column][start:end]).tobytes())
+        fingerprints.append(fingerprint.hexdigest())
+    return fingerprints
+
+
+def save_matrix(data: Dict, folder: str = MATRIX_FOLDER) -> None:
+    # Columns are replaced atomically, so workers of a running round keep their mapped matrix
+    try:
+        makedirs(folder)
+    except FileExistsError:
+        pass
+    for column in MATRIX_COLUMNS:
+        temporary_file = join(folder, '{}.{}.tmp'.format(column, getpid()))
+        with open(temporary_file, 'wb') as target:
+            np.save(target, data[column])
+        replace(temporary_file, join(folder, column + '.npy'))
+    with open(join(folder, 'sessions.json'), 'w') as target:
+        dump({
+            'names': data['names'],
+            'fingerprints': data['fingerprints'],
+            'mean': data['mean'].tolist(),
+            'scale': data['scale'].tolist()
+        }, target)
+
+
+def read_matrix(folder: str = MATRIX_FOLDER) -> Dict:
+    data = {column: np.load(join(folder, column + '.npy'), mmap_mode='r') for column in MATRIX_COLUMNS}
+    with open(join(folder, 'sessions.json'), encoding='utf8') as source:
+        data.update(load(source))
+    for key in ['mean', 'scale']:
+        data[key] = np.array(data[key])
+    return data
+
+
+def get_fold_fingerprint(data: Dict, session_name: str) -> str:
+    # The training data of a fold is the other sessions, together with the features and parameters of the model.
+    # The scale sets what the penalty of each coefficient means, the mean only moves the intercept, which is not
+    # penalized
+    training = [[name, fingerprint] for name, fingerprint in zip(data['names'], data['fingerprints'])
+                if name != session_name]
+    return md5(dumps([MODEL_FEATURES, MODEL_PARAMETERS, data['scale'].tolist(), training],
+                     sort_keys=True).encode()).hexdigest()
+
+
+def read_model(session_name: str) -> Optional[Dict]:
+    try:
+        with open(join(MODEL_FOLDER, session_name + '.json'), encoding='utf8') as source:
+            return load(source)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_model(session_name: str, model: Dict) -> None:
+    try:
+        makedirs(MODEL_FOLDER)
+    except FileExistsError:
+        pass
+    temporary_file = join(MODEL_FOLDER, '{}.json.{}.tmp'.format(session_name, getpid()))
+    with open(temporary_file, 'w') as target:
+        dump(model, target)
+    replace(temporary_file, join(MODEL_FOLDER, session_name + '.json'))
+
+
+def get_fold_weights(data: Dict, test: np.ndarray, weighting: str = 'session') -> np.ndarray:
+    # The test session is left out by its weight, so the training rows are not copied for each fold
+    if weighting == 'session':
+        return np.where(test, 0, data['w'])
+    if weighting == 'none':
+        return np.where(test, 0, 1.0)
+    if weighting == 'balanced':
+        counts = np.bincount(data['y'][~test], minlength=2).astype(float)
+        class_weights = np.where(counts > 0, counts.sum() / (2 * np.maximum(counts, 1)), 0)
+        return np.where(test, 0, class_weights[data['y']])
+    raise ValueError('Unknown weighting: ' + weighting)
+
+
+def get_scaler(x: np.ndarray) -> Dict[str, np.ndarray]:
+    # Mean and standard deviation of all rows, reduced column by column without a copy of the matrix.
+    # The scale only has to make lbfgs converge, so it is rounded to a power of two and stays the same when a few
+    # sessions change, which keeps the folds whose training sessions did not change. Constant features are not scaled
+    count = max(len(x), 1)
+    mean = np.asarray(x.sum(axis=0)) / count
+    std = np.sqrt(np.maximum(np.einsum('ij,ij->j', x, x) / count - mean ** 2, 0))
+    return {
+        'mean': mean,
+        'scale': np.where(std > 0, 2.0 ** np.round(np.log2(np.where(std > 0, std, 1.0))), 1.0)
+    }
+
+
+def scale_coefficients(coef: np.ndarray, intercept: np.ndarray,
+                       scaler: Dict) -> Tuple[np.ndarray, np.ndarray]:
+    # Coefficients of the raw features to the same model on the standardized features
+    return coef * scaler['scale'], intercept + coef.dot(scaler['mean'])
+
+
+def unscale_coefficients(coef: np.ndarray, intercept: np.ndarray,
+                         scaler: Dict) -> Tuple[np.ndarray, np.ndarray]:
+    raw = coef / scaler['scale']
+    return raw, intercept - raw.dot(scaler['mean'])
+
+
+def fit_standardized(classifier: LogisticRegression, data: Dict, weights: np.ndarray) -> None:
+    # The classifier is fitted on the standardized matrix, but starts from and ends with the coefficients of the raw
+    # features, so it predicts from the raw matrix and a warm start does not depend on the previous scaler
+    if getattr(classifier, 'coef_', None) is not None:
+        classifier.coef_, classifier.intercept_ = scale_coefficients(classifier.coef_, classifier.intercept_, data)
+    classifier.fit(data['z'], data['y'], sample_weight=weights)
+    classifier.coef_, classifier.intercept_ = unscale_coefficients(classifier.coef_, classifier.intercept_, data)
+
+
+def fit_fold(data: Dict, session_name: str) -> Tuple[LogisticRegression, Dict]:
+    # The model of the previous round is reused if the training data is the same,
+    # and its coefficients are the start of the fit if only the training data changed
+    test = data['session'] == data['names'].index(session_name)
+    fingerprint = get_fold_fingerprint(data, session_name)
+    classes = np.unique(data['y']).tolist()
+    previous = read_model(session_name)
+    if previous and (previous['features'] != MODEL_FEATURES or previous['classes'] != classes
+                     or 'scale' not in previous):
+        previous = None
+    classifier = LogisticRegression(warm_start=True, **MODEL_PARAMETERS)
+    if previous:
+        classifier.coef_ = np.array(previous['coef'])
+        classifier.intercept_ = np.array(previous['intercept'])
+    if previous and previous['fingerprint'] == fingerprint:
+        classifier.classes_ = np.array(classes)
+        return classifier, {
+            'fit': 'skipped',
+            'iterations': 0,
+            'fit_duration': 0.0
+        }
+
+    start = time()
+    fit_standardized(classifier, data, get_fold_weights(data, test))
+    fit_duration = time() - start
+    iterations = int(np.max(classifier.n_iter_))
+    write_model(session_name, {
+        'features': MODEL_FEATURES,
+        'classes': classes,
+        'fingerprint': fingerprint,
+        'coef': classifier.coef_.tolist(),
+        'intercept': classifier.intercept_.tolist(),
+        'mean': data['mean'].tolist(),
+        'scale': data['scale'].tolist(),
+        'iterations': iterations
+    })
+    return classifier, {
+        'fit': 'warm' if previous else 'cold',
+        'iterations': iterations,
+        'fit_duration': fit_duration
+    }
+
+
+def evaluate_fold(data: Dict, session_name: str, classifier: LogisticRegression) -> Dict[str, Union[float, List]]:
+    test = data['session'] == data['names'].index(session_name)
+    return get_result(data['y'][test], classifier.predict(data['x'][test]))
+
+
+def get_result(y_test: np.ndarray, c: np.ndarray) -> Dict[str, Union[float, List]]:
     return {
         'accuracy': accuracy_score(y_test, c),
         'precision': precision_score(y_test, c),
@@ -67,42 +254,231 @@ def predict(session_name: str) -> Dict[str, Union[float, List]]:
     }
 
 
-def save_prediction(file_name: str) -> None:
-    session_name = splitext(file_name)[0]
-    result = predict(session_name)
+def predict_fold(data: Dict, session_name: str) -> Dict[str, Union[float, List]]:
+    return evaluate_fold(data, session_name, fit_fold(data, session_name)[0])
+
+
+def save_fold(data: Dict, session_name: str) -> Dict:
+    # Writes the prediction of a fold and reports how its model was fitted
+    classifier, fit = fit_fold(data, session_name)
+    write_prediction(session_name, evaluate_fold(data, session_name, classifier))
+    return fit
+
+
+def format_fit(fit: Dict) -> str:
+    return '{}, {} iterations in {:.2f}s'.format(fit['fit'], fit['iterations'], fit['fit_duration'])
+
+
+def get_session_statistics(data: Dict, session_index: int) -> Dict[str, np.ndarray]:
+    # Weighted least squares of the labels as -1 and 1 only needs these sums, so sessions can be added and removed
+    rows = data['session'] == session_index
+    x = np.hstack([data['x'][rows], np.ones((np.count_nonzero(rows), 1))])
+    w = data['w'][rows]
+    return {
+        'xx': (x * w[:, np.newaxis]).T.dot(x),
+        'xy': x.T.dot(w * (2 * data['y'][rows] - 1))
+    }
+
+
+def update_statistics(data: Dict) -> Tuple[Dict[str, Dict], int]:
+    # Statistics of the previous round are kept for the sessions whose rows did not change
+    try:
+        with open(STATISTICS_FILE, encoding='utf8') as source:
+            previous = load(source)
+    except (FileNotFoundError, ValueError):
+        previous = {}
+    statistics = {}
+    updated = 0
+    for i, (name, fingerprint) in enumerate(zip(data['names'], data['fingerprints'])):
+        if name in previous and previous[name]['fingerprint'] == fingerprint \
+                and previous[name]['features'] == MODEL_FEATURES:
+            statistics[name] = {key: np.array(previous[name][key]) for key in ['xx', 'xy']}
+        else:
+            statistics[name] = get_session_statistics(data, i)
+            updated += 1
+    temporary_file = '{}.{}.tmp'.format(STATISTICS_FILE, getpid())
+    with open(temporary_file, 'w') as target:
+        dump({name: {
+            'fingerprint': fingerprint,
+            'features': MODEL_FEATURES,
+            'xx': statistics[name]['xx'].tolist(),
+            'xy': statistics[name]['xy'].tolist()
+        } for name, fingerprint in zip(data['names'], data['fingerprints'])}, target)
+    replace(temporary_file, STATISTICS_FILE)
+    return statistics, updated
+
+
+def get_total_statistics(statistics: Dict[str, Dict]) -> Dict[str, np.ndarray]:
+    return {key: sum(session[key] for session in statistics.values()) for key in ['xx', 'xy']}
+
+
+def fit_statistics(total: Dict[str, np.ndarray], session: Dict[str, np.ndarray]) -> np.ndarray:
+    # The fold is the total of all sessions with the contribution of the test session removed
+    xx = total['xx'] - session['xx']
+    xy = total['xy'] - session['xy']
+    ridge = RIDGE * max(np.trace(xx) / len(xx), 1)
+    return np.linalg.solve(xx + ridge * np.eye(len(xx)), xy)
+
+
+def predict_statistics(coefficients: np.ndarray, x: np.ndarray) -> np.ndarray:
+    return (np.asarray(x).dot(coefficients[:-1]) + coefficients[-1] > 0).astype(int)
+
+
+def predict_incremental(data: Dict, statistics: Dict[str, Dict], total: Dict[str, np.ndarray],
+                        session_name: str) -> Dict[str, Union[float, List]]:
+    test = data['session'] == data['names'].index(session_name)
+    c = predict_statistics(fit_statistics(total, statistics[session_name]), data['x'][test])
+    return get_result(data['y'][test], c)
+
+
+def save_incremental_predictions(data: Dict) -> List[str]:
+    # Solving a fold is cheap, so the round runs in this process
+    start = time()
+    statistics, updated = update_statistics(data)
+    total = get_total_statistics(statistics)
+    for session_name in data['names']:
+        write_prediction(session_name, predict_incremental(data, statistics, total, session_name))
+    print('incremental - {}/{} sessions updated ({:.2f}s)'.format(updated, len(data['names']), time() - start))
+    return data['names']
+
+
+def compare_backends() -> Dict[str, Dict]:
+    # Mean scores of the folds of each backend. The statistics and models are computed in memory only,
+    # so the comparison does not change data/statistics.json, data/models or the predictions of later rounds
+    data = load_sessions()
+    statistics = {name: get_session_statistics(data, i) for i, name in enumerate(data['names'])}
+    total = get_total_statistics(statistics)
+    results = {backend: [] for backend in BACKENDS}
+    for i, session_name in enumerate(data['names']):
+        classifier = LogisticRegression(**MODEL_PARAMETERS)
+        fit_standardized(classifier, data, get_fold_weights(data, data['session'] == i))
+        results['batch'].append(evaluate_fold(data, session_name, classifier))
+        results['incremental'].append(predict_incremental(data, statistics, total, session_name))
+    comparison = {}
+    for backend in BACKENDS:
+        comparison[backend] = {prop: mean(result[prop] for result in results[backend])
+                               for prop in ['accuracy', 'precision', 'recall']}
+    return comparison
+
+
+def predict(session_name: str) -> Dict[str, Union[float, List]]:
+    return predict_fold(load_sessions(), session_name)
+
+
+def write_prediction(session_name: str, result: Dict) -> None:
     try:
         makedirs(join('data', 'predictions'))
     except FileExistsError:
         pass
-    with open(join('data', 'predictions', file_name), 'w') as result_file:
+    with open(join('data', 'predictions', session_name + '.json'), 'w') as result_file:
         dump(result, result_file, indent=2)
 
 
+def save_prediction(file_name: str) -> None:
+    session_name = splitext(file_name)[0]
+    write_prediction(session_name, predict(session_name))
+
+
+def limit_blas_threads(threads: int) -> None:
+    # Forked workers have the BLAS of the parent loaded already, which ignores the environment from then on,
+    # so loaded libraries are limited by threadpoolctl and the variables only cover libraries loaded later
+    threadpool_limits(threads)
+    for variable in BLAS_VARIABLES:
+        environ[variable] = str(threads)
+
+
+def init_worker(blas_threads: int) -> None:
+    limit_blas_threads(blas_threads)
+    worker_data.update(read_matrix())
+
+
+def predict_task(session_name: str) -> Dict:
+    # Runs in a worker on the shared memory-mapped matrix, writes its prediction and only reports the outcome
+    start = time()
+    status = {
+        'session': session_name,
+        'error': None
+    }
+    try:
+        status.update(save_fold(worker_data, session_name))
+    except Exception as e:
+        status['error'] = '{}: {}'.format(type(e).__name__, e)
+    status['duration'] = time() - start
+    return status
+
+
+def save_predictions(workers: int = 1, blas_threads: Optional[int] = None, backend: str = 'batch') -> List[str]:
+    # Leave-one-session-out round, the chunks of all sessions are read only once
+    data = load_sessions()
+    if backend == 'incremental':
+        return save_incremental_predictions(data)
+    if workers <= 1:
+        for i, session_name in enumerate(data['names'], 1):
+            fit = save_fold(data, session_name)
+            print('{}/{} {} - done ({})'.format(i, len(data['names']), session_name, format_fit(fit)))
+        return data['names']
+
+    save_matrix(data)
+    predicted = []
+    pool = Pool(workers, initializer=init_worker, initargs=[blas_threads or max(1, cpu_count() // workers)])
+    for i, status in enumerate(pool.imap_unordered(predict_task, data['names']), 1):
+        progress = '{}/{} {} - '.format(i, len(data['names']), status['session'])
+        if status['error']:
+            print(progress + 'failed - ' + status['error'])
+        else:
+            predicted.append(status['session'])
+            print(progress + 'done ({:.2f}s, {})'.format(status['duration'], format_fit(status)))
+    pool.close()
+    pool.join()
+    return predicted
+
+
+def get_summary(results: List[Dict], chunk_size: int) -> Dict:
+    # Mean of each score of the folds, the format of data/predictions.json
+    scores = {}
+    for result in results:
+        for prop in result:
+            if prop != 'prediction':
+                scores.setdefault(prop, []).append(result[prop])
+    summary = {
+        'chunk_size': chunk_size
+    }
+    for prop in scores:
+        summary[prop] = mean(scores[prop])
+    return summary
+
+
 def summarize_predictions(chunk_size: int) -> None:
-    results = {}
+    results = []
     prediction_folder = join('data', 'predictions')
     for prediction_file_name in listdir(prediction_folder):
         if isfile(join(prediction_folder, prediction_file_name)):
             with open(join(prediction_folder, prediction_file_name), encoding='utf8') as prediction_file:
                 result = load(prediction_file)
-            del result['prediction']
-            for prop in result:
-                if prop not in results:
-                    results[prop] = []
-                results[prop].append(result[prop])
-    summary = {
-        'chunk_size': chunk_size
-    }
-    for prop in results:
-        summary[prop] = mean(results[prop])
+            results.append(result)
+    summary = get_summary(results, chunk_size)
     with open(join('data', 'predictions.json'), 'w') as result_file:
         dump(summary, result_file, indent=2)
 
 
 if __name__ == '__main__':
-    from multiprocessing.pool import Pool
-    source_folder = join('data', 'chunks')
-    session_files = [f for f in listdir(source_folder) if isfile(join(source_folder, f))]
-    pool = Pool(4)
-    pool.map(save_prediction, session_files)
-    summarize_predictions(5)
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Predict the interruptions of each session from the other sessions.')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of worker processes')
+    parser.add_argument('--blas-threads', type=int,
+                        help='number of BLAS threads per worker (default: number of cores divided by workers)')
+    parser.add_argument('--backend', choices=BACKENDS, default='batch',
+                        help='batch logistic regression or incremental least squares from per-session statistics')
+    parser.add_argument('--compare', action='store_true', help='only print the scores of both backends')
+    arguments = parser.parse_args()
+    if arguments.compare:
+        print('backend      accuracy  precision  recall')
+        comparison = compare_backends()
+        for name in BACKENDS:
+            scores = comparison[name]
+            print('{:<12} {:>8.3f}  {:>9.3f}  {:>6.3f}'.format(name, scores['accuracy'], scores['precision'],
+                                                              scores['recall']))
+    else:
+        save_predictions(arguments.workers, arguments.blas_threads, arguments.backend)
+        summarize_predictions(5)
@@ -0,0 +1,213 @@
+import unittest
+from json import dump, load
+from multiprocessing.pool import Pool
+from os import chdir, getcwd, listdir, makedirs, remove
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from threadpoolctl import threadpool_info
+
+from features import MODEL_FEATURES
+from predict import MODEL_FOLDER, MODEL_PARAMETERS, compare_backends, fit_fold, fit_statistics, get_fold_weights, \
+    get_session_statistics, get_total_statistics, init_worker, load_session, load_sessions, predict_fold, read_matrix, \
+    read_model, save_matrix, save_predictions, update_statistics, write_model
+
+
+def get_chunk(random: np.random.RandomState, interruption: bool) -> dict:
+    def get_statistics():
+        return {name: float(random.normal(2 if interruption else 0, 1)) for name in ['avg', 'med', 'min', 'max', 'var']}
+
+    return {
+        'start': 0,
+        'end': 5,
+        'interruption': interruption,
+        'fixations': {
+            'duration': get_statistics(),
+            'count': int(random.randint(5, 15))
+        },
+        'saccades': {
+            'duration': get_statistics(),
+            'length': get_statistics(),
+            'angle': get_statistics()
+        }
+    }
+
+
+class LeaveOneSessionOutTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = getcwd()
+        self.directory = TemporaryDirectory()
+        chdir(self.directory.name)
+        makedirs(join('data', 'chunks'))
+        random = np.random.RandomState(0)
+        for session_name, size in [('b', 30), ('a', 20), ('c', 40)]:
+            with open(join('data', 'chunks', session_name + '.json'), 'w') as target:
+                dump([get_chunk(random, i % 4 == 0) for i in range(size)], target)
+        # Files that are being written are not sessions
+        open(join('data', 'chunks', 'c.json.123.tmp'), 'w').close()
+
+    def tearDown(self) -> None:
+        chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_load_sessions(self) -> None:
+        data = load_sessions()
+        self.assertEqual(['a', 'b', 'c'], data['names'])
+        self.assertEqual((90, len(MODEL_FEATURES)), data['x'].shape)
+        self.assertEqual([20, 30, 40], np.bincount(data['session']).tolist())
+        x, y, w = load_session('b')
+        self.assertEqual(x, data['x'][data['session'] == 1].tolist())
+        self.assertEqual(y, data['y'][data['session'] == 1].tolist())
+        self.assertEqual(w, data['w'][data['session'] == 1].tolist())
+
+    def test_predict_fold(self) -> None:
+        result = predict_fold(load_sessions(), 'c')
+        self.assertEqual(40, len(result['prediction']))
+        self.assertGreater(result['accuracy'], 0.8)
+
+    def test_matrix(self) -> None:
+        data = load_sessions()
+        save_matrix(data)
+        matrix = read_matrix()
+        self.assertEqual(data['names'], matrix['names'])
+        self.assertEqual(data['fingerprints'], matrix['fingerprints'])
+        self.assertIsInstance(matrix['x'], np.memmap)
+        for column in ['x', 'z', 'y', 'w', 'session']:
+            self.assertEqual(data[column].tolist(), matrix[column].tolist())
+        self.assertEqual(data['scale'].tolist(), matrix['scale'].tolist())
+
+    def test_parallel(self) -> None:
+        self.assertEqual(['a', 'b', 'c'], sorted(save_predictions(2, 1)))
+        for session_name, size in [('a', 20), ('b', 30), ('c', 40)]:
+            with open(join('data', 'predictions', session_name + '.json'), encoding='utf8') as source:
+                self.assertEqual(size, len(load(source)['prediction']))
+
+    def test_blas_threads(self) -> None:
+        save_matrix(load_sessions())
+        pool = Pool(1, initializer=init_worker, initargs=[3])
+        libraries = pool.apply(threadpool_info)
+        pool.close()
+        pool.join()
+        blas = [library['num_threads'] for library in libraries if library['user_api'] == 'blas']
+        self.assertTrue(blas)
+        self.assertEqual([3] * len(blas), blas)
+
+    def test_weightings(self) -> None:
+        data = load_sessions()
+        test = data['session'] == 0
+        np.testing.assert_array_equal(np.where(test, 0, data['w']), get_fold_weights(data, test))
+        self.assertEqual({0.0, 1.0}, set(get_fold_weights(data, test, 'none')))
+        balanced = get_fold_weights(data, test, 'balanced')
+        self.assertEqual(0, balanced[test].sum())
+        # Both classes of the training sessions have the same total weight
+        train_y = data['y'][~test]
+        self.assertAlmostEqual(balanced[~test][train_y == 0].sum(), balanced[~test][train_y == 1].sum())
+
+    def test_skip(self) -> None:
+        data = load_sessions()
+        classifier, fit = fit_fold(data, 'a')
+        self.assertEqual('cold', fit['fit'])
+        self.assertGreater(fit['iterations'], 0)
+        reused, fit = fit_fold(data, 'a')
+        self.assertEqual('skipped', fit['fit'])
+        self.assertEqual(0, fit['iterations'])
+        test = data['session'] == 0
+        self.assertEqual(classifier.predict(data['x'][test]).tolist(), reused.predict(data['x'][test]).tolist())
+
+    def test_warm_start(self) -> None:
+        data = load_sessions()
+        for session_name in data['names']:
+            fit_fold(data, session_name)
+        with open(join('data', 'chunks', 'c.json'), encoding='utf8') as source:
+            chunks = load(source)
+        chunks[0]['saccades']['length']['avg'] += 0.1
+        with open(join('data', 'chunks', 'c.json'), 'w') as target:
+            dump(chunks, target)
+        data = load_sessions()
+        # Only the folds that train on the changed session are fitted again, the scale of the round is the same
+        self.assertEqual(['warm', 'warm', 'skipped'],
+                         [fit_fold(data, session_name)[1]['fit'] for session_name in data['names']])
+
+    def test_scale(self) -> None:
+        data = load_sessions()
+        np.testing.assert_array_equal(2.0 ** np.round(np.log2(data['scale'])), data['scale'])
+        np.testing.assert_allclose((data['x'] - data['mean']) / data['scale'], data['z'])
+        for session_name in data['names']:
+            fit_fold(data, session_name)
+        # Another scale changes the penalty of the coefficients, so every fold is fitted again
+        data['scale'] = data['scale'] * 2
+        data['z'] = data['z'] / 2
+        self.assertEqual(['warm', 'warm', 'warm'],
+                         [fit_fold(data, session_name)[1]['fit'] for session_name in data['names']])
+
+    def test_warm_matches_cold(self) -> None:
+        data = load_sessions()
+        for session_name in data['names']:
+            fit_fold(data, session_name)
+        with open(join('data', 'chunks', 'c.json'), encoding='utf8') as source:
+            chunks = load(source)
+        chunks[0]['fixations']['count'] += 1
+        with open(join('data', 'chunks', 'c.json'), 'w') as target:
+            dump(chunks, target)
+        data = load_sessions()
+        warm, warm_fit = fit_fold(data, 'a')
+        remove(join(MODEL_FOLDER, 'a.json'))
+        cold, cold_fit = fit_fold(data, 'a')
+        self.assertEqual(('warm', 'cold'), (warm_fit['fit'], cold_fit['fit']))
+        # Both fits converge to the same model, the warm one from much closer
+        self.assertLess(warm_fit['iterations'], cold_fit['iterations'])
+        self.assertLess(cold_fit['iterations'], MODEL_PARAMETERS['max_iter'])
+        np.testing.assert_allclose(cold.coef_, warm.coef_, rtol=1e-2, atol=1e-3)
+        np.testing.assert_allclose(cold.intercept_, warm.intercept_, rtol=1e-2, atol=1e-3)
+        self.assertEqual(cold.predict(data['x']).tolist(), warm.predict(data['x']).tolist())
+
+    def test_layout(self) -> None:
+        data = load_sessions()
+        fit_fold(data, 'b')
+        model = read_model('b')
+        model['features'] = model['features'][1:]
+        write_model('b', model)
+        self.assertEqual('cold', fit_fold(data, 'b')[1]['fit'])
+
+    def test_statistics(self) -> None:
+        data = load_sessions()
+        statistics, updated = update_statistics(data)
+        self.assertEqual(3, updated)
+        coefficients = fit_statistics(get_total_statistics(statistics), statistics['b'])
+        # Same as weighted least squares on the rows of the other sessions
+        train = data['session'] != 1
+        x = np.hstack([data['x'][train], np.ones((np.count_nonzero(train), 1))])
+        root_w = np.sqrt(data['w'][train])
+        expected = np.linalg.lstsq(x * root_w[:, np.newaxis], root_w * (2 * data['y'][train] - 1), rcond=None)[0]
+        np.testing.assert_allclose(expected, coefficients, rtol=1e-6)
+
+    def test_incremental(self) -> None:
+        update_statistics(load_sessions())
+        with open(join('data', 'chunks', 'a.json'), encoding='utf8') as source:
+            chunks = load(source)
+        chunks[0]['fixations']['count'] += 1
+        with open(join('data', 'chunks', 'a.json'), 'w') as target:
+            dump(chunks, target)
+        data = load_sessions()
+        statistics, updated = update_statistics(data)
+        self.assertEqual(1, updated)
+        for i, session_name in enumerate(data['names']):
+            for key in ['xx', 'xy']:
+                np.testing.assert_allclose(get_session_statistics(data, i)[key], statistics[session_name][key])
+        self.assertEqual(['a', 'b', 'c'], save_predictions(backend='incremental'))
+        with open(join('data', 'predictions', 'c.json'), encoding='utf8') as source:
+            self.assertEqual(40, len(load(source)['prediction']))
+
+    def test_compare_backends(self) -> None:
+        comparison = compare_backends()
+        self.assertEqual({'batch', 'incremental'}, set(comparison))
+        for scores in comparison.values():
+            self.assertEqual({'accuracy', 'precision', 'recall'}, set(scores))
+            self.assertGreater(scores['accuracy'], 0.8)
+        # Nothing that a later round reads is written
+        self.assertEqual(['chunks'], listdir('data'))
+
+
+if __name__ == '__main__':
+    unittest.main()
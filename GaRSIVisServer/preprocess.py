@@ -1,17 +1,23 @@
+from array import array
 from datetime import datetime
-from itertools import tee
+from functools import lru_cache
 from hashlib import md5
-from json import dumps, load
-from math import ceil, floor, sqrt, atan2, degrees
+from json import dump, dumps, load, loads
+from math import ceil, floor
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
 from operator import itemgetter
-from os import listdir, makedirs
+from os import listdir, makedirs, remove, stat
 from os.path import isdir, isfile, join, splitext
-from re import match
-from typing import Dict, List, TextIO, Tuple
+from shutil import rmtree
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
+import numpy as np
 from humanhash import humanize
 
-from smallestenclosingcircle import make_circle
+from features import MEASURES
+from smallestenclosingcircle import make_circles
 
 
 SOURCE_FOLDER = 'sessions'
@@ -22,20 +28,96 @@ SACCADE_FOLDER = join(RESULT_FOLDER, 'saccade')
 TIME_FOLDER = join(RESULT_FOLDER, 'time')
 COMBINED_FOLDER = join(RESULT_FOLDER, 'combined')
 PREPROCESSED_FOLDER = join(RESULT_FOLDER, 'preprocessed')
+CHUNK_FOLDER = join(RESULT_FOLDER, 'chunks')
+CHUNK_PARAMETER_FOLDER = join(CHUNK_FOLDER, 'parameters')
+CACHE_FOLDER = join(RESULT_FOLDER, 'cache')
+PREDICTION_FOLDER = join(RESULT_FOLDER, 'predictions')
+MANIFEST_FILE = join(RESULT_FOLDER, 'manifest.json')
+COMBINED_TIMES_FILE = 'times.json'
+
+PREPROCESS_VERSION = 8  # increase when the preprocessing results change
 
 T_I = 5000  # duration of interest in ms
 T_L = 0  # interruption lag
 T_R = 3000  # resumption lag in ms
-
-
-def pairwise(iterable):
-    """s -> (s0,s1), (s1,s2), (s2, s3), ..."""
-    a, b = tee(iterable)
-    next(b, None)
-    return zip(a, b)
+CIRCLE_SEED = 0  # seed for the randomized order of the smallest enclosing circle algorithm
+
+# Known event types, the index is the type code in the event columns
+EVENT_TYPES = ['OPEN', 'CLOSE', 'FOCUS', 'BLUR', 'ACTIVE', 'REASON', 'SCROLL', 'ZOOM', 'PDF',
+               'GAZE', 'FIXATIONSTART', 'FIXATIONDATA', 'FIXATIONEND', 'HEAD']
+# Event columns with their numpy type
+EVENT_COLUMNS = {
+    'timestamp': np.int64,
+    'type': np.uint8,
+    'x': np.float64,
+    'y': np.float64,
+    'rel_x': np.float32,
+    'rel_y': np.float32,
+    'text': np.int32,
+    'z': np.float32,
+    'rot_x': np.float32,
+    'rot_y': np.float32,
+    'rot_z': np.float32,
+}
+# Categories of the known event types in the preprocessing
+CATEGORY_NONE = 0
+CATEGORY_GAZE = 1
+CATEGORY_FIXATION_START = 2
+CATEGORY_FIXATION_DATA = 3
+CATEGORY_FIXATION_END = 4
+CATEGORY_OPEN = 5
+CATEGORY_BLUR = 6
+CATEGORY_FOCUS = 7
+CATEGORY_ACTIVE = 8
+CATEGORY_REASON = 9
+CATEGORY_SCROLL = 10
+EVENT_CATEGORIES = {
+    'GAZE': CATEGORY_GAZE,
+    'FIXATIONSTART': CATEGORY_FIXATION_START,
+    'FIXATIONDATA': CATEGORY_FIXATION_DATA,
+    'FIXATIONEND': CATEGORY_FIXATION_END,
+    'OPEN': CATEGORY_OPEN,
+    'BLUR': CATEGORY_BLUR,
+    'FOCUS': CATEGORY_FOCUS,
+    'ACTIVE': CATEGORY_ACTIVE,
+    'REASON': CATEGORY_REASON,
+    'SCROLL': CATEGORY_SCROLL,
+    'CLOSE': CATEGORY_NONE,
+    'ZOOM': CATEGORY_NONE,
+    'PDF': CATEGORY_NONE,
+    'HEAD': CATEGORY_NONE,
+}
+
+# Columns filled by gaze and fixation events and by head events
+POINT_COLUMNS = ['x', 'y', 'rel_x', 'rel_y']
+HEAD_COLUMNS = ['x', 'y', 'z', 'rot_x', 'rot_y', 'rot_z']
+# Columns of the combined results, each saved as a .npy file
+COMBINED_FIXATION_COLUMNS = ['start', 'end', 'circle', 'points', 'point_offsets']
+COMBINED_SACCADE_COLUMNS = ['start', 'end', 'origin', 'destination', 'length', 'radius_length', 'angle']
+
+
+@lru_cache(maxsize=1024)
+def parse_minute(minute: str) -> int:
+    """
+    Get the seconds since epoch of the start of a minute.
+    Like parse_timestamp, the time is interpreted as local time.
+    :param minute: Minute in the format YYYY-MM-DDTHH:MM
+    :return: Seconds since epoch
+    """
+    return int(datetime.strptime(minute, '%Y-%m-%dT%H:%M').timestamp())
 
 
 def parse_timestamp(timestamp: str) -> int:
+    """
+    Parse a GaRSILogger timestamp into milliseconds since epoch.
+    For timestamps of the form YYYY-MM-DDTHH:MM:SS.mmmZ, only seconds and milliseconds are parsed,
+    the minute is looked up in a cache. Results are the same as from datetime.timestamp().
+    :param timestamp: Timestamp in ISO 8601 format
+    :return: Milliseconds since epoch
+    """
+    if len(timestamp) == 24 and timestamp[16] == ':' and timestamp[19] == '.' and timestamp[23] == 'Z':
+        seconds = parse_minute(timestamp[:16]) + int(timestamp[17:19])
+        return int((seconds + int(timestamp[20:23]) / 1000) * 1000)
     date = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
     return int(date.timestamp() * 1000)
 
@@ -47,11 +129,13 @@ def parse_open_args(args: List[str]) -> Dict:
 
 
 def parse_scroll_args(args: List[str]) -> Dict:
+    px = args[0].split('->')
+    percent = args[1].split('->')
     return {
-        'px_before': float(args[0].split('->')[0]),
-        'px_after': float(args[0].split('->')[1]),
-        '%_before': float(args[1].split('->')[0][:-1]),
-        '%_after': float(args[1].split('->')[1][:-1]),
+        'px_before': float(px[0]),
+        'px_after': float(px[1]),
+        '%_before': float(percent[0][:-1]),
+        '%_after': float(percent[1][:-1]),
     }
 
 
@@ -85,54 +169,68 @@ def parse_reason_args(args: List[str]) -> Dict:
 
 
 def parse_fixation_args(args: List[str]) -> Dict:
+    position = args[0].split(',')
+    relative = args[1].split(',')
     return {
-        'x': float(args[0].split(',')[0]),
-        'y': float(args[0].split(',')[1]),
-        'rel_x': float(args[1].split(',')[0][:-1]),
-        'rel_y': float(args[1].split(',')[1][:-1]),
+        'x': float(position[0]),
+        'y': float(position[1]),
+        'rel_x': float(relative[0][:-1]),
+        'rel_y': float(relative[1][:-1]),
         'text': args[2]
     }
 
 
 def parse_head_args(args: List[str]) -> Dict:
+    position = args[0].split(',')
+    rotation = args[1].split(',')
     return {
-        'x': float(args[0].split(',')[0]),
-        'y': float(args[0].split(',')[1]),
-        'z': float(args[0].split(',')[2]),
-        'rot_x': float(args[1].split(',')[0]),
-        'rot_y': float(args[1].split(',')[1]),
-        'rot_z': float(args[1].split(',')[2])
+        'x': float(position[0]),
+        'y': float(position[1]),
+        'z': float(position[2]),
+        'rot_x': float(rotation[0]),
+        'rot_y': float(rotation[1]),
+        'rot_z': float(rotation[2])
     }
 
 
+# Args parser of each event type, events of other types have no args
+ARG_PARSERS = {
+    'OPEN': parse_open_args,
+    'SCROLL': parse_scroll_args,
+    'ZOOM': parse_zoom_args,
+    'ACTIVE': parse_active_args,
+    'REASON': parse_reason_args,
+    'GAZE': parse_fixation_args,
+    'FIXATIONSTART': parse_fixation_args,
+    'FIXATIONDATA': parse_fixation_args,
+    'FIXATIONEND': parse_fixation_args,
+    'HEAD': parse_head_args,
+}
+
+# Projection modes, events are either parsed with args, only with timestamp and type, or skipped
+PARSE_ARGS = 'args'
+PARSE_TIMESTAMP = 'timestamp'
+PARSE_SKIP = None
+
+# Projection of the events used by the preprocessing, other event types are only timestamped
+PREPROCESS_PROJECTION = {
+    'OPEN': PARSE_ARGS,
+    'SCROLL': PARSE_ARGS,
+    'ACTIVE': PARSE_ARGS,
+    'REASON': PARSE_ARGS,
+    'FIXATIONSTART': PARSE_ARGS,
+    'FIXATIONDATA': PARSE_ARGS,
+    'FIXATIONEND': PARSE_ARGS,
+}
+
+
 def parse_event_args(event_type: str, args: List[str]) -> Dict:
-    if event_type == 'OPEN':
-        return parse_open_args(args)
-    elif event_type == 'SCROLL':
-        return parse_scroll_args(args)
-    elif event_type == 'ZOOM':
-        return parse_zoom_args(args)
-    elif event_type == 'ACTIVE':
-        return parse_active_args(args)
-    elif event_type == 'REASON':
-        return parse_reason_args(args)
-    elif event_type == 'GAZE':
-        return parse_fixation_args(args)
-    elif event_type == 'FIXATIONSTART':
-        return parse_fixation_args(args)
-    elif event_type == 'FIXATIONDATA':
-        return parse_fixation_args(args)
-    elif event_type == 'FIXATIONEND':
-        return parse_fixation_args(args)
-    elif event_type == 'HEAD':
-        return parse_head_args(args)
-    else:
-        return {}
+    parser = ARG_PARSERS.get(event_type)
+    return parser(args) if parser else {}
 
 
 def parse_event(event: str) -> Dict:
-    event = event.strip()
-    sections = event.split('|')
+    sections = event.strip().split('|')
     if sections[2] != '[hidden]':
         return {
             'timestamp': parse_timestamp(sections[0]),
@@ -141,140 +239,219 @@ def parse_event(event: str) -> Dict:
         }
 
 
-def parse_session(session_file: TextIO) -> List:
-    return [parsed for parsed in (parse_event(line) for line in session_file) if parsed]
-
-
-def normalize_events(events: List) -> List:
+def new_event_columns() -> Dict:
     """
-    Normalize events with regard to the coordinates.
-    :param events: List of parsed events
-    :returns: List of normalized, parsed events
+    Create empty, growable event columns.
+    Timestamps and types are kept for all events, values only for the events that have them.
+    :returns: Event columns as compact arrays, with the type names and interned strings and their codes
     """
-    # zoom_factor = 1.0
-    scroll_offset = 0
-    for event in events:
-        if event['type'] == 'SCROLL':
-            scroll_offset = event['args']['px_after']
-        # elif event['type'] == 'ZOOM':
-        #     try:
-        #         factor_before = float(event['args']['factor_before'])
-        #         factor_after = float(event['args']['factor_after'])
-        #         zoom_factor *= factor_after / factor_before
-        #     except ValueError as _:
-        #         pass
-        elif event['type'].startswith('FIXATION') or event['type'] == 'GAZE':
-            if 'y' not in event['args']:
-                print(event)
-                exit()
-            event['args']['y'] += scroll_offset
-    return events
+    return {
+        'timestamp': array('q'),
+        'type': array('B'),
+        'point_rows': array('q'),
+        'point_values': array('d'),
+        'point_texts': array('i'),
+        'head_rows': array('q'),
+        'head_values': array('d'),
+        'types': list(EVENT_TYPES),
+        'strings': [],
+        'args': {},
+        'type_codes': {event_type: code for code, event_type in enumerate(EVENT_TYPES)},
+        'string_codes': {}
+    }
 
 
-def merge_fixations(events: List) -> List:
+def append_event(columns: Dict, timestamp: int, event_type: str, args: Dict) -> None:
     """
-    Merge fixation start, data, and end point events into fixation events with a duration.
-    :param events: List of parsed events of any type
-    :returns: List of merged fixation events
+    Append a parsed event to the event columns.
+    Coordinates, head pose, and gaze text are stored as columns, other args are kept by event index.
+    :param columns: Growable event columns from new_event_columns
+    :param timestamp: Timestamp of the event in ms
+    :param event_type: Type of the event
+    :param args: Parsed args of the event, empty if they were not parsed
     """
-    fixations = []
-    current_fixation = {
-        'start': None,
-        'end': None,
-        'points': [],
-        'circle': None
-    }
-    started = False
-    for event in events:
-        if event['type'] == 'FIXATIONSTART':
-            started = True
-            point = (event['args']['x'], event['args']['y'])
-            current_fixation['start'] = event['timestamp']
-            current_fixation['points'] = [point]
-        elif started and event['type'] == 'FIXATIONDATA':
-            point = (event['args']['x'], event['args']['y'])
-            current_fixation['points'].append(point)
-        elif started and event['type'] == 'FIXATIONEND':
-            started = False
-            current_fixation['end'] = event['timestamp']
-            point = (event['args']['x'], event['args']['y'])
-            current_fixation['points'].append(point)
-            circle = [round(c, 2) for c in make_circle(current_fixation['points'])]
-            current_fixation['circle'] = circle
-            fixations.append(current_fixation)
-            current_fixation = {}
-    return fixations
+    if event_type not in columns['type_codes']:
+        columns['type_codes'][event_type] = len(columns['types'])
+        columns['types'].append(event_type)
+    row = len(columns['timestamp'])
+    columns['timestamp'].append(timestamp)
+    columns['type'].append(columns['type_codes'][event_type])
+    if not args:
+        return
+    if 'text' in args:
+        if args['text'] not in columns['string_codes']:
+            columns['string_codes'][args['text']] = len(columns['strings'])
+            columns['strings'].append(args['text'])
+        columns['point_rows'].append(row)
+        columns['point_values'].extend((args['x'], args['y'], args['rel_x'], args['rel_y']))
+        columns['point_texts'].append(columns['string_codes'][args['text']])
+    elif 'z' in args:
+        columns['head_rows'].append(row)
+        columns['head_values'].extend((args['x'], args['y'], args['z'], args['rot_x'], args['rot_y'], args['rot_z']))
+    else:
+        columns['args'][row] = args
 
 
-def bin_events(events: List, start: int, end: int) -> List:
+def finish_event_columns(columns: Dict) -> Dict:
     """
-    Bin the given events by second.
-    :param events: List of events with start and end
-    :param start: Start of the event time, corresponds to bin 0
-    :param end: End of the event time, corresponds to the last bin
-    :return:
+    Turn growable event columns into numpy arrays.
+    Columns of events without the respective value are NaN, or -1 for the text.
+    :param columns: Growable event columns from new_event_columns
+    :returns: Event columns as numpy arrays, with the type names, interned strings, and other args
     """
-    end_s = int(ceil((end - start) / 1000))
-    bins = [[] for _ in range(end_s)]
-    for event in events:
-        time_s = int(floor((event['start'] + (event['end'] - event['start']) / 2 - start) / 1000))
-        bins[time_s].append(event)
-    return bins
+    length = len(columns['timestamp'])
+    events = {name: np.full(length, -1 if name == 'text' else np.nan, dtype=dtype)
+              for name, dtype in EVENT_COLUMNS.items() if name not in ['timestamp', 'type']}
+    events['timestamp'] = np.frombuffer(columns['timestamp'], dtype=np.int64) if length else np.empty(0, np.int64)
+    events['type'] = np.frombuffer(columns['type'], dtype=np.uint8) if length else np.empty(0, np.uint8)
+    for prefix, names in [('point', POINT_COLUMNS), ('head', HEAD_COLUMNS)]:
+        rows = np.frombuffer(columns[prefix + '_rows'], dtype=np.int64) if len(columns[prefix + '_rows']) else []
+        values = np.frombuffer(columns[prefix + '_values'], dtype=np.float64).reshape(-1, len(names)) \
+            if len(rows) else np.empty((0, len(names)))
+        for i, name in enumerate(names):
+            events[name][rows] = values[:, i]
+    if len(columns['point_texts']):
+        events['text'][np.frombuffer(columns['point_rows'], dtype=np.int64)] = columns['point_texts']
+    events['types'] = columns['types']
+    events['strings'] = columns['strings']
+    events['args'] = columns['args']
+    return events
 
 
-def bin_fixations(fixations: List) -> List:
+def parse_session(session_file: TextIO, projection: Dict[str, Optional[str]] = None) -> Dict:
     """
-    Bin fixations by second.
-    :param fixations: List of merged fixation events
-    :return: List of fixations per second
+    Parse the events of a session into columns.
+    Each line is split once, the args are only parsed for the event types that need them.
+    :param session_file: Raw session file
+    :param projection: Projection mode by event type, types not in it are only timestamped.
+                       All events are parsed with args if no projection is given.
+    :returns: Event columns
     """
-    return bin_events(fixations, fixations[0]['start'], fixations[-1]['end'])
+    columns = new_event_columns()
+    no_args = {}
+    for line in session_file:
+        sections = line.strip().split('|')
+        if sections[2] == '[hidden]':
+            continue
+        event_type = sections[1]
+        mode = projection.get(event_type, PARSE_TIMESTAMP) if projection is not None else PARSE_ARGS
+        if mode == PARSE_SKIP:
+            continue
+        parser = ARG_PARSERS.get(event_type) if mode == PARSE_ARGS else None
+        args = parser(sections[2].split(';')) if parser else no_args
+        append_event(columns, parse_timestamp(sections[0]), event_type, args)
+    return finish_event_columns(columns)
+
+
+def has_values(column: np.ndarray) -> bool:
+    """
+    Check whether an event column has any value.
+    :param column: Event column
+    :returns: Whether any value is not NaN, or not -1 for integer columns
+    """
+    if column.dtype.kind == 'f':
+        return not np.isnan(column).all()
+    return column.dtype != np.int32 or bool((column != -1).any())
 
 
-def get_saccades(fixations: List) -> List:
+def get_event_args(events: Dict, index: int) -> Dict:
     """
-    Calculate saccades from merged fixation events.
-    :param fixations: List of merged fixation events
-    :return: List of saccade events
+    Get the args of a single event as they were parsed.
+    :param events: Event columns
+    :param index: Index of the event
+    :returns: Args of the event
     """
-    saccades = []
-    for fixation, next_fixation in pairwise(fixations):
-        o_x, o_y = fixation['circle'][0], fixation['circle'][1]
-        d_x, d_y = next_fixation['circle'][0], next_fixation['circle'][1]
-        center_distance = sqrt((o_x - d_x) ** 2 + (o_y - d_y) ** 2)
-        radius_distance = center_distance - fixation['circle'][2] - next_fixation['circle'][2]
-        angle = atan2(d_y - o_y, d_x - o_x)
-        saccades.append({
-            'start': fixation['end'],
-            'end': next_fixation['start'],
-            'origin': (o_x, o_y),
-            'destination': (d_x, d_y),
-            'length': center_distance,
-            'radius_length': radius_distance,
-            'angle': degrees(angle)
-        })
-    return saccades
+    if index in events['args']:
+        return events['args'][index]
+    if np.isnan(events['x'][index]):
+        return {}
+    if np.isnan(events['z'][index]):
+        return {
+            'x': float(events['x'][index]),
+            'y': float(events['y'][index]),
+            'rel_x': float(events['rel_x'][index]),
+            'rel_y': float(events['rel_y'][index]),
+            'text': events['strings'][events['text'][index]]
+        }
+    return {
+        'x': float(events['x'][index]),
+        'y': float(events['y'][index]),
+        'z': float(events['z'][index]),
+        'rot_x': float(events['rot_x'][index]),
+        'rot_y': float(events['rot_y'][index]),
+        'rot_z': float(events['rot_z'][index])
+    }
 
 
-def bin_saccades(saccades: List, fixations: List) -> List:
+def get_event_categories(events: Dict) -> np.ndarray:
     """
-    Bin saccades by second
-    :param saccades: List of saccade events to be binned
-    :param fixations: List of fixation events, required for the time context
-    :return: List of saccades per second
+    Get the preprocessing category of each event.
+    Event types that are not known, e.g. of a newer logger, are ignored.
+    :param events: Event columns
+    :returns: Category code of each event
     """
-    return bin_events(saccades, fixations[0]['start'], fixations[-1]['end'])
+    categories = [EVENT_CATEGORIES.get(t, CATEGORY_NONE) for t in events['types']]
+    return np.array(categories, dtype=np.uint8)[events['type']]
 
 
-def classify_times(events: List) -> Tuple[List, List]:
+def preprocess_events(events: Dict) -> Tuple[List, List, List]:
     """
-    Classify the time segments of a list of events.
-    The first and last couple of events are stripped.
-    Times of interest before an interruption are marked.
-    The time after an interruptions until reading is resumed is stripped.
-    :param events: List of parsed events
-    :returns: List of time durations with classification
+    Normalize, merge fixations, and classify times in a single pass over the events.
+    Only fixations are normalized by the scroll offset, the events are not changed.
+    Fixations are grouped on the columns, so the pass only visits the events that change the reading state.
+    Gaze events in between only matter through the last one that is not ignored.
+    :param events: Parsed event columns
+    :returns: List of merged, normalized fixation events, list of ignored times, and list of interruptions
     """
+    categories = get_event_categories(events)
+    timestamps = events['timestamp']
+    first_timestamp = int(timestamps[0])
+    last_timestamp = int(timestamps[-1])
+
+    # Scroll offset of each fixation event is the offset after the last scroll event before it
+    scroll_indices = np.flatnonzero(categories == CATEGORY_SCROLL)
+    scroll_offsets = np.zeros(len(scroll_indices) + 1)
+    scroll_offsets[1:] = [events['args'][i]['px_after'] for i in scroll_indices.tolist()]
+    fixation_indices = np.flatnonzero((categories >= CATEGORY_FIXATION_START) & (categories <= CATEGORY_FIXATION_END))
+    fixation_categories = categories[fixation_indices]
+    fixation_xs = events['x'][fixation_indices]
+    fixation_ys = events['y'][fixation_indices] + \
+        scroll_offsets[np.searchsorted(scroll_indices, fixation_indices, side='right')]
+    xs = fixation_xs.tolist()
+    ys = fixation_ys.tolist()
+
+    # A fixation ends with an end event and starts with the last start event before it,
+    # if there was no other end event in between
+    starts = np.flatnonzero(fixation_categories == CATEGORY_FIXATION_START)
+    ends = np.flatnonzero(fixation_categories == CATEGORY_FIXATION_END)
+    last_starts = starts[np.searchsorted(starts, ends) - 1] if len(starts) else np.empty(0, dtype=np.int64)
+    previous_ends = np.concatenate([[-1], ends[:-1]])
+    valid = (np.searchsorted(starts, ends) > 0) & (last_starts > previous_ends)
+    last_starts = last_starts[valid]
+    ends = ends[valid]
+    # Circles of all fixations at once, from the points of each fixation concatenated
+    lengths = ends - last_starts + 1
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    point_indices = np.repeat(last_starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    circles = make_circles(fixation_xs[point_indices], fixation_ys[point_indices], offsets, seed=CIRCLE_SEED).tolist()
+    fixation_timestamps = timestamps[fixation_indices].tolist()
+    fixations = []
+    for start, end, circle in zip(last_starts.tolist(), ends.tolist(), circles):
+        points = list(zip(xs[start:end + 1], ys[start:end + 1]))
+        fixations.append({
+            'start': fixation_timestamps[start],
+            'end': fixation_timestamps[end],
+            'points': points,
+            'circle': [round(c, 2) for c in circle]
+        })
+
+    gaze_indices = np.flatnonzero((categories >= CATEGORY_GAZE) & (categories <= CATEGORY_FIXATION_END))
+    gaze_timestamps = timestamps[gaze_indices]
+    state_indices = np.flatnonzero(categories >= CATEGORY_OPEN)
+    state_indices = state_indices[categories[state_indices] != CATEGORY_SCROLL]
+    # Gaze events between two state events, the last state "event" is the end of the session
+    gaze_bounds = np.searchsorted(gaze_indices, np.append(state_indices, len(categories))).tolist()
+
     last_gaze_timestamp = None
     ignoring_until = None
     reason = None
@@ -282,29 +459,38 @@ def classify_times(events: List) -> Tuple[List, List]:
     ignored_times = []
     interruptions = []
     state = 'before'
-    for event in events:
-        if event['type'] == 'OPEN':
+    gaze_start = 0
+    for index, category, timestamp, gaze_end in zip(state_indices.tolist() + [None],
+                                                    categories[state_indices].tolist() + [CATEGORY_NONE],
+                                                    timestamps[state_indices].tolist() + [None], gaze_bounds):
+        if state == 'reading' and gaze_start < gaze_end:
+            if not ignoring_until or ignoring_until < gaze_timestamps[gaze_end - 1]:
+                last_gaze_timestamp = int(gaze_timestamps[gaze_end - 1])
+            else:
+                not_ignored = np.flatnonzero(gaze_timestamps[gaze_start:gaze_end] > ignoring_until)
+                if len(not_ignored):
+                    last_gaze_timestamp = int(gaze_timestamps[gaze_start + not_ignored[-1]])
+        gaze_start = gaze_end
+
+        if category == CATEGORY_OPEN:
             # If this is the first OPEN, ignore everything before
             # Otherwise only ignore time since the last gaze
-            ignoring_until = event['timestamp'] + T_R
+            ignoring_until = timestamp + T_R
             ignored_times.append({
-                'start': last_gaze_timestamp if last_gaze_timestamp else events[0]['timestamp'],
+                'start': last_gaze_timestamp if last_gaze_timestamp else first_timestamp,
                 'end': ignoring_until,
                 'class': "stripped",
                 'comment': "Before and shortly after open"
             })
             state = 'reading'
-        elif state == 'reading' and match('(?:GAZE|FIXATION)', event['type']):
-            if not ignoring_until or ignoring_until < event['timestamp']:
-                last_gaze_timestamp = event['timestamp']
-        elif state == 'reading' and event['type'] == 'BLUR':
+        elif state == 'reading' and category == CATEGORY_BLUR:
             state = 'blurred'
-        elif state == 'blurred' and event['type'] == 'ACTIVE':
-            active_windows.append(event['args'])
-        elif event['type'] == 'REASON':
-            reason = event['args']['reason']
-        elif state == 'blurred' and event['type'] == 'FOCUS':
-            ignoring_until = event['timestamp'] + T_R
+        elif state == 'blurred' and category == CATEGORY_ACTIVE:
+            active_windows.append(events['args'][index])
+        elif category == CATEGORY_REASON:
+            reason = events['args'][index]['reason']
+        elif state == 'blurred' and category == CATEGORY_FOCUS:
+            ignoring_until = timestamp + T_R
             if last_gaze_timestamp:
                 if reason == 'interruption':  # ext. interruptions don't affect previous gazes
                     classification = "normal"
@@ -336,13 +522,194 @@ def classify_times(events: List) -> Tuple[List, List]:
             state = 'reading'
     ignored_times.append({
         'start': max((last_gaze_timestamp or 0) - T_R, ignored_times[-1]['end']),
-        'end': events[-1]['timestamp'],
+        'end': last_timestamp,
         'class': "stripped",
         'comment': "Ignore last gazes"
     })
 
     ignored_times.sort(key=itemgetter('start'))
-    return merge_overlapping_times(ignored_times), interruptions
+    return fixations, merge_overlapping_times(ignored_times), interruptions
+
+
+def bin_events(events: List, start: int, end: int) -> List:
+    """
+    Bin the given events by second.
+    :param events: List of events with start and end
+    :param start: Start of the event time, corresponds to bin 0
+    :param end: End of the event time, corresponds to the last bin
+    :return:
+    """
+    end_s = int(ceil((end - start) / 1000))
+    bins = [[] for _ in range(end_s)]
+    for event in events:
+        time_s = int(floor((event['start'] + (event['end'] - event['start']) / 2 - start) / 1000))
+        bins[time_s].append(event)
+    return bins
+
+
+def bin_fixations(fixations: List) -> List:
+    """
+    Bin fixations by second.
+    :param fixations: List of merged fixation events
+    :return: List of fixations per second
+    """
+    return bin_events(fixations, fixations[0]['start'], fixations[-1]['end'])
+
+
+def get_fixation_columns(fixations: List) -> Dict:
+    """
+    Get the start, end, circle, and points of merged fixation events as columns.
+    :param fixations: List of merged fixation events
+    :return: Dict with start and end arrays, circle array with one row of x, y, and radius per fixation,
+        and points array with one row of x and y per point, where the points of fixation i are the rows
+        point_offsets[i] to point_offsets[i + 1]
+    """
+    return {
+        'start': np.array([fixation['start'] for fixation in fixations], dtype=np.int64),
+        'end': np.array([fixation['end'] for fixation in fixations], dtype=np.int64),
+        'circle': np.array([fixation['circle'] for fixation in fixations], dtype=np.float64).reshape(-1, 3),
+        'points': np.array([point for fixation in fixations for point in fixation['points']],
+                           dtype=np.float64).reshape(-1, 2),
+        'point_offsets': np.cumsum([0] + [len(fixation['points']) for fixation in fixations], dtype=np.int64)
+    }
+
+
+def get_saccade_columns(fixation_columns: Dict) -> Dict:
+    """
+    Calculate saccades between consecutive fixations as columns.
+    :param fixation_columns: Fixation columns as returned by get_fixation_columns
+    :return: Dict with start, end, origin, destination, length, radius_length, and angle arrays
+    """
+    circles = fixation_columns['circle']
+    origins = circles[:-1]
+    destinations = circles[1:]
+    d_x = destinations[:, 0] - origins[:, 0]
+    d_y = destinations[:, 1] - origins[:, 1]
+    center_distances = np.sqrt(d_x * d_x + d_y * d_y)
+    return {
+        'start': fixation_columns['end'][:-1],
+        'end': fixation_columns['start'][1:],
+        'origin': origins[:, :2],
+        'destination': destinations[:, :2],
+        'length': center_distances,
+        'radius_length': center_distances - origins[:, 2] - destinations[:, 2],
+        'angle': np.degrees(np.arctan2(d_y, d_x))
+    }
+
+
+def get_saccade_events(saccade_columns: Dict) -> List:
+    """
+    Convert saccade columns to a list of saccade events, as saved in the combined results.
+    :param saccade_columns: Saccade columns as returned by get_saccade_columns
+    :return: List of saccade events
+    """
+    return [{
+        'start': start,
+        'end': end,
+        'origin': tuple(origin),
+        'destination': tuple(destination),
+        'length': length,
+        'radius_length': radius_length,
+        'angle': angle
+    } for start, end, origin, destination, length, radius_length, angle in zip(
+        saccade_columns['start'].tolist(),
+        saccade_columns['end'].tolist(),
+        saccade_columns['origin'].tolist(),
+        saccade_columns['destination'].tolist(),
+        saccade_columns['length'].tolist(),
+        saccade_columns['radius_length'].tolist(),
+        saccade_columns['angle'].tolist()
+    )]
+
+
+def get_saccades(fixations: List) -> List:
+    """
+    Calculate saccades from merged fixation events.
+    :param fixations: List of merged fixation events
+    :return: List of saccade events
+    """
+    return get_saccade_events(get_saccade_columns(get_fixation_columns(fixations)))
+
+
+def get_relative_seconds_array(columns: Dict, start: int) -> np.ndarray:
+    """
+    Get the middle of events as seconds relative to the start, the second a chunk counts the event in.
+    :param columns: Event columns with start and end as absolute ms
+    :param start: Absolute ms as offset
+    :return: Array of seconds of the middle of the events, relative to start
+    """
+    starts = columns['start']
+    return np.floor((starts + (columns['end'] - starts) / 2 - start) / 1000).astype(np.int64)
+
+
+def get_second_index(fixation_columns: Dict, saccade_columns: Dict) -> Dict[str, np.ndarray]:
+    """
+    Build the per-second index of a session, to calculate the features of any time window without the events.
+    The events are counted in the second of their middle, relative to the start of the first fixation.
+    For each event type, <event>_count_prefix holds the number of events before each second.
+    As the events are ordered in time, the events in seconds [a, b) are the events count_prefix[a] to count_prefix[b].
+    For each measure, <measure>_sum_prefix and <measure>_sumsq_prefix hold the sums of the values and squared
+    values before each second, shifted by <measure>_shift for numerical stability, and <measure>_sorted holds
+    the values sorted within each second for order statistics.
+    :param fixation_columns: Fixation columns as returned by get_fixation_columns
+    :param saccade_columns: Saccade columns as returned by get_saccade_columns
+    :return: Dict of index arrays
+    """
+    start = int(fixation_columns['start'][0])
+    length = int(ceil((int(fixation_columns['end'][-1]) - start) / 1000))
+    events = {
+        'fixation': fixation_columns,
+        'saccade': saccade_columns
+    }
+    index = {}
+    seconds = {}
+    for event, columns in events.items():
+        seconds[event] = get_relative_seconds_array(columns, start)
+        index[event + '_count_prefix'] = np.searchsorted(seconds[event], np.arange(length + 1))
+    for measure, (event, values) in sorted(get_index_measures(fixation_columns, saccade_columns).items()):
+        shift = values.mean() if len(values) else 0.0
+        shifted = np.concatenate([[0.0], values - shift])
+        # Sums before second s are the sums of the shifted values of all events before count_prefix[s]
+        prefix = index[event + '_count_prefix']
+        index[measure + '_shift'] = np.array(shift)
+        index[measure + '_sum_prefix'] = np.cumsum(shifted)[prefix]
+        index[measure + '_sumsq_prefix'] = np.cumsum(shifted * shifted)[prefix]
+        index[measure + '_sorted'] = values[np.lexsort((values, seconds[event]))]
+    return index
+
+
+def get_index_measures(fixation_columns: Dict, saccade_columns: Dict) -> Dict[str, Tuple[str, np.ndarray]]:
+    """
+    Get the measures of the per-second index, all measures of the feature registry.
+    :param fixation_columns: Fixation columns with start and end
+    :param saccade_columns: Saccade columns with start, end, length, and angle
+    :return: Dict of measure name to event type and values
+    """
+    columns = {'fixation': fixation_columns, 'saccade': saccade_columns}
+    return {measure['name']: (measure['event'], measure['value'](columns[measure['event']])) for measure in MEASURES}
+
+
+def bin_saccades(saccades: List, fixations: List) -> List:
+    """
+    Bin saccades by second
+    :param saccades: List of saccade events to be binned
+    :param fixations: List of fixation events, required for the time context
+    :return: List of saccades per second
+    """
+    return bin_events(saccades, fixations[0]['start'], fixations[-1]['end'])
+
+
+def classify_times(events: Dict) -> Tuple[List, List]:
+    """
+    Classify the time segments of a list of events, see preprocess_events.
+    The first and last couple of events are stripped.
+    Times of interest before an interruption are marked.
+    The time after an interruptions until reading is resumed is stripped.
+    :param events: Parsed event columns
+    :returns: List of time durations with classification
+    """
+    _, ignored_times, interruptions = preprocess_events(events)
+    return ignored_times, interruptions
 
 
 def merge_overlapping_times(ignored_times: List) -> List:
@@ -419,6 +786,15 @@ def get_relative_interruptions(interruptions: List, fixations_start: int) -> Lis
 
 
 # Meta file operations
+def get_reading_id(session_file: str) -> str:
+    """
+    Get the humanized reading id of a session file.
+    :param session_file: Name of the session file, without extension
+    :return: Humanized reading id
+    """
+    return humanize(md5(bytes(session_file, 'utf-8')).hexdigest(), words=2)
+
+
 def list_sessions() -> None:
     """
     List the session files and save the list of hashed ids.
@@ -429,17 +805,19 @@ def list_sessions() -> None:
         user_folder_path = join(SOURCE_FOLDER, user_folder)
         session_files = [f for f in listdir(user_folder_path) if isfile(join(user_folder_path, f))]
         for session_file in session_files:
-            session_file = splitext(session_file)[0]
-            reading_id = humanize(md5(bytes(session_file, 'utf-8')).hexdigest(), words=2)
-            sessions.append(reading_id)
+            sessions.append(get_reading_id(splitext(session_file)[0]))
     sessions.sort()
     with open(join(RESULT_FOLDER, 'list.json'), 'w') as list_file:
         print(dumps(sessions, indent=2), file=list_file)
 
 
-def setup_state() -> None:
+def setup_state(reset_predictions: bool = False) -> None:
     """
     Generate the default state.
+    The chunk size and the flags of sessions in an existing state are kept.
+    If sessions were added, removed, or changed, the training sessions of every other session changed,
+    so the predictions of all sessions in an existing state are invalid.
+    :param reset_predictions: Whether any session was added, removed, or changed
     """
     with open(join(RESULT_FOLDER, 'list.json'), encoding='utf-8') as list_file:
         sessions = load(list_file)
@@ -450,10 +828,20 @@ def setup_state() -> None:
         'prediction': {},
         'prediction_summary': True
     }
+    previous_state = state
+    reset = False
+    if isfile(join(RESULT_FOLDER, 'state.json')):
+        with open(join(RESULT_FOLDER, 'state.json'), encoding='utf-8') as state_file:
+            previous_state = load(state_file)
+        state['chunk_size'] = previous_state['chunk_size']
+        state['prediction_summary'] = previous_state['prediction_summary']
+        reset = reset_predictions or set(sessions) != set(previous_state['prediction'])
     for session in sessions:
-        state['ignored'][session] = True
-        state['chunks'][session] = True
-        state['prediction'][session] = True
+        state['ignored'][session] = previous_state['ignored'].get(session, True)
+        state['chunks'][session] = previous_state['chunks'].get(session, True)
+        state['prediction'][session] = previous_state['prediction'].get(session, True) and not reset
+    if reset:
+        state['prediction_summary'] = False
 
     with open(join(RESULT_FOLDER, 'state.json'), 'w') as state_file:
         print(dumps(state, indent=2), file=state_file)
@@ -471,7 +859,7 @@ def map_ids() -> None:
         for session_file in session_files:
             user_id = humanize(md5(bytes(user_folder, 'utf-8')).hexdigest(), words=1)
             session_file = splitext(session_file)[0]
-            reading_id = humanize(md5(bytes(session_file, 'utf-8')).hexdigest(), words=2)
+            reading_id = get_reading_id(session_file)
             sessions.append({
                 'user': user_folder,
                 'user_id': user_id,
@@ -482,62 +870,234 @@ def map_ids() -> None:
         print(dumps(sessions, indent=2), file=list_file)
 
 
+# Manifest operations
+def get_parameters() -> Dict:
+    """
+    Get the parameters that affect the preprocessing results.
+    :return: Parameters by name
+    """
+    return {
+        'T_I': T_I,
+        'T_L': T_L,
+        'T_R': T_R,
+        'version': PREPROCESS_VERSION,
+        'measures': [measure['name'] for measure in MEASURES]
+    }
+
+
+def hash_file(path: str) -> str:
+    """
+    Hash the content of a file.
+    :param path: Path of the file
+    :return: Hex digest of the file content
+    """
+    file_hash = md5()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def read_manifest() -> Dict:
+    """
+    Read the manifest of the last preprocessing run.
+    :return: Manifest with parameters and session entries, empty if there was no run
+    """
+    if not isfile(MANIFEST_FILE):
+        return {
+            'parameters': None,
+            'sessions': {}
+        }
+    with open(MANIFEST_FILE, encoding='utf8') as manifest_file:
+        return load(manifest_file)
+
+
+def save_manifest(manifest: Dict) -> None:
+    """
+    Save the manifest of the current preprocessing run.
+    :param manifest: Manifest with parameters and session entries
+    """
+    with open(MANIFEST_FILE, 'w') as manifest_file:
+        print(dumps(manifest, indent=2, sort_keys=True), file=manifest_file)
+
+
+def get_manifest_entry(user_folder: str, session_file: str, previous: Dict) -> Tuple[Dict, bool]:
+    """
+    Get the manifest entry of a raw session file and check whether it changed.
+    The content is only hashed if size or modification time differ from the previous entry.
+    :param user_folder: Name of the user folder in the source folder
+    :param session_file: Name of the session file in the user folder
+    :param previous: Entry of the previous run or None
+    :return: Entry with session id, size, mtime, and hash, and whether the session has to be processed
+    """
+    path = join(SOURCE_FOLDER, user_folder, session_file)
+    file_stat = stat(path)
+    entry = {
+        'session': get_reading_id(splitext(session_file)[0]),
+        'size': file_stat.st_size,
+        'mtime': file_stat.st_mtime_ns,
+        'hash': None
+    }
+    outputs_exist = all(isfile(result_file) for result_file in get_result_files(entry['session']))
+    if previous and outputs_exist and previous['size'] == entry['size'] and previous['mtime'] == entry['mtime']:
+        return previous, False
+    entry['hash'] = hash_file(path)
+    return entry, not previous or not outputs_exist or previous['hash'] != entry['hash']
+
+
+def get_result_files(session_id: str) -> List[str]:
+    """
+    Get the paths of the preprocessing results of a session.
+    :param session_id: Humanized reading id of the session
+    :return: List of result file paths
+    """
+    return [
+        join(PARSED_FOLDER, session_id + '.npz'),
+        join(get_combined_folder(session_id), COMBINED_TIMES_FILE),
+        join(PREPROCESSED_FOLDER, session_id + '.json')
+    ]
+
+
+def remove_session_outputs(session_id: str) -> None:
+    """
+    Remove all results of a session whose raw file was deleted.
+    :param session_id: Humanized reading id of the session
+    """
+    result_files = get_result_files(session_id) + [
+        join(COMBINED_FOLDER, session_id + '.json'),
+        join(PREDICTION_FOLDER, session_id + '.json')
+    ]
+    for path in result_files:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+    rmtree(get_combined_folder(session_id), ignore_errors=True)
+    remove_chunks(session_id)
+
+
+def remove_chunks(session_id: str) -> None:
+    """
+    Remove the chunks currently used, their parameters, and the cached chunks of a session, e.g. after its results
+    changed, so no features of the previous events are reused.
+    :param session_id: Humanized reading id of the session
+    """
+    for path in [join(CHUNK_FOLDER, session_id + '.json'), join(CHUNK_PARAMETER_FOLDER, session_id + '.json')]:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+    rmtree(join(CACHE_FOLDER, session_id), ignore_errors=True)
+
+
 # IO operations
-def read_sessions() -> List:
+def iter_session_files() -> Iterator[Tuple[str, str]]:
     """
-    Read the raw sessions, parse and normalize the events.
-    :returns: List of parsed, normalized sessions
+    Find the raw session files.
+    :returns: Iterator of user folder and session file name pairs
     """
-    sessions = []
     user_folders = [f for f in listdir(SOURCE_FOLDER) if isdir(join(SOURCE_FOLDER, f))]
     for user_folder in user_folders:
         user_folder_path = join(SOURCE_FOLDER, user_folder)
         session_files = [f for f in listdir(user_folder_path) if isfile(join(user_folder_path, f))]
         for session_file in session_files:
-            with open(join(user_folder_path, session_file), encoding='utf8') as reading_file:
-                user_id = humanize(md5(bytes(user_folder, 'utf-8')).hexdigest(), words=1)
-                session_file = splitext(session_file)[0]
-                reading_id = humanize(md5(bytes(session_file, 'utf-8')).hexdigest(), words=2)
-                sessions.append({
-                    'user': user_id,
-                    'file': reading_id,
-                    'events': normalize_events(parse_session(reading_file))
-                })
-    return sessions
+            yield user_folder, session_file
+
+
+def read_session(user_folder: str, session_file: str) -> Dict:
+    """
+    Read a single raw session and parse the events.
+    The coordinates are normalized later, in preprocess_events.
+    :param user_folder: Name of the user folder in the source folder
+    :param session_file: Name of the session file in the user folder
+    :returns: Parsed session
+    """
+    with open(join(SOURCE_FOLDER, user_folder, session_file), encoding='utf8') as reading_file:
+        user_id = humanize(md5(bytes(user_folder, 'utf-8')).hexdigest(), words=1)
+        reading_id = get_reading_id(splitext(session_file)[0])
+        return {
+            'user': user_id,
+            'file': reading_id,
+            'events': parse_session(reading_file, PREPROCESS_PROJECTION)
+        }
+
+
+def read_sessions() -> Iterator[Dict]:
+    """
+    Read the raw sessions one at a time and parse the events.
+    Only the session currently being consumed is held in memory.
+    :returns: Iterator of parsed sessions
+    """
+    for user_folder, session_file in iter_session_files():
+        yield read_session(user_folder, session_file)
 
 
-def save_parsed(sessions: List) -> None:
+def save_parsed_session(session: Dict) -> None:
+    """
+    Save a single parsed session.
+    Columns without any value, e.g. of event types that were only timestamped, are not saved.
+    :param session: Parsed session
+    """
+    try:
+        makedirs(PARSED_FOLDER)
+    except FileExistsError:
+        pass
+    parsed_filename = session['file'] + '.npz'
+    events = session['events']
+    np.savez(join(PARSED_FOLDER, parsed_filename), meta=np.array(dumps({
+        'user': session['user'],
+        'file': session['file'],
+        'types': events['types'],
+        'strings': events['strings'],
+        'args': sorted(events['args'].items())
+    })), **{name: events[name] for name in EVENT_COLUMNS if has_values(events[name])})
+
+
+def save_parsed(sessions: Iterable) -> None:
     """
     Save the parsed sessions.
-    :param sessions: List of parsed sessions
+    :param sessions: Iterable of parsed sessions
     """
     for session in sessions:
-        try:
-            makedirs(PARSED_FOLDER)
-        except FileExistsError:
-            pass
-        parsed_filename = session['file'] + '.json'
-        with open(join(PARSED_FOLDER, parsed_filename), 'w') as target:
-            print(dumps(session, indent=2), file=target)
+        save_parsed_session(session)
 
 
-def read_parsed() -> List:
+def read_parsed_session(session_file: str) -> Dict:
     """
-    Read the parsed sessions.
-    :returns: List of parsed, normalized sessions
+    Read a single parsed session.
+    :param session_file: Name of the parsed session file
+    :returns: Parsed session
+    """
+    with np.load(join(PARSED_FOLDER, session_file)) as parsed_file:
+        meta = loads(str(parsed_file['meta']))
+        length = len(parsed_file['timestamp'])
+        events = {name: parsed_file[name] if name in parsed_file else
+                  np.full(length, -1 if name == 'text' else np.nan, dtype=dtype)
+                  for name, dtype in EVENT_COLUMNS.items()}
+    events['types'] = meta['types']
+    events['strings'] = meta['strings']
+    events['args'] = {index: args for index, args in meta['args']}
+    return {
+        'user': meta['user'],
+        'file': meta['file'],
+        'events': events
+    }
+
+
+def read_parsed() -> Iterator[Dict]:
+    """
+    Read the parsed sessions one at a time.
+    :returns: Iterator of parsed sessions
     """
-    sessions = []
     session_files = [f for f in listdir(PARSED_FOLDER) if isfile(join(PARSED_FOLDER, f))]
     for session_file in session_files:
-        with open(join(PARSED_FOLDER, session_file), encoding='utf8') as parsed_file:
-            sessions.append(load(parsed_file))
-    return sessions
+        yield read_parsed_session(session_file)
 
 
-def save_fixations(sessions: List) -> None:
+def save_fixations(sessions: Iterable) -> None:
     """
     Save the merged fixations.
-    :param sessions: List of parsed sessions
+    :param sessions: Iterable of parsed sessions
     """
     for session in sessions:
         try:
@@ -549,7 +1109,7 @@ def save_fixations(sessions: List) -> None:
             print(dumps({
                 'user': session['user'],
                 'file': session['file'],
-                'fixations': merge_fixations(session['events'])
+                'fixations': preprocess_events(session['events'])[0]
             }, indent=2), file=target)
 
 
@@ -566,10 +1126,10 @@ def read_fixations() -> List:
     return sessions
 
 
-def save_times(sessions: List) -> None:
+def save_times(sessions: Iterable) -> None:
     """
     Save the classified times.
-    :param sessions: List of parsed sessions
+    :param sessions: Iterable of parsed sessions
     """
     for session in sessions:
         try:
@@ -578,7 +1138,7 @@ def save_times(sessions: List) -> None:
             pass
         parsed_filename = session['file'] + '.json'
         with open(join(TIME_FOLDER, parsed_filename), 'w') as target:
-            ignored, interruptions = classify_times(session['events'])
+            _, ignored, interruptions = preprocess_events(session['events'])
             print(dumps({
                 'user': session['user'],
                 'file': session['file'],
@@ -600,52 +1160,266 @@ def read_times() -> List:
     return sessions
 
 
-def main() -> None:
+def get_combined_folder(session_id: str) -> str:
+    """
+    Get the folder of the combined results of a session.
+    :param session_id: Humanized reading id of the session
+    :returns: Path of the folder with a .npy file per column and the times file
+    """
+    return join(COMBINED_FOLDER, session_id)
+
+
+def save_combined(session_id: str, fixation_columns: Dict, saccade_columns: Dict, index: Dict, ignored: List,
+                  interruptions: List) -> None:
+    """
+    Save the combined results of a session as a .npy file per column and index array, and the times as JSON.
+    The times are written last, so they mark complete results.
+    :param session_id: Humanized reading id of the session
+    :param fixation_columns: Fixation columns as returned by get_fixation_columns
+    :param saccade_columns: Saccade columns as returned by get_saccade_columns
+    :param index: Per-second index as returned by get_second_index
+    :param ignored: List of ignored times relative to the session start
+    :param interruptions: List of interruptions relative to the session start
+    """
+    folder = get_combined_folder(session_id)
     try:
-        makedirs(RESULT_FOLDER)
+        makedirs(folder)
     except FileExistsError:
         pass
-    list_sessions()
-    map_ids()
-    setup_state()
+    for name in COMBINED_FIXATION_COLUMNS:
+        np.save(join(folder, 'fixation_' + name + '.npy'), fixation_columns[name])
+    for name in COMBINED_SACCADE_COLUMNS:
+        np.save(join(folder, 'saccade_' + name + '.npy'), saccade_columns[name])
+    for name, values in index.items():
+        np.save(join(folder, 'index_' + name + '.npy'), values)
+    save_combined_times(session_id, ignored, interruptions)
 
-    sessions = read_sessions()
-    save_parsed(sessions)
 
-    # sessions = read_parsed()
-    for session in sessions:
-        fixations = merge_fixations(session['events'])
-        saccades = get_saccades(fixations)
-        fixation_bins = bin_fixations(fixations)
-        # saccade_bins = bin_saccades(saccades, fixations)
-        ignored_times, interruptions = classify_times(session['events'])
-        trimmed_ignored_times = trim_times(ignored_times, fixations[0]['start'], fixations[-1]['end'])
-        relative_ignored_times = get_relative_times(trimmed_ignored_times, fixations[0]['start'])
-        relative_interruptions = get_relative_interruptions(interruptions, fixations[0]['start'])
+def save_combined_times(session_id: str, ignored: List, interruptions: List) -> None:
+    """
+    Save the ignored times and interruptions of the combined results of a session.
+    :param session_id: Humanized reading id of the session
+    :param ignored: List of ignored times relative to the session start
+    :param interruptions: List of interruptions relative to the session start
+    """
+    with open(join(get_combined_folder(session_id), COMBINED_TIMES_FILE), 'w') as target:
+        dump({
+            'ignored': ignored,
+            'interruptions': interruptions
+        }, target, indent=2)
 
-        try:
-            makedirs(COMBINED_FOLDER)
-        except FileExistsError:
-            pass
-        with open(join(COMBINED_FOLDER, session['file'] + '.json'), 'w') as target:
-            print(dumps({
-                'fixations': fixations,
-                'saccades': saccades,
-                'ignored': relative_ignored_times,
-                'interruptions': relative_interruptions
-            }, indent=2), file=target)
 
-        try:
-            makedirs(PREPROCESSED_FOLDER)
-        except FileExistsError:
-            pass
-        with open(join(PREPROCESSED_FOLDER, session['file'] + '.json'), 'w') as target:
-            print(dumps({
-                'counts': [len(fixation_bin) for fixation_bin in fixation_bins],
-                'ignored': relative_ignored_times,
-                'interruptions': relative_interruptions
-            }, indent=2), file=target)
+def read_combined_times(session_id: str) -> Dict:
+    """
+    Read the ignored times and interruptions of the combined results of a session.
+    :param session_id: Humanized reading id of the session
+    :returns: Dict with ignored and interruptions lists
+    """
+    with open(join(get_combined_folder(session_id), COMBINED_TIMES_FILE), encoding='utf8') as times_file:
+        return load(times_file)
+
+
+def read_combined(session_id: str, fixation_columns: Iterable[str] = COMBINED_FIXATION_COLUMNS,
+                  saccade_columns: Iterable[str] = COMBINED_SACCADE_COLUMNS) -> Dict:
+    """
+    Read the combined results of a session.
+    The columns are memory-mapped, so only the parts that are used are actually read.
+    :param session_id: Humanized reading id of the session
+    :param fixation_columns: Names of the fixation columns to read
+    :param saccade_columns: Names of the saccade columns to read
+    :returns: Dict with fixation and saccade columns, ignored times, and interruptions
+    """
+    folder = get_combined_folder(session_id)
+    session = read_combined_times(session_id)
+    session['fixations'] = {name: np.load(join(folder, 'fixation_' + name + '.npy'), mmap_mode='r')
+                            for name in fixation_columns}
+    session['saccades'] = {name: np.load(join(folder, 'saccade_' + name + '.npy'), mmap_mode='r')
+                           for name in saccade_columns}
+    return session
+
+
+def read_second_index(session_id: str) -> Dict[str, np.ndarray]:
+    """
+    Read the per-second index of a session, see get_second_index.
+    The arrays are memory-mapped, so only the parts that are used are actually read.
+    :param session_id: Humanized reading id of the session
+    :returns: Dict of index arrays
+    """
+    folder = get_combined_folder(session_id)
+    return {splitext(f)[0][len('index_'):]: np.load(join(folder, f), mmap_mode='r')
+            for f in listdir(folder) if f.startswith('index_') and f.endswith('.npy')}
+
+
+def export_combined(session_id: str) -> None:
+    """
+    Export the combined results of a session as a single JSON file, e.g. for the frontend.
+    :param session_id: Humanized reading id of the session
+    """
+    session = read_combined(session_id)
+    fixations = session['fixations']
+    points = fixations['points'].tolist()
+    offsets = fixations['point_offsets'].tolist()
+    with open(join(COMBINED_FOLDER, session_id + '.json'), 'w') as target:
+        dump({
+            'fixations': [{
+                'start': start,
+                'end': end,
+                'points': points[offsets[i]:offsets[i + 1]],
+                'circle': circle
+            } for i, (start, end, circle) in enumerate(zip(fixations['start'].tolist(), fixations['end'].tolist(),
+                                                           fixations['circle'].tolist()))],
+            'saccades': get_saccade_events(session['saccades']),
+            'ignored': session['ignored'],
+            'interruptions': session['interruptions']
+        }, target, indent=2)
+        print(file=target)
+
+
+def list_combined() -> List[str]:
+    """
+    List the sessions with combined results.
+    :returns: List of humanized reading ids
+    """
+    return sorted(f for f in listdir(COMBINED_FOLDER) if isfile(join(COMBINED_FOLDER, f, COMBINED_TIMES_FILE)))
+
+
+def preprocess_session(session: Dict) -> None:
+    """
+    Merge fixations, calculate saccades, and classify times of a single session.
+    Saves the combined and the preprocessed results.
+    :param session: Parsed session
+    """
+    fixations, ignored_times, interruptions = preprocess_events(session['events'])
+    fixation_columns = get_fixation_columns(fixations)
+    saccade_columns = get_saccade_columns(fixation_columns)
+    fixation_bins = bin_fixations(fixations)
+    # saccade_bins = bin_saccades(saccades, fixations)
+    trimmed_ignored_times = trim_times(ignored_times, fixations[0]['start'], fixations[-1]['end'])
+    relative_ignored_times = get_relative_times(trimmed_ignored_times, fixations[0]['start'])
+    relative_interruptions = get_relative_interruptions(interruptions, fixations[0]['start'])
+
+    index = get_second_index(fixation_columns, saccade_columns)
+    save_combined(session['file'], fixation_columns, saccade_columns, index, relative_ignored_times,
+                  relative_interruptions)
+
+    try:
+        makedirs(PREPROCESSED_FOLDER)
+    except FileExistsError:
+        pass
+    with open(join(PREPROCESSED_FOLDER, session['file'] + '.json'), 'w') as target:
+        print(dumps({
+            'counts': [len(fixation_bin) for fixation_bin in fixation_bins],
+            'ignored': relative_ignored_times,
+            'interruptions': relative_interruptions
+        }, indent=2), file=target)
+
+
+def process_session_file(user_folder: str, session_file: str) -> None:
+    """
+    Read, parse, and preprocess a single raw session and save all results.
+    Nothing of the session is kept in memory afterwards.
+    :param user_folder: Name of the user folder in the source folder
+    :param session_file: Name of the session file in the user folder
+    """
+    session = read_session(user_folder, session_file)
+    save_parsed_session(session)
+    preprocess_session(session)
+
+
+def process_session_task(session_path: Tuple[str, str]) -> Dict:
+    """
+    Process a single raw session and report the outcome instead of raising.
+    Used by the worker processes, so only this small status record is sent back.
+    :param session_path: Pair of user folder and session file name
+    :returns: Status with user folder, file, duration in seconds, and error message or None
+    """
+    user_folder, session_file = session_path
+    start = time()
+    error = None
+    try:
+        process_session_file(user_folder, session_file)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return {
+        'user': user_folder,
+        'file': session_file,
+        'duration': time() - start,
+        'error': error
+    }
+
+
+def main(workers: int = cpu_count(), force: bool = False, export_json: bool = False) -> List[Dict]:
+    """
+    Preprocess all new and changed raw sessions and remove the results of deleted ones.
+    Sessions are distributed to worker processes, each reading its raw session and writing its results.
+    :param workers: Number of worker processes
+    :param force: Whether to preprocess all sessions regardless of the manifest
+    :param export_json: Whether to also export the combined results of all sessions as JSON
+    :returns: List of status records of the sessions that failed
+    """
+    try:
+        makedirs(RESULT_FOLDER)
+    except FileExistsError:
+        pass
+    list_sessions()
+    map_ids()
+
+    manifest = read_manifest()
+    parameters = get_parameters()
+    previous_entries = manifest['sessions'] if not force and manifest['parameters'] == parameters else {}
+    entries = {}
+    changed_entries = {}
+    session_paths = []
+    for user_folder, session_file in iter_session_files():
+        key = user_folder + '/' + session_file
+        entry, changed = get_manifest_entry(user_folder, session_file, previous_entries.get(key))
+        if changed:
+            changed_entries[key] = entry
+            session_paths.append((user_folder, session_file))
+            remove_chunks(entry['session'])
+        else:
+            entries[key] = entry
+    current_ids = {entry['session'] for entry in list(entries.values()) + list(changed_entries.values())}
+    removed_ids = {entry['session'] for entry in manifest['sessions'].values()} - current_ids
+    for session_id in removed_ids:
+        remove_session_outputs(session_id)
+    print('{} unchanged, {} to preprocess, {} removed'.format(len(entries), len(session_paths), len(removed_ids)))
+    setup_state(bool(session_paths or removed_ids))
+
+    failed = []
+    if session_paths:
+        pool = Pool(workers)
+        for i, status in enumerate(pool.imap_unordered(process_session_task, session_paths), 1):
+            progress = '{}/{} {} - '.format(i, len(session_paths), join(status['user'], status['file']))
+            if status['error']:
+                failed.append(status)
+                print(progress + 'failed - ' + status['error'])
+            else:
+                key = status['user'] + '/' + status['file']
+                entries[key] = changed_entries[key]
+                print(progress + 'done ({:.1f}s)'.format(status['duration']))
+        pool.close()
+        pool.join()
+    for status in failed:
+        print('failed - ' + join(status['user'], status['file']) + ' - ' + status['error'])
+
+    save_manifest({
+        'parameters': parameters,
+        'sessions': entries
+    })
+    if export_json:
+        for session_id in list_combined():
+            export_combined(session_id)
+    return failed
 
 
 if __name__ == '__main__':
-    main()
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Preprocess the raw sessions.')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='preprocess all sessions, not only changed ones')
+    parser.add_argument('--json', action='store_true', help='also export the combined results as JSON')
+    arguments = parser.parse_args()
+    if main(arguments.workers, arguments.force, arguments.json):
+        exit(1)
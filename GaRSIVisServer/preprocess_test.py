@@ -1,6 +1,513 @@
+import time
 import unittest
+from datetime import datetime, timedelta
+from io import StringIO
+from json import dump, load
+from operator import itemgetter
+from os import chdir, environ, getcwd, makedirs, remove, stat
+from os.path import isfile, join
+from re import match
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List, Tuple
+from unittest.mock import patch
 
-from preprocess import bin_fixations, merge_overlapping_times, trim_times
+import numpy as np
+
+from preprocess import CATEGORY_NONE, CHUNK_FOLDER, CHUNK_PARAMETER_FOLDER, COMBINED_SACCADE_COLUMNS, \
+    EVENT_CATEGORIES, EVENT_TYPES, PARSE_ARGS, PARSE_SKIP, PREPROCESS_PROJECTION, T_L, T_R, bin_fixations, \
+    classify_times, export_combined, get_event_args, get_event_categories, get_fixation_columns, get_reading_id, \
+    get_saccade_columns, get_saccades, get_second_index, list_combined, main, merge_overlapping_times, parse_minute, \
+    parse_session, parse_timestamp, preprocess_events, read_combined, read_combined_times, read_manifest, \
+    read_sessions, save_combined, save_combined_times, trim_times
+from smallestenclosingcircle import make_circle
+
+
+# Reference implementations of the separate stages replaced by preprocess_events
+def get_type_codes(events: Dict, predicate: Callable[[str], bool]) -> List[int]:
+    """
+    Get the codes of all event types matching a predicate.
+    :param events: Event columns
+    :param predicate: Function to test the event type name
+    :returns: List of matching type codes
+    """
+    return [code for code, event_type in enumerate(events['types']) if predicate(event_type)]
+
+
+def reference_normalize_events(events: Dict) -> Dict:
+    """
+    Normalize events with regard to the coordinates.
+    :param events: Parsed event columns
+    :returns: Normalized, parsed event columns
+    """
+    # Scroll offset of each event is the offset after the last scroll event before it
+    scroll_indices = np.flatnonzero(np.isin(events['type'], get_type_codes(events, lambda t: t == 'SCROLL')))
+    scroll_offsets = np.zeros(len(scroll_indices) + 1)
+    scroll_offsets[1:] = [events['args'][i]['px_after'] for i in scroll_indices.tolist()]
+    offsets = scroll_offsets[np.searchsorted(scroll_indices, np.arange(len(events['type'])), side='right')]
+    gaze_codes = get_type_codes(events, lambda t: t.startswith('FIXATION') or t == 'GAZE')
+    # Gaze events that were only timestamped have no coordinates and stay NaN
+    gaze_mask = np.isin(events['type'], gaze_codes)
+    events['y'][gaze_mask] += offsets[gaze_mask]
+    return events
+
+
+def reference_merge_fixations(events: Dict) -> List:
+    """
+    Merge fixation start, data, and end point events into fixation events with a duration.
+    :param events: Parsed event columns of any type
+    :returns: List of merged fixation events
+    """
+    start_code, data_code, end_code = [events['types'].index(t) if t in events['types'] else -1
+                                       for t in ['FIXATIONSTART', 'FIXATIONDATA', 'FIXATIONEND']]
+    indices = np.flatnonzero(np.isin(events['type'], [start_code, data_code, end_code]))
+    types = events['type'][indices].tolist()
+    timestamps = events['timestamp'][indices].tolist()
+    xs = events['x'][indices].tolist()
+    ys = events['y'][indices].tolist()
+    fixations = []
+    current_fixation = {
+        'start': None,
+        'end': None,
+        'points': [],
+        'circle': None
+    }
+    started = False
+    for event_type, timestamp, x, y in zip(types, timestamps, xs, ys):
+        if event_type == start_code:
+            started = True
+            point = (x, y)
+            current_fixation['start'] = timestamp
+            current_fixation['points'] = [point]
+        elif started and event_type == data_code:
+            point = (x, y)
+            current_fixation['points'].append(point)
+        elif started and event_type == end_code:
+            started = False
+            current_fixation['end'] = timestamp
+            point = (x, y)
+            current_fixation['points'].append(point)
+            circle = [round(c, 2) for c in make_circle(current_fixation['points'])]
+            current_fixation['circle'] = circle
+            fixations.append(current_fixation)
+            current_fixation = {}
+    return fixations
+
+
+def reference_classify_times(events: Dict) -> Tuple[List, List]:
+    """
+    Classify the time segments of a list of events.
+    The first and last couple of events are stripped.
+    Times of interest before an interruption are marked.
+    The time after an interruptions until reading is resumed is stripped.
+    :param events: Parsed event columns
+    :returns: List of time durations with classification
+    """
+    open_code, blur_code, active_code, reason_code, focus_code = [
+        events['types'].index(t) if t in events['types'] else -1
+        for t in ['OPEN', 'BLUR', 'ACTIVE', 'REASON', 'FOCUS']
+    ]
+    gaze_codes = set(get_type_codes(events, lambda t: match('(?:GAZE|FIXATION)', t)))
+    first_timestamp = int(events['timestamp'][0])
+    last_timestamp = int(events['timestamp'][-1])
+    last_gaze_timestamp = None
+    ignoring_until = None
+    reason = None
+    active_windows = []
+    ignored_times = []
+    interruptions = []
+    state = 'before'
+    for index, (event_type, timestamp) in enumerate(zip(events['type'].tolist(), events['timestamp'].tolist())):
+        if event_type == open_code:
+            # If this is the first OPEN, ignore everything before
+            # Otherwise only ignore time since the last gaze
+            ignoring_until = timestamp + T_R
+            ignored_times.append({
+                'start': last_gaze_timestamp if last_gaze_timestamp else first_timestamp,
+                'end': ignoring_until,
+                'class': "stripped",
+                'comment': "Before and shortly after open"
+            })
+            state = 'reading'
+        elif state == 'reading' and event_type in gaze_codes:
+            if not ignoring_until or ignoring_until < timestamp:
+                last_gaze_timestamp = timestamp
+        elif state == 'reading' and event_type == blur_code:
+            state = 'blurred'
+        elif state == 'blurred' and event_type == active_code:
+            active_windows.append(events['args'][index])
+        elif event_type == reason_code:
+            reason = events['args'][index]['reason']
+        elif state == 'blurred' and event_type == focus_code:
+            ignoring_until = timestamp + T_R
+            if last_gaze_timestamp:
+                if reason == 'interruption':  # ext. interruptions don't affect previous gazes
+                    classification = "normal"
+                else:
+                    classification = "target"
+
+                if T_L:
+                    ignored_times.append({
+                        'start': last_gaze_timestamp - T_L,
+                        'end': last_gaze_timestamp,
+                        'class': "stripped",
+                        'comment': "Interruption lag"
+                    })
+                ignored_times.append({
+                    'start': last_gaze_timestamp,
+                    'end': ignoring_until,
+                    'class': "stripped",
+                    'comment': "Non-reading time"
+                })
+                interruptions.append({
+                    'timestamp': last_gaze_timestamp - T_L,
+                    'class': classification,
+                    'reason': reason,
+                    'active': active_windows
+                })
+                last_gaze_timestamp = None
+            reason = None
+            active_windows = []
+            state = 'reading'
+    ignored_times.append({
+        'start': max((last_gaze_timestamp or 0) - T_R, ignored_times[-1]['end']),
+        'end': last_timestamp,
+        'class': "stripped",
+        'comment': "Ignore last gazes"
+    })
+
+    ignored_times.sort(key=itemgetter('start'))
+    return merge_overlapping_times(ignored_times), interruptions
+
+
+SESSION = """2018-01-10T10:00:00.000Z|OPEN|paper.pdf
+2018-01-10T10:00:00.100Z|FIXATIONSTART|10.00,20.00;1.00%,2.00%;word
+2018-01-10T10:00:00.116Z|GAZE|[hidden]
+2018-01-10T10:00:00.132Z|SCROLL|0->100;0.00%->10.00%
+2018-01-10T10:00:00.148Z|FIXATIONEND|14.00,20.00;1.00%,2.00%;word
+2018-01-10T10:00:00.164Z|HEAD|1.00,2.00,3.00;0.10,0.20,0.30
+"""
+
+
+@unittest.skipUnless(hasattr(time, 'tzset'), "requires time.tzset")
+class TimestampTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tz = environ.get('TZ')
+
+    def tearDown(self) -> None:
+        if self.tz is None:
+            environ.pop('TZ', None)
+        else:
+            environ['TZ'] = self.tz
+        time.tzset()
+        parse_minute.cache_clear()
+
+    @staticmethod
+    def reference(timestamp: str) -> int:
+        return int(datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ').timestamp() * 1000)
+
+    def test_same_as_datetime(self) -> None:
+        # Around DST changes, with a 30 min DST change in Lord Howe
+        days = [datetime(2018, 3, 25), datetime(2018, 10, 28), datetime(2018, 3, 11), datetime(2018, 4, 1)]
+        for tz in ['UTC', 'Europe/Berlin', 'America/Vancouver', 'Australia/Lord_Howe']:
+            environ['TZ'] = tz
+            time.tzset()
+            parse_minute.cache_clear()
+            for day in days:
+                for offset in range(0, 24 * 3600 * 1000, 997 * 61):
+                    timestamp = (day + timedelta(milliseconds=offset)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+                    self.assertEqual(self.reference(timestamp), parse_timestamp(timestamp), tz + ' ' + timestamp)
+
+    def test_other_format(self) -> None:
+        self.assertEqual(self.reference('2018-01-10T10:00:00.5Z'), parse_timestamp('2018-01-10T10:00:00.5Z'))
+
+
+INTERRUPTED_SESSION = SESSION + """2018-01-10T10:00:01.000Z|FIXATIONDATA|1.00,1.00;1.00%,1.00%;
+2018-01-10T10:00:04.000Z|FIXATIONSTART|30.00,40.00;1.00%,2.00%;
+2018-01-10T10:00:04.016Z|FIXATIONSTART|31.00,40.00;1.00%,2.00%;
+2018-01-10T10:00:04.032Z|FIXATIONDATA|32.00,41.00;1.00%,2.00%;
+2018-01-10T10:00:04.048Z|FIXATIONEND|33.00,42.00;1.00%,2.00%;
+2018-01-10T10:00:04.064Z|FIXATIONEND|34.00,42.00;1.00%,2.00%;
+2018-01-10T10:00:05.000Z|GAZE|30.00,40.00;1.00%,2.00%;
+2018-01-10T10:00:05.100Z|BLUR|
+2018-01-10T10:00:05.200Z|ACTIVE|app.exe;Title
+2018-01-10T10:00:06.000Z|REASON|distraction
+2018-01-10T10:00:06.100Z|FOCUS|
+2018-01-10T10:00:07.000Z|GAZE|30.00,40.00;1.00%,2.00%;
+2018-01-10T10:00:07.100Z|BLUR|
+2018-01-10T10:00:07.200Z|FOCUS|
+2018-01-10T10:00:09.000Z|FIXATIONSTART|50.00,60.00;1.00%,2.00%;
+2018-01-10T10:00:09.100Z|FIXATIONEND|50.00,61.00;1.00%,2.00%;
+2018-01-10T10:00:12.000Z|CLOSE|
+"""
+
+
+class ParseSessionTest(unittest.TestCase):
+    def test_columns(self) -> None:
+        events = parse_session(StringIO(SESSION))
+        self.assertEqual(5, len(events['timestamp']))
+        self.assertEqual(148, events['timestamp'][3] - events['timestamp'][0])
+        self.assertEqual(['word'], events['strings'])
+        self.assertEqual({'document': 'paper.pdf'}, get_event_args(events, 0))
+        self.assertEqual({
+            'x': 10.0,
+            'y': 20.0,
+            'rel_x': 1.0,
+            'rel_y': 2.0,
+            'text': 'word'
+        }, get_event_args(events, 1))
+        self.assertEqual(3.0, get_event_args(events, 4)['z'])
+
+    def test_projection(self) -> None:
+        events = parse_session(StringIO(SESSION), {
+            'FIXATIONSTART': PARSE_ARGS,
+            'SCROLL': PARSE_SKIP
+        })
+        self.assertEqual(['OPEN', 'FIXATIONSTART', 'FIXATIONEND', 'HEAD'],
+                         [events['types'][code] for code in events['type']])
+        self.assertEqual({}, get_event_args(events, 0))
+        self.assertEqual(10.0, get_event_args(events, 1)['x'])
+        self.assertEqual({}, get_event_args(events, 2))
+        self.assertEqual({}, get_event_args(events, 3))
+
+    def test_normalize(self) -> None:
+        events = parse_session(StringIO(SESSION))
+        fixations = preprocess_events(events)[0]
+        self.assertEqual([(10.0, 20.0), (14.0, 120.0)], fixations[0]['points'])
+        # The events themselves are not changed
+        self.assertEqual([20.0, 20.0], events['y'][[1, 3]].tolist())
+
+    def test_merge_fixations(self) -> None:
+        fixations = preprocess_events(parse_session(StringIO(SESSION)))[0]
+        self.assertEqual(1, len(fixations))
+        self.assertEqual(48, fixations[0]['end'] - fixations[0]['start'])
+        self.assertEqual([(10.0, 20.0), (14.0, 120.0)], fixations[0]['points'])
+
+
+class PreprocessEventsTest(unittest.TestCase):
+    def test_same_as_stages(self) -> None:
+        for projection in [None, PREPROCESS_PROJECTION]:
+            events = parse_session(StringIO(INTERRUPTED_SESSION), projection)
+            fixations, ignored, interruptions = preprocess_events(events)
+            self.assertEqual((ignored, interruptions), classify_times(events))
+            reference_normalize_events(events)
+            self.assertEqual(reference_merge_fixations(events), fixations)
+            self.assertEqual(reference_classify_times(events), (ignored, interruptions))
+
+    def test_categories(self) -> None:
+        self.assertEqual(set(EVENT_TYPES), set(EVENT_CATEGORIES))
+        # An unknown event type of a newer logger is ignored instead of failing the session
+        events = parse_session(StringIO(SESSION + '2018-01-10T10:00:01.000Z|GAZEPOINT|\n'))
+        self.assertEqual(CATEGORY_NONE, get_event_categories(events)[-1])
+        self.assertEqual(reference_classify_times(events), classify_times(events))
+
+    def test_interruption(self) -> None:
+        _, ignored, interruptions = preprocess_events(parse_session(StringIO(INTERRUPTED_SESSION)))
+        self.assertEqual(1, len(interruptions))
+        self.assertEqual('distraction', interruptions[0]['reason'])
+        self.assertEqual([{'app_id': 'app.exe', 'app_title': 'Title'}], interruptions[0]['active'])
+        self.assertEqual(['Before and shortly after open', 'Non-reading time', 'Ignore last gazes'],
+                         [time['comment'] for time in ignored])
+
+
+class SaccadeTest(unittest.TestCase):
+    FIXATIONS = [{
+        'start': 0,
+        'end': 100,
+        'points': [(9.0, 10.0), (11.0, 10.0)],
+        'circle': [10.0, 10.0, 1.0]
+    }, {
+        'start': 150,
+        'end': 250,
+        'points': [(11.0, 14.0), (15.0, 14.0), (13.0, 13.0)],
+        'circle': [13.0, 14.0, 2.0]
+    }, {
+        'start': 300,
+        'end': 400,
+        'points': [(13.0, 4.0)],
+        'circle': [13.0, 4.0, 0.5]
+    }]
+
+    def test_columns(self) -> None:
+        saccades = get_saccade_columns(get_fixation_columns(self.FIXATIONS))
+        self.assertEqual([100, 250], saccades['start'].tolist())
+        self.assertEqual([150, 300], saccades['end'].tolist())
+        self.assertEqual([[10.0, 10.0], [13.0, 14.0]], saccades['origin'].tolist())
+        self.assertEqual([[13.0, 14.0], [13.0, 4.0]], saccades['destination'].tolist())
+        self.assertEqual([5.0, 10.0], saccades['length'].tolist())
+        self.assertEqual([2.0, 7.5], saccades['radius_length'].tolist())
+        self.assertAlmostEqual(53.130102354, saccades['angle'][0])
+        self.assertEqual(-90.0, saccades['angle'][1])
+
+    def test_events(self) -> None:
+        saccades = get_saccades(self.FIXATIONS)
+        self.assertEqual(['start', 'end', 'origin', 'destination', 'length', 'radius_length', 'angle'],
+                         list(saccades[0]))
+        self.assertEqual((13.0, 14.0), saccades[1]['origin'])
+        self.assertEqual(7.5, saccades[1]['radius_length'])
+
+    def test_single(self) -> None:
+        self.assertEqual([], get_saccades(self.FIXATIONS[:1]))
+
+
+class SecondIndexTest(unittest.TestCase):
+    def test_prefixes(self) -> None:
+        fixation_columns = get_fixation_columns(SaccadeTest.FIXATIONS + [{
+            'start': 2400,
+            'end': 2600,
+            'points': [(20.0, 20.0)],
+            'circle': [20.0, 20.0, 0.0]
+        }])
+        index = get_second_index(fixation_columns, get_saccade_columns(fixation_columns))
+        self.assertEqual([0, 3, 3, 4], index['fixation_count_prefix'].tolist())
+        self.assertEqual([0, 2, 3, 3], index['saccade_count_prefix'].tolist())
+        fixation_sums = index['fixation_duration_sum_prefix'] + index['fixation_count_prefix'] * \
+            index['fixation_duration_shift']
+        self.assertEqual([0, 300, 300, 500], np.round(fixation_sums).tolist())
+        self.assertEqual([50, 50, 2000], index['saccade_duration_sorted'].tolist())
+        self.assertEqual([5.0, 10.0, np.hypot(7.0, 16.0)], index['saccade_length_sorted'].tolist())
+
+
+class CombinedTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.patch = patch('preprocess.COMBINED_FOLDER', self.directory.name)
+        self.patch.start()
+        fixation_columns = get_fixation_columns(SaccadeTest.FIXATIONS)
+        saccade_columns = get_saccade_columns(fixation_columns)
+        save_combined('session', fixation_columns, saccade_columns,
+                      get_second_index(fixation_columns, saccade_columns), [{
+            'start': 0,
+            'end': 1
+        }], [])
+
+    def tearDown(self) -> None:
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_read(self) -> None:
+        session = read_combined('session', ['start', 'end'], ['length'])
+        self.assertEqual([0, 150, 300], session['fixations']['start'].tolist())
+        self.assertEqual(['length'], list(session['saccades']))
+        self.assertEqual([5.0, 10.0], session['saccades']['length'].tolist())
+        self.assertEqual([{'start': 0, 'end': 1}], session['ignored'])
+
+    def test_times(self) -> None:
+        save_combined_times('session', [], [{'timestamp': 2}])
+        self.assertEqual({'ignored': [], 'interruptions': [{'timestamp': 2}]}, read_combined_times('session'))
+        self.assertEqual([5.0, 10.0], read_combined('session')['saccades']['length'].tolist())
+
+    def test_export(self) -> None:
+        export_combined('session')
+        with open(join(self.directory.name, 'session.json'), encoding='utf8') as export_file:
+            session = load(export_file)
+        self.assertEqual([[list(point) for point in fixation['points']] for fixation in SaccadeTest.FIXATIONS],
+                         [fixation['points'] for fixation in session['fixations']])
+        self.assertEqual(COMBINED_SACCADE_COLUMNS, list(session['saccades'][0]))
+        self.assertEqual([13.0, 14.0], session['saccades'][1]['origin'])
+
+
+class MainTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = getcwd()
+        self.directory = TemporaryDirectory()
+        chdir(self.directory.name)
+        makedirs(join('sessions', 'user'))
+        self.write_session('first.txt', INTERRUPTED_SESSION)
+        self.write_session('second.txt', INTERRUPTED_SESSION)
+
+    def tearDown(self) -> None:
+        chdir(self.cwd)
+        self.directory.cleanup()
+
+    @staticmethod
+    def write_session(session_file: str, content: str) -> None:
+        with open(join('sessions', 'user', session_file), 'w') as target:
+            target.write(content)
+
+    def test_malformed(self) -> None:
+        self.write_session('malformed.txt', INTERRUPTED_SESSION + 'not an event\n')
+        failed = main(2)
+        self.assertEqual(['malformed.txt'], [status['file'] for status in failed])
+        self.assertIn('IndexError', failed[0]['error'])
+        # The other sessions of the batch are still preprocessed, the malformed one is retried next time
+        self.assertEqual(2, len(list_combined()))
+        self.assertEqual(['user/first.txt', 'user/second.txt'], sorted(read_manifest()['sessions']))
+
+    def test_streaming(self) -> None:
+        with patch('preprocess.parse_session', wraps=parse_session) as parse:
+            sessions = read_sessions()
+            self.assertEqual(0, parse.call_count)
+            session = next(sessions)
+            # Only the session being consumed is parsed
+            self.assertEqual(1, parse.call_count)
+            self.assertEqual(parse_session(StringIO(INTERRUPTED_SESSION))['timestamp'].tolist(),
+                             session['events']['timestamp'].tolist())
+            self.assertEqual(1, len(list(sessions)))
+            self.assertEqual(2, parse.call_count)
+
+    @staticmethod
+    def read_state() -> dict:
+        with open(join('data', 'state.json'), encoding='utf8') as state_file:
+            return load(state_file)
+
+    def test_unchanged(self) -> None:
+        main(1)
+        state = self.read_state()
+        state['chunk_size'] = 10
+        with open(join('data', 'state.json'), 'w') as state_file:
+            dump(state, state_file)
+        preprocessed = join('data', 'preprocessed', get_reading_id('first') + '.json')
+        modified = stat(preprocessed).st_mtime_ns
+        self.assertEqual([], main(1))
+        self.assertEqual(modified, stat(preprocessed).st_mtime_ns)
+        state = self.read_state()
+        self.assertEqual(10, state['chunk_size'])
+        self.assertTrue(all(state['prediction'].values()))
+        self.assertTrue(state['prediction_summary'])
+
+    def test_changed(self) -> None:
+        main(1)
+        previous = read_manifest()['sessions']['user/second.txt']
+        # Chunks of the previous events are not reused by a later annotation edit
+        chunk_files = [join(CHUNK_FOLDER, previous['session'] + '.json'),
+                       join(CHUNK_PARAMETER_FOLDER, previous['session'] + '.json')]
+        makedirs(CHUNK_PARAMETER_FOLDER)
+        for path in chunk_files:
+            open(path, 'w').close()
+        self.write_session('second.txt', INTERRUPTED_SESSION.replace('50.00,61.00', '52.00,61.00'))
+        main(1)
+        self.assertNotEqual(previous['hash'], read_manifest()['sessions']['user/second.txt']['hash'])
+        self.assertFalse(any(isfile(path) for path in chunk_files))
+        state = self.read_state()
+        self.assertFalse(any(state['prediction'].values()))
+        self.assertFalse(state['prediction_summary'])
+
+    def test_added(self) -> None:
+        main(1)
+        self.write_session('third.txt', INTERRUPTED_SESSION)
+        main(1)
+        state = self.read_state()
+        self.assertEqual(3, len(list_combined()))
+        self.assertEqual(3, len(state['prediction']))
+        self.assertFalse(any(state['prediction'].values()))
+        self.assertFalse(state['prediction_summary'])
+
+    def test_removed(self) -> None:
+        main(1)
+        remove(join('sessions', 'user', 'second.txt'))
+        main(1)
+        state = self.read_state()
+        self.assertEqual([get_reading_id('first')], list_combined())
+        self.assertFalse(isfile(join('data', 'preprocessed', get_reading_id('second') + '.json')))
+        self.assertEqual(['user/first.txt'], list(read_manifest()['sessions']))
+        self.assertEqual([get_reading_id('first')], list(state['prediction']))
+        self.assertFalse(any(state['prediction'].values()))
+
+    def test_parse_lines(self) -> None:
+        events = parse_session(StringIO(INTERRUPTED_SESSION))
+        streamed = parse_session(iter(INTERRUPTED_SESSION.splitlines(True)))
+        for name in ['timestamp', 'type', 'x', 'y']:
+            np.testing.assert_array_equal(events[name], streamed[name])
 
 
 class BinningTest(unittest.TestCase):
@@ -19,9 +19,12 @@
 # If not, see <http://www.gnu.org/licenses/>.
 #
 
+import itertools
 import math
 import random
 
+import numpy
+
 
 # Data conventions: A point is a pair of floats (x, y). A circle is a triple of floats (center x, center y, radius).
 
@@ -36,13 +39,7 @@ def make_circle(points):
     # Convert to float and randomize order
     shuffled = [(float(x), float(y)) for (x, y) in points]
     random.shuffle(shuffled)
-
-    # Progressively add points to circle or recompute circle
-    c = None
-    for (i, p) in enumerate(shuffled):
-        if c is None or not is_in_circle(c, p):
-            c = _make_circle_one_point(shuffled[ : i + 1], p)
-    return c
+    return _make_circle_shuffled(shuffled)
 
 
 # One boundary point known
@@ -129,3 +126,162 @@ def is_in_circle(c, p):
 # Returns twice the signed area of the triangle defined by (x0, y0), (x1, y1), (x2, y2).
 def _cross_product(x0, y0, x1, y1, x2, y2):
     return (x1 - x0) * (y2 - y0) - (y1 - y0) * (x2 - x0)
+
+
+#
+# Batch version of make_circle for many groups of points at once, using numpy.
+# Input: Flat arrays of x and y coordinates of all points, and the offsets of the groups into them,
+#   e.g. offsets [0, 3, 5] for a group of the first three and a group of the next two points.
+#   Every group has to contain at least one point.
+# Seed: With a seed, the randomized order is reproducible, otherwise the random module is used like in make_circle.
+# Approximate: Instead of the smallest circle, return the circle around the center of the bounding box.
+#   It encloses all points and its radius is at most sqrt(2) times the radius of the smallest circle,
+#   as the bounding box fits into the square around the smallest circle.
+# Output: Array of shape (number of groups, 3) with center x, center y, and radius of each group.
+#
+def make_circles(xs, ys, offsets, seed=None, approximate=False):
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    counts = numpy.diff(offsets)
+    circles = numpy.zeros((len(counts), 3))
+    if len(counts) == 0:
+        return circles
+    starts = offsets[:-1]
+
+    if approximate:
+        circles[:, 0] = (numpy.minimum.reduceat(xs, starts) + numpy.maximum.reduceat(xs, starts)) / 2.0
+        circles[:, 1] = (numpy.minimum.reduceat(ys, starts) + numpy.maximum.reduceat(ys, starts)) / 2.0
+        groups = numpy.repeat(numpy.arange(len(counts)), counts)
+        distances = numpy.hypot(xs - circles[groups, 0], ys - circles[groups, 1])
+        circles[:, 2] = numpy.maximum.reduceat(distances, starts)
+        return circles
+
+    # Single points are their own circle
+    circles[counts == 1, 0] = xs[starts[counts == 1]]
+    circles[counts == 1, 1] = ys[starts[counts == 1]]
+    # Only points that are not strictly inside the quadrilateral of the extreme points can be on the circle
+    groups = numpy.repeat(numpy.arange(len(counts)), counts)
+    outside = ~_is_interior(xs, ys, groups, starts)
+    xs = xs[outside]
+    ys = ys[outside]
+    counts = numpy.bincount(groups[outside], minlength=len(counts))
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+
+    pending = []
+    for size in numpy.unique(counts[counts > 1]).tolist():
+        group_indices = numpy.flatnonzero(counts == size)
+        if size > _MAX_VECTORIZED_SIZE:
+            pending.extend(group_indices.tolist())
+            continue
+        point_indices = offsets[group_indices, numpy.newaxis] + numpy.arange(size)
+        group_xs = xs[point_indices]
+        group_ys = ys[point_indices]
+        # The circle with the farthest pair as diameter is the smallest circle if it encloses all points
+        distances = numpy.hypot(group_xs[:, :, numpy.newaxis] - group_xs[:, numpy.newaxis, :],
+                                group_ys[:, :, numpy.newaxis] - group_ys[:, numpy.newaxis, :])
+        farthest = distances.reshape(len(group_indices), -1).argmax(axis=1)
+        rows = numpy.arange(len(group_indices))
+        candidates = _make_diameters(group_xs[rows, farthest // size], group_ys[rows, farthest // size],
+                                     group_xs[rows, farthest % size], group_ys[rows, farthest % size])
+        enclosed = _encloses(candidates[:, numpy.newaxis, :], group_xs[:, numpy.newaxis, :],
+                             group_ys[:, numpy.newaxis, :])[:, 0]
+        circles[group_indices[enclosed]] = candidates[enclosed]
+        # Otherwise it is the smallest circumcircle of three points that encloses all points
+        group_indices = group_indices[~enclosed]
+        if len(group_indices) == 0:
+            continue
+        triples = numpy.array(list(itertools.combinations(range(size), 3)), dtype=numpy.int64).T
+        batch_size = max(1, _MAX_BATCH_ELEMENTS // (triples.shape[1] * size))
+        for batch in range(0, len(group_indices), batch_size):
+            batch_indices = group_indices[batch:batch + batch_size]
+            point_indices = offsets[batch_indices, numpy.newaxis] + numpy.arange(size)
+            group_xs = xs[point_indices]
+            group_ys = ys[point_indices]
+            candidates = _make_circumcircles(group_xs[:, triples[0]], group_ys[:, triples[0]],
+                                             group_xs[:, triples[1]], group_ys[:, triples[1]],
+                                             group_xs[:, triples[2]], group_ys[:, triples[2]])
+            enclosed = _encloses(candidates, group_xs[:, numpy.newaxis, :], group_ys[:, numpy.newaxis, :])
+            radii = numpy.where(enclosed, candidates[:, :, 2], numpy.inf)
+            best = radii.argmin(axis=1)
+            found = numpy.isfinite(radii[numpy.arange(len(batch_indices)), best])
+            circles[batch_indices[found]] = candidates[numpy.flatnonzero(found), best[found]]
+            pending.extend(batch_indices[~found].tolist())
+
+    # Larger groups use the randomized algorithm
+    rng = random.Random(seed) if seed is not None else random
+    for group in sorted(pending):
+        start, end = offsets[group], offsets[group + 1]
+        points = list(zip(xs[start:end].tolist(), ys[start:end].tolist()))
+        rng.shuffle(points)
+        circles[group] = _make_circle_shuffled(points)
+    return circles
+
+
+_MAX_VECTORIZED_SIZE = 12
+_MAX_BATCH_ELEMENTS = 1 << 20
+
+
+# Progressively add points to circle or recompute circle, for points that are already shuffled
+def _make_circle_shuffled(points):
+    c = None
+    for (i, p) in enumerate(points):
+        if c is None or not is_in_circle(c, p):
+            c = _make_circle_one_point(points[ : i + 1], p)
+    return c
+
+
+# Returns which points are strictly inside the quadrilateral of the leftmost, topmost, rightmost, and bottommost
+# point of their group. They are inside the convex hull, so they cannot be on the smallest enclosing circle.
+def _is_interior(xs, ys, groups, starts):
+    extremes = [_first_extreme(xs, numpy.minimum, groups, starts), _first_extreme(ys, numpy.minimum, groups, starts),
+                _first_extreme(xs, numpy.maximum, groups, starts), _first_extreme(ys, numpy.maximum, groups, starts)]
+    interior = numpy.ones(len(xs), dtype=bool)
+    for a, b in zip(extremes, extremes[1:] + extremes[:1]):
+        a = a[groups]
+        b = b[groups]
+        interior &= _cross_product(xs[a], ys[a], xs[b], ys[b], xs, ys) > 0.0
+    return interior
+
+
+# Returns the index of the first point with the smallest or largest value in each group
+def _first_extreme(values, ufunc, groups, starts):
+    candidates = numpy.flatnonzero(values == ufunc.reduceat(values, starts)[groups])
+    _, first = numpy.unique(groups[candidates], return_index=True)
+    return candidates[first]
+
+
+# Vectorized version of make_diameter, returns an array of circles
+def _make_diameters(ax, ay, bx, by):
+    cx = (ax + bx) / 2.0
+    cy = (ay + by) / 2.0
+    r = numpy.maximum(numpy.hypot(cx - ax, cy - ay), numpy.hypot(cx - bx, cy - by))
+    return numpy.stack([cx, cy, r], axis=-1)
+
+
+# Vectorized version of make_circumcircle, returns an array of circles with infinite radius instead of None
+def _make_circumcircles(ax, ay, bx, by, cx, cy):
+    ox = (numpy.minimum(numpy.minimum(ax, bx), cx) + numpy.maximum(numpy.maximum(ax, bx), cx)) / 2.0
+    oy = (numpy.minimum(numpy.minimum(ay, by), cy) + numpy.maximum(numpy.maximum(ay, by), cy)) / 2.0
+    ax0 = ax - ox; ay0 = ay - oy
+    bx0 = bx - ox; by0 = by - oy
+    cx0 = cx - ox; cy0 = cy - oy
+    d = (ax0 * (by0 - cy0) + bx0 * (cy0 - ay0) + cx0 * (ay0 - by0)) * 2.0
+    collinear = d == 0.0
+    d[collinear] = 1.0
+    a2 = ax0 * ax0 + ay0 * ay0
+    b2 = bx0 * bx0 + by0 * by0
+    c2 = cx0 * cx0 + cy0 * cy0
+    x = ox + (a2 * (by0 - cy0) + b2 * (cy0 - ay0) + c2 * (ay0 - by0)) / d
+    y = oy + (a2 * (cx0 - bx0) + b2 * (ax0 - cx0) + c2 * (bx0 - ax0)) / d
+    r = numpy.maximum(numpy.maximum(numpy.hypot(x - ax, y - ay), numpy.hypot(x - bx, y - by)),
+                      numpy.hypot(x - cx, y - cy))
+    r[collinear] = numpy.inf
+    return numpy.stack([x, y, r], axis=-1)
+
+
+# Vectorized version of is_in_circle for all points, circles of shape (groups, candidates, 3),
+# points of shape (groups, 1, points), returns whether each candidate encloses all points of its group
+def _encloses(circles, xs, ys):
+    distances = numpy.hypot(xs - circles[:, :, 0, numpy.newaxis], ys - circles[:, :, 1, numpy.newaxis])
+    return (distances <= circles[:, :, 2, numpy.newaxis] * _MULTIPLICATIVE_EPSILON).all(axis=2)
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+
+from smallestenclosingcircle import make_circle, make_circles
+
+
+def get_groups(seed: int, sizes: list) -> tuple:
+    random = np.random.RandomState(seed)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    xs = random.normal(500, 20, offsets[-1]).round()
+    ys = random.normal(300, 20, offsets[-1]).round()
+    return xs, ys, offsets
+
+
+class MakeCirclesTestCase(unittest.TestCase):
+    def test_empty(self) -> None:
+        self.assertEqual((0, 3), make_circles([], [], [0]).shape)
+
+    def test_single_point(self) -> None:
+        self.assertEqual([[1.0, 2.0, 0.0]], make_circles([1], [2], [0, 1]).tolist())
+
+    def test_collinear(self) -> None:
+        circles = make_circles([0, 0, 0, 1, 2, 3, 4], [0, 1, 2, 1, 2, 3, 4], [0, 3, 7])
+        np.testing.assert_allclose([[0, 1, 1], [2.5, 2.5, np.hypot(1.5, 1.5)]], circles)
+
+    def test_same_as_make_circle(self) -> None:
+        xs, ys, offsets = get_groups(0, list(range(1, 40)) * 5 + [100, 200])
+        circles = make_circles(xs, ys, offsets, seed=1)
+        for circle, start, end in zip(circles, offsets[:-1], offsets[1:]):
+            np.testing.assert_allclose(make_circle(list(zip(xs[start:end], ys[start:end]))), circle, atol=1e-9)
+
+    def test_seed(self) -> None:
+        xs, ys, offsets = get_groups(1, [50, 100, 200])
+        self.assertEqual(make_circles(xs, ys, offsets, seed=1).tolist(), make_circles(xs, ys, offsets, seed=1).tolist())
+
+    def test_approximate(self) -> None:
+        xs, ys, offsets = get_groups(2, list(range(1, 40)) * 5)
+        circles = make_circles(xs, ys, offsets)
+        approximations = make_circles(xs, ys, offsets, approximate=True)
+        for approximation, start, end in zip(approximations, offsets[:-1], offsets[1:]):
+            distances = np.hypot(xs[start:end] - approximation[0], ys[start:end] - approximation[1])
+            self.assertTrue((distances <= approximation[2]).all())
+        self.assertTrue((approximations[:, 2] >= circles[:, 2] - 1e-9).all())
+        self.assertTrue((approximations[:, 2] <= circles[:, 2] * np.sqrt(2) + 1e-9).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,18 +3,24 @@ from multiprocessing.pool import Pool
 from operator import itemgetter
 from os import listdir
 from os.path import join, isfile, splitext
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 from autobahn.twisted.websocket import WebSocketServerProtocol
 
-from chunk import featurize
-from predict import save_prediction,summarize_predictions
-from preprocess import merge_overlapping_times
+from cache import get_cache_stats
+from chunk import refeaturize, update_chunks
+from predict import save_predictions, summarize_predictions
+from preprocess import merge_overlapping_times, read_combined_times, save_combined_times
 
 
 with open(join('data', 'state.json'), encoding='utf8') as state_read:
     state = load(state_read)
 
+cache_counts = {
+    'hits': 0,
+    'misses': 0
+}
+
 
 def on_error(e: Exception) -> None:
     print(e)
@@ -24,31 +30,29 @@ def write_state() -> None:
         dump(state, state_write, indent=2)
 
 
-def merge_annotations(session_name: str, annotations: List) -> None:
-    with open(join('data', 'combined', session_name + '.json'), encoding='utf8') as session_file:
-        session = load(session_file)
-    annotations.extend(session['ignored'])
+def merge_annotations(session_name: str, annotations: List) -> List[Dict]:
+    times = read_combined_times(session_name)
+    # Merging changes the segments in place, an overlapping annotation would change the previous ones too
+    previous_ignored = [dict(time) for time in times['ignored']]
+    annotations.extend(times['ignored'])
     annotations.sort(key=itemgetter('start'))
     merged_annotations = merge_overlapping_times(annotations)
-    session['ignored'] = merged_annotations
-    with open(join('data', 'combined', session_name + '.json'), 'w') as session_file:
-        dump(session, session_file, indent=2)
+    save_combined_times(session_name, merged_annotations, times['interruptions'])
 
     with open(join('data', 'preprocessed', session_name + '.json'), encoding='utf8') as session_file:
         session = load(session_file)
     session['ignored'] = merged_annotations
     with open(join('data', 'preprocessed', session_name + '.json'), 'w') as session_file:
         dump(session, session_file, indent=2)
+    return previous_ignored
 
 
-def featurize_session(session_name: str, chunk_size: int) -> str:
-    featurize(session_name + '.json', chunk_size, True)
-    return session_name
+def featurize_session(session_name: str, chunk_size: int) -> Tuple[str, bool]:
+    return session_name, update_chunks(session_name, chunk_size)
 
 
-def predict(session_name: str) -> str:
-    save_prediction(session_name + '.json')
-    return session_name
+def refeaturize_session(session_name: str, chunk_size: int, previous_ignored: List[Dict]) -> Tuple[str, bool, Dict]:
+    return session_name, False, refeaturize(session_name, chunk_size, previous_ignored)
 
 
 class MyServerProtocol(WebSocketServerProtocol):
@@ -69,6 +73,7 @@ class MyServerProtocol(WebSocketServerProtocol):
         if request_data['type'] == 'annotations':
             print('annotations - start')
             session_name = request_data['session']
+            predictions_valid = state['prediction_summary'] and all(state['prediction'].values())
             state['ignored'][session_name] = False
             state['chunks'][session_name] = False
             for ps in state['prediction']:
@@ -94,7 +99,9 @@ class MyServerProtocol(WebSocketServerProtocol):
                     'valid': False
                 })
             self.pool.apply_async(merge_annotations, [session_name, request_data['annotations']],
-                                  callback=lambda _: self.after_merge_annotations(session_name), error_callback=on_error)
+                                  callback=lambda previous_ignored: self.after_merge_annotations(
+                                      session_name, previous_ignored, predictions_valid),
+                                  error_callback=on_error)
             print('annotations - done')
 
         elif request_data['type'] == 'chunkSize':
@@ -119,38 +126,60 @@ class MyServerProtocol(WebSocketServerProtocol):
                 })
                 print('chunk - start - ' + session_name)
                 self.pool.apply_async(featurize_session, [session_name, state['chunk_size']],
-                                      callback=lambda x: self.after_featurize_session(x), error_callback=on_error)
+                                      callback=lambda x: self.after_featurize_session(*x), error_callback=on_error)
 
         elif request_data['type'] == 'state':
             print('state')
             self.sendJSON("state", state)
 
-    def after_merge_annotations(self, session_name: str) -> None:
+        elif request_data['type'] == 'cache':
+            self.sendJSON("cache", get_cache_stats(cache_counts['hits'], cache_counts['misses']))
+
+    def after_merge_annotations(self, session_name: str, previous_ignored: List[Dict], predictions_valid: bool) -> None:
         state['ignored'][session_name] = True
         write_state()
         self.sendJSON("ignored", {
             'session': session_name,
             'valid': True
         })
-        self.pool.apply_async(featurize_session, [session_name, state['chunk_size']],
-                              callback=lambda _: self.after_featurize_session(session_name), error_callback=on_error)
-
-    def after_featurize_session(self, session_name: str) -> None:
-        print('chunk - done - '+ session_name)
+        self.pool.apply_async(refeaturize_session, [session_name, state['chunk_size'], previous_ignored],
+                              callback=lambda x: self.after_featurize_session(*x, predictions_valid=predictions_valid),
+                              error_callback=on_error)
+
+    def after_featurize_session(self, session_name: str, cache_hit: bool, changes: Optional[Dict] = None,
+                                predictions_valid=False) -> None:
+        print('chunk - done - ' + session_name + (' (cached)' if cache_hit else '') +
+              (' ({} changed)'.format(changes['changed']) if changes else ''))
+        if changes is None:
+            # Refeaturized chunks after annotations are updated in place, so they are neither hits nor misses
+            cache_counts['hits' if cache_hit else 'misses'] += 1
+            self.sendJSON("cache", get_cache_stats(cache_counts['hits'], cache_counts['misses']))
         state['chunks'][session_name] = True
         write_state()
         self.sendJSON("chunk", {
             'session': session_name,
-            'valid': True
+            'valid': True,
+            'changes': changes
         })
         ready_for_prediction = True
         for session in state['chunks']:
             ready_for_prediction = ready_for_prediction and state['chunks'][session]
-        if ready_for_prediction:
-            for session in state['chunks']:
-                print('predict - start - ' + session)
-                self.pool.apply_async(predict, [session],
-                                      callback=lambda x: self.after_predict(x), error_callback=on_error)
+        if ready_for_prediction and changes and changes['changed'] == 0 and predictions_valid:
+            # The chunks are the same as before the annotations, so the predictions are still valid
+            print('predict - unchanged')
+            for session in state['prediction']:
+                self.after_predict(session)
+        elif ready_for_prediction:
+            # One leave-one-session-out round, so the chunks of all sessions are read only once,
+            # its folds run one after another as workers of the pool cannot start worker processes
+            print('predict - start')
+            self.pool.apply_async(save_predictions, [],
+                                  callback=lambda session_names: self.after_predict_all(session_names),
+                                  error_callback=on_error)
+
+    def after_predict_all(self, session_names: List[str]) -> None:
+        for session_name in session_names:
+            self.after_predict(session_name)
 
     def after_predict(self, session_name: str) -> None:
         print('predict - done - ' + session_name)